@@ -1,37 +1,198 @@
-import argparse
-import curses
-import logging
-import os
-import time
-from src.global_monitor import GlobalMonitor
-from src.utils import get_local_time, get_sites
+from src.startup import StartupProfiler
+
+profiler = StartupProfiler()
+with profiler.phase("import standard library"):
+    import argparse
+    import logging
+    import os
+    import time
+with profiler.phase("import src"):
+    from src.global_monitor import GlobalMonitor
+    from src.site_monitor import SiteMonitor, OVERLOAD_POLICIES
+    from src.sites import SitesReader, SitesFileError
+    from src.availability import AvailabilityPolicy
+    from src.windows import DEFAULT_WINDOWS, load_windows
+    from src.export import FORMATS, check_format, export_logs
 
 logger = logging.getLogger()
-os.makedirs("logs", exist_ok=True)
-file_log_handler = logging.FileHandler(
-    "logs/logfile {}.log".format(get_local_time(time.time()).strftime("%d-%m-%Y %Hh%Mm%Ss"))
-)
 
-logger.addHandler(file_log_handler)
-logger.setLevel(logging.INFO)
 
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-file_log_handler.setFormatter(formatter)
+def setup_logging():
+    """
+    Creates the log file of the program in the logs folder.
+    """
+    os.makedirs("logs", exist_ok=True)
+    file_log_handler = logging.FileHandler("logs/logfile {}.log".format(time.strftime("%d-%m-%Y %Hh%Mm%Ss")))
+    logger.addHandler(file_log_handler)
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    file_log_handler.setFormatter(formatter)
+
+
+def run_agent(monitor, address, name, period):
+    """
+    Monitors the websites without any user interface and sends the summaries to an aggregator, until interrupted.
+
+    :param GlobalMonitor monitor: the monitor to run
+    :param str address: the address of the aggregator, as **host:port**
+    :param str name: the name of this agent
+    :param float period: the time in seconds between two summaries
+    """
+    from src.agent import Agent, parse_address
+    agent = Agent(monitor, parse_address(address), name, period)
+    monitor.start_monitoring()
+    agent.start()
+    print(f"Sending the summaries to {address}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            if not monitor.all_started:
+                monitor.start_batch()
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        agent.stop()
+        monitor.stop()
+
+
+def profile_startup(monitor, timeout=10):
+    """
+    Starts monitoring without the user interface until the first request is sent, then prints where the time went.
+
+    :param GlobalMonitor monitor: the monitor to start
+    :param float timeout: the maximum time to wait for the first request
+    """
+    with profiler.phase("start monitoring"):
+        monitor.start_monitoring()
+    t = time.time()
+    while monitor.first_probe is None and time.time() - t < timeout:
+        time.sleep(0.001)
+    if monitor.first_probe:
+        profiler.milestone("first request sent", monitor.first_probe)
+    monitor.stop()
+    print("\n".join(profiler.report()))
+    logger.info("\n".join(profiler.report()))
+
 
 if __name__ == '__main__':
+    with profiler.phase("set up logging"):
+        setup_logging()
     logger.info("Program started")
     parser = argparse.ArgumentParser(usage='A program to monitor websites uptime and response time.')
     parser.add_argument("-f", "--file", type=str, help="The path to the input file.", required=True)
     parser.add_argument("-l", "--logs", type=str, help="The path to store the logs in.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adapt each website's ping interval to its availability and response time.")
+    parser.add_argument("--probe-budget", type=float, help="The maximum number of requests per second overall.")
+    parser.add_argument("--availability-threshold", type=float, default=0.8,
+                        help="A website is down when its availability goes below this value.")
+    parser.add_argument("--recovery-threshold", type=float,
+                        help="A website is back up when its availability reaches this value. "
+                             "Defaults to the availability threshold.")
+    parser.add_argument("--min-samples", type=int, default=3,
+                        help="The number of responses needed before a website can be considered down.")
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="A file to save the state in periodically, and to restore it from at startup.")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="The time in seconds between two snapshots.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Start without the user interface, print the time spent in each startup step "
+                             "once the first request is sent, and exit.")
+    parser.add_argument("--agent", type=str, metavar="HOST:PORT",
+                        help="Run without user interface and send the summaries to the aggregator at this address.")
+    parser.add_argument("--agent-name", type=str, help="The name of this agent. Defaults to the host name.")
+    parser.add_argument("--agent-period", type=float, default=1,
+                        help="The time in seconds between two summaries sent by the agent.")
+    parser.add_argument("--aggregate", type=str, metavar="[HOST:]PORT",
+                        help="Show the summaries sent by agents on this address instead of sending requests.")
+    parser.add_argument("--seasonal-baseline", action="store_true",
+                        help="Learn the usual response time of each website for each hour of the day.")
+    parser.add_argument("--columnar", action="store_true",
+                        help="Store the responses in numpy arrays, which takes less memory. Requires numpy.")
+    parser.add_argument("--windows", type=str, metavar="JSON_FILE",
+                        help="The windows over which the metrics are computed, as a JSON list of objects with a "
+                             "period and a duration in seconds, and optionally a list of stats among "
+                             "availability, codes_count, avg_elapsed, max_elapsed, p50, p90, p95, p99 and skipped.")
+    parser.add_argument("--window-workers", type=int, default=0,
+                        help="Compute the metrics in this many separate processes, to keep the probes and the "
+                             "user interface responsive with thousands of websites.")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="The maximum number of requests of a website waiting for their response.")
+    parser.add_argument("--max-global-in-flight", type=int,
+                        help="The maximum number of requests waiting for their response over all the websites.")
+    parser.add_argument("--overload-policy", choices=OVERLOAD_POLICIES, default='skip',
+                        help="What to do with a probe when too many requests are in flight: skip it, or count it "
+                             "as a timeout without sending it.")
+    parser.add_argument("--store", type=str, metavar="DB_FILE",
+                        help="A SQLite database to store every response and metric in, to query them across websites.")
+    parser.add_argument("--store-retention", type=float,
+                        help="The time in seconds the responses and metrics are kept in the database. Forever by "
+                             "default.")
+    parser.add_argument("--export", type=str, metavar="FOLDER",
+                        help="Convert the raw logs of the websites to columnar files in this folder, then exit.")
+    parser.add_argument("--export-format", choices=FORMATS, default='npz',
+                        help="The format of the exported responses: a NumPy archive per website and day, or a single "
+                             "Arrow IPC file (requires pyarrow). Also used by the e key, on any page.")
+    parser.add_argument("--notify", type=str, action="append", metavar="URL",
+                        help="A webhook to post the websites going down or back up to, as JSON. Prefix it with chat+ "
+                             "for a chat hook expecting a text message. Can be repeated.")
+    parser.add_argument("--notify-window", type=float, default=5,
+                        help="The time in seconds the changes of a website are merged over before being sent.")
+    parser.add_argument("--memory-budget", type=float, metavar="MB",
+                        help="The memory in MB the responses kept by the websites and the histories shown are sized "
+                             "within. The websites probed the most often keep less than 10 minutes of responses. "
+                             "Unlimited by default.")
     args = parser.parse_args()
+    if args.export or args.export_format != 'npz':
+        try:
+            check_format(args.export_format)
+        except ValueError as e:
+            print(e)
+            raise SystemExit(1)
     input_file = args.file
-    sites = get_sites(input_file)
+    #  The monitoring starts with the first chunk of websites, and the next chunks are read as the monitors start.
+    #  An export needs all the websites, so any invalid line stops it
+    site_chunks = iter(SitesReader(input_file, strict=bool(args.export)))
+    try:
+        with profiler.phase("read input file"):
+            sites = next(site_chunks, [])
+    except SitesFileError as e:
+        print(e)
+        raise SystemExit(1)
     if not args.logs:
         print('No folder has been specified to save logs. They will be saved at ./logfiles')
         logs_path = './logfiles'
-        time.sleep(1)
+        if not args.profile_startup and not args.export:
+            time.sleep(1)
     else:
         logs_path = args.logs
+    if args.export:
+        try:
+            names = [site[0] for chunk in (sites, *site_chunks) for site in chunk]
+        except SitesFileError as e:
+            print(e)
+            raise SystemExit(1)
+        n = export_logs(names, logs_path, args.export, args.export_format)
+        print(f"Exported {n} responses to {args.export}")
+        raise SystemExit
     logger.info("Main Monitorer created")
-    mon = GlobalMonitor(sites, logs_path)
-    curses.wrapper(mon.start)
+    windows = load_windows(args.windows) if args.windows else DEFAULT_WINDOWS
+    policy = AvailabilityPolicy(args.availability_threshold, args.recovery_threshold, min_samples=args.min_samples)
+    monitor_factory = SiteMonitor
+    if args.aggregate:
+        from src.agent import Aggregator, parse_address
+        aggregator = Aggregator(parse_address(args.aggregate, ''))
+        aggregator.start()
+        monitor_factory = aggregator.monitor_factory
+    with profiler.phase("create main monitor"):
+        mon = GlobalMonitor(sites, logs_path, args.adaptive, args.probe_budget, policy, args.snapshot,
+                            args.snapshot_interval, monitor_factory, args.seasonal_baseline, args.columnar,
+                            args.window_workers, windows, args.max_in_flight, args.max_global_in_flight,
+                            args.overload_policy, args.store, args.store_retention, args.export_format,
+                            args.notify, args.notify_window, site_chunks,
+                            args.memory_budget and args.memory_budget * 2 ** 20)
+    if args.profile_startup:
+        profile_startup(mon)
+    elif args.agent:
+        run_agent(mon, args.agent, args.agent_name, args.agent_period)
+    else:
+        import curses
+        curses.wrapper(mon.start)
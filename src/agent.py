@@ -0,0 +1,244 @@
+from collections import deque
+from operator import attrgetter
+from threading import Thread
+import logging
+import socket
+import time
+from src.fixed_size import FixedSizeQueue
+from src.site_monitor import SiteMonitor
+from src.summary import WindowSummary, encode_frame, decode_payload, read_frame
+from src.utils import SKIPPED
+from src.windows import DEFAULT_WINDOWS
+
+"""
+This module allows monitoring the websites from several places at once.
+Agents monitor the websites without any user interface and periodically send a summary of the responses
+to an aggregator, which merges the summaries of all the agents and shows them as a single monitor would.
+"""
+
+logger = logging.getLogger()
+
+
+def parse_address(address, default_host='localhost'):
+    """
+    Parses an address of the form **host:port** or **port**.
+
+    :param str address: the address to parse
+    :param str default_host: the host to use if the address has none
+    :rtype: tuple
+    """
+    host, _, port = address.rpartition(':')
+    return host or default_host, int(port)
+
+
+class Agent(Thread):
+    """
+    Sends, every **period**, a summary of the responses received by each monitor since the last summary.
+    The summaries of all the websites are sent in a single frame. If the aggregator can't be reached,
+    the responses are sent with the next summary, as long as they are still in the monitors' queues.
+
+    :param global_monitor.GlobalMonitor global_monitor: the monitor whose websites to summarize
+    :param tuple address: the host and port of the aggregator
+    :param str name: the name identifying this agent. Defaults to the host name
+    :param float period: the time in seconds between two summaries
+    :ivar dict last_ends: the end of the last summary sent for each website
+    :ivar dict names: the ids of the website names already sent on the current connection
+    """
+
+    def __init__(self, global_monitor, address, name=None, period=1):
+        super().__init__()
+        self.global_monitor = global_monitor
+        self.address = address
+        self.name = name or socket.gethostname()
+        self.period = period
+        self.sock = None
+        self.last_ends = {}
+        self.names = {}
+        self.set_stop = False
+
+    def run(self):
+        t = time.time()
+        while not self.set_stop:
+            if time.time() - t > self.period:
+                t = time.time()
+                self.flush()
+            time.sleep(0.01)
+        if self.sock:
+            self.sock.close()
+
+    def summarize(self):
+        """
+        Summarizes the responses received by each monitor since its last summary.
+        Responses more recent than the timeout are left for the next summary, as earlier requests could still
+        be waiting for their response.
+
+        :return: the list of **(website name, summary)**, and the new end of each website's summaries
+        :rtype: tuple
+        """
+        records = []
+        ends = {}
+        now = time.time()
+        for site, monitor in list(self.global_monitor.site_monitors.items()):
+            start = self.last_ends.get(site[0], float('-inf'))
+            end = now - monitor.timeout
+            responses = [r for r in monitor.request_scheduler.results.get_slice(start, end) if r[0] > start]
+            ends[site[0]] = end
+            if responses:
+                summary = WindowSummary(max(start, responses[0][0]), end)
+                for _, code, elapsed in responses:
+                    summary.add(code, elapsed)
+                records.append((site[0], summary))
+        return records, ends
+
+    def flush(self):
+        """
+        Sends the summaries to the aggregator.
+
+        :return: whether the summaries were sent
+        :rtype: bool
+        """
+        records, ends = self.summarize()
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, timeout=10)
+                self.names = {}
+                logger.info(f"Agent {self.name} connected to {self.address}")
+            self.sock.sendall(encode_frame(self.name, records, self.names))
+        except OSError as e:
+            logger.warning(f"Agent {self.name} could not send its summaries: {e}")
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+            return False
+        self.last_ends.update(ends)
+        return True
+
+    def stop(self):
+        self.set_stop = True
+
+
+class Aggregator(Thread):
+    """
+    Receives the summaries sent by the agents and hands them to the :class:`RemoteSiteMonitor` of each website.
+
+    :param tuple address: the host and port to listen on. Port 0 picks a free port
+    :ivar dict monitors: the monitor of each website, by name
+    :ivar set agents: the names of the agents that sent summaries
+    """
+
+    def __init__(self, address):
+        super().__init__(daemon=True)
+        self.server = socket.create_server(address)
+        self.address = self.server.getsockname()
+        self.monitors = {}
+        self.agents = set()
+        self.set_stop = False
+
+    def monitor_factory(self, name, url, interval, timeout, **settings):
+        """
+        Creates the monitor of a website, fed by this aggregator.
+        Can be used as the **monitor_factory** of a :class:`global_monitor.GlobalMonitor`.
+
+        :rtype: RemoteSiteMonitor
+        """
+        monitor = RemoteSiteMonitor(name, url, interval, timeout, settings.get('availability_policy'),
+                                    phase=settings.get('phase', 0), windows=settings.get('windows', DEFAULT_WINDOWS),
+                                    notifier=settings.get('notifier'))
+        self.monitors[name] = monitor
+        return monitor
+
+    def run(self):
+        logger.info(f"Aggregator listening on {self.address}")
+        while not self.set_stop:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            Thread(target=self.receive, args=(connection,), daemon=True).start()
+
+    def receive(self, connection):
+        """
+        Reads the frames sent on a connection until it is closed.
+
+        :param socket.socket connection: the connection with an agent
+        """
+        names = {}
+        with connection:
+            while not self.set_stop:
+                try:
+                    payload = read_frame(connection)
+                    if payload is None:
+                        break
+                    agent, records = decode_payload(payload, names)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Closing the connection with an agent after an invalid frame: {e}")
+                    break
+                if agent not in self.agents:
+                    self.agents.add(agent)
+                    logger.info(f"Agent {agent} connected to the aggregator")
+                for name, summary in records:
+                    if name in self.monitors:
+                        self.monitors[name].add_summary(summary)
+
+    def stop(self):
+        self.set_stop = True
+        self.server.close()
+
+
+class RemoteSiteMonitor(SiteMonitor):
+    """
+    A :class:`site_monitor.SiteMonitor` that doesn't send any request, but computes its metrics from the summaries
+    received from the agents. The summaries of all the agents are merged, so the metrics are those of all the
+    requests made to the website.
+
+    :ivar fixed_size.FixedSizeQueue summaries: the summaries received, sorted by the end of their window
+    :ivar deque new_summaries: the summaries not yet taken into account in the availability
+    """
+
+    def __init__(self, name, url, interval, timeout, availability_policy=None, capacity=100000, phase=0,
+                 windows=DEFAULT_WINDOWS, notifier=None):
+        super().__init__(name, url, interval, timeout, availability_policy=availability_policy, phase=phase,
+                         windows=windows, notifier=notifier)
+        self.summaries = FixedSizeQueue(capacity, key=attrgetter('end'))
+        self.new_summaries = deque()
+
+    def add_summary(self, summary):
+        """
+        Adds a summary received from an agent.
+
+        :param summary.WindowSummary summary: the summary
+        """
+        self.summaries.add(summary)
+        self.new_summaries.append(summary)
+
+    def start_probing(self):
+        """
+        Nothing to do, the requests are made by the agents.
+        """
+
+    def consume_responses(self):
+        """
+        Feeds the summaries received since the last call to the availability tracker and to the windows.
+        """
+        while self.new_summaries:
+            summary = self.new_summaries.popleft()
+            self.engine.add_summary(summary)
+            transition = self.tracker.add_counts(summary.end, summary.successes, summary.count)
+            if transition:
+                self.set_transition(transition, summary.start)
+
+    def get_metrics(self, end, duration, delay):
+        """
+        get the metrics over the specified time window ending at **end**, by merging the summaries of the window.
+        """
+        summaries = self.summaries.get_slice(*self.get_window(end, duration, delay))
+        if summaries:
+            merged = WindowSummary(summaries[0].start, summaries[-1].end)
+            for summary in summaries:
+                merged.merge(summary)
+            codes_count = +merged.codes_count
+            skipped = codes_count.pop(SKIPPED, 0)
+            if merged.count:
+                return merged.availability, codes_count, merged.max_elapsed, merged.avg_elapsed, skipped
+            if skipped:
+                return None, codes_count, None, None, skipped
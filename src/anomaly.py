@@ -0,0 +1,118 @@
+import math
+from src.windows import describe_duration
+
+"""
+This module detects unusual response times as the responses come in, with a constant amount of memory per website.
+"""
+
+SECONDS_PER_DAY = 86400
+
+
+class LatencyDetector:
+    """
+    Learns the usual response time of a website with an exponentially weighted moving average and variance,
+    and flags the responses that are much slower than usual. Outliers are clipped before being added to
+    the baseline, so that a spike doesn't hide the next ones, while a lasting change is still learned.
+    With **seasonal**, a separate baseline is learned for each hour of the day (UTC), so that a website which is
+    always slower at peak hours isn't flagged every day.
+
+    :param float alpha: the weight of each new response in the moving average
+    :param float threshold: a response is a spike when it is this many standard deviations above the average
+    :param float min_excess: the minimum difference in seconds with the average for a response to be a spike
+    :param int warmup: the number of responses needed before a baseline is trusted
+    :param float divergence: a window is flagged when its maximum response time is this many times its average
+    :param float cooldown: the minimum time in seconds between two anomalies of the same kind
+    :param bool seasonal: whether to keep a baseline per hour of the day
+    :ivar list baselines: the count, mean and variance of each baseline
+    :ivar dict last_anomaly: the time of the last anomaly of each kind
+    """
+
+    def __init__(self, alpha=0.05, threshold=4, min_excess=0.05, warmup=30, divergence=10, cooldown=60,
+                 seasonal=False):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_excess = min_excess
+        self.warmup = warmup
+        self.divergence = divergence
+        self.cooldown = cooldown
+        self.seasonal = seasonal
+        self.baselines = [[0, 0, 0] for _ in range(24 if seasonal else 1)]
+        self.last_anomaly = {}
+
+    def baseline(self, t):
+        """
+        Returns the baseline to use at time **t**.
+
+        :param float t: a unix time
+        :return: the count, mean and variance of the baseline
+        :rtype: list
+        """
+        if self.seasonal:
+            return self.baselines[int(t % SECONDS_PER_DAY // 3600)]
+        return self.baselines[0]
+
+    def update(self, t, elapsed):
+        """
+        Checks whether a response is a spike, then adds it to the baseline.
+
+        :param float t: the time the request was sent
+        :param float elapsed: the response time
+        :return: the anomaly, as a dict, or None
+        """
+        baseline = self.baseline(t)
+        count, mean, var = baseline
+        anomaly = None
+        if count >= self.warmup:
+            excess = elapsed - mean
+            limit = self.threshold * math.sqrt(var)
+            if excess > limit:
+                if excess > self.min_excess:
+                    anomaly = self.flag(t, 'latency_spike', elapsed=elapsed, baseline=mean)
+                elapsed = mean + max(limit, self.min_excess)
+        diff = elapsed - mean
+        increment = self.alpha * diff if count else diff
+        baseline[0] = count + 1
+        baseline[1] = mean + increment
+        baseline[2] = (1 - self.alpha) * (var + diff * increment) if count else 0
+        return anomaly
+
+    def check_window(self, t, avg_elapsed, max_elapsed, duration):
+        """
+        Checks whether the maximum response time of a window is far from its average.
+
+        :param float t: the time the window was computed
+        :param float avg_elapsed: the average response time of the window
+        :param float max_elapsed: the maximum response time of the window
+        :param float duration: the duration of the window in seconds
+        :return: the anomaly, as a dict, or None
+        """
+        if avg_elapsed > 0 and max_elapsed - avg_elapsed > self.min_excess \
+                and max_elapsed > self.divergence * avg_elapsed:
+            return self.flag(t, 'latency_divergence', avg_elapsed=avg_elapsed, max_elapsed=max_elapsed,
+                             duration=duration)
+        return None
+
+    def flag(self, t, kind, **details):
+        """
+        Creates an anomaly, unless one of the same kind was created during the cooldown.
+
+        :rtype: Union[dict,None]
+        """
+        if t - self.last_anomaly.get(kind, float('-inf')) < self.cooldown:
+            return None
+        self.last_anomaly[kind] = t
+        return {'time': t, 'kind': kind, **details}
+
+
+def describe_anomaly(anomaly):
+    """
+    Formats an anomaly to be shown to the user.
+
+    :param dict anomaly: the anomaly returned by a :class:`LatencyDetector`
+    :rtype: str
+    """
+    if anomaly['kind'] == 'latency_spike':
+        return f"response time spike: {int(1000 * anomaly['elapsed'])} ms" \
+               f" instead of {int(1000 * anomaly['baseline'])} ms usually"
+    return f"maximum response time of {int(1000 * anomaly['max_elapsed'])} ms over the last" \
+           f" {describe_duration(anomaly['duration'])}, for an average of {int(1000 * anomaly['avg_elapsed'])} ms"
@@ -0,0 +1,113 @@
+from collections import deque
+from src.utils import SKIPPED
+
+"""
+This module contains the classes used to follow the availability of a website continuously,
+as the responses come in, instead of re-computing it over a fixed window.
+"""
+
+
+class AvailabilityPolicy:
+    """
+    The rules deciding when a website goes down or recovers.
+    The default policy is the 80% rule: the website is down when less than 80% of the requests
+    of the last two minutes succeeded, once there are at least 3 of them, so that a single failed first
+    request doesn't report a website down.
+
+    :param float threshold: the website goes down when its availability drops below this value
+    :param float recovery_threshold: the website recovers when its availability goes back to this value.
+        Setting it above **threshold** adds hysteresis to avoid flapping. Defaults to **threshold**
+    :param float window: the duration in seconds over which the availability is calculated
+    :param int min_samples: the minimum number of responses in the window before any transition is emitted
+    """
+
+    def __init__(self, threshold=0.8, recovery_threshold=None, window=120, min_samples=3):
+        self.threshold = threshold
+        self.recovery_threshold = threshold if recovery_threshold is None else recovery_threshold
+        self.window = window
+        self.min_samples = min_samples
+        if self.recovery_threshold < self.threshold:
+            raise ValueError("The recovery threshold should not be lower than the threshold")
+
+
+class AvailabilityTracker:
+    """
+    Keeps the availability of a website over a sliding window, updated with every response.
+    Each update is O(1) amortized: responses are only added once and removed once from the window.
+
+    :param AvailabilityPolicy policy: the rules to apply. Defaults to the 80% rule
+    :param float resolution: the responses arriving within this many seconds after the latest entry are merged
+        into it, so that the window holds at most one entry per **resolution**. An entry leaves the window as a
+        whole, when its first response does. If 0, each response is an entry
+    :ivar deque samples: the time, number of successes and number of responses of each entry in the window
+    :ivar int successes: the number of successful responses in the window
+    :ivar int total: the number of responses in the window
+    :ivar bool available: the current state of the website
+    """
+
+    def __init__(self, policy=None, resolution=0):
+        self.policy = policy or AvailabilityPolicy()
+        self.resolution = resolution
+        self.samples = deque()
+        self.successes = 0
+        self.total = 0
+        self.latest = float('-inf')
+        self.available = True
+
+    @property
+    def availability(self):
+        """
+        The ratio of successful responses in the window, or None if there are none.
+        """
+        if not self.total:
+            return None
+        return self.successes / self.total
+
+    def add(self, t, code):
+        """
+        Adds a response to the window and checks whether the website went down or recovered.
+
+        :param float t: the time the request was sent
+        :param int code: the status code of the response. Skipped probes are ignored
+        :return: **'unavailable_since'** if the website went down, **'recovered_at'** if it recovered, None otherwise
+        """
+        if code == SKIPPED:
+            return None
+        return self.add_counts(t, int(code < 400), 1)
+
+    def add_counts(self, t, successes, total):
+        """
+        Adds several responses sharing the same time to the window, for instance the summary
+        of a time window, and checks whether the website went down or recovered.
+
+        :param float t: the time of the responses
+        :param int successes: the number of successful responses
+        :param int total: the number of responses
+        :return: **'unavailable_since'** if the website went down, **'recovered_at'** if it recovered, None otherwise
+        """
+        if not total:
+            return None
+        samples = self.samples
+        if self.resolution and samples and samples[-1][0] <= t < samples[-1][0] + self.resolution:
+            first, old_successes, old_total = samples[-1]
+            samples[-1] = (first, old_successes + successes, old_total + total)
+        else:
+            samples.append((t, successes, total))
+        self.successes += successes
+        self.total += total
+        self.latest = max(self.latest, t)
+        #  Responses arrive roughly in order, so the oldest ones are at the left
+        while self.samples[0][0] <= self.latest - self.policy.window:
+            _, old_successes, old_total = self.samples.popleft()
+            self.successes -= old_successes
+            self.total -= old_total
+        if self.total < self.policy.min_samples:
+            return None
+        availability = self.availability
+        if self.available and availability < self.policy.threshold:
+            self.available = False
+            return 'unavailable_since'
+        if not self.available and availability >= self.policy.recovery_threshold:
+            self.available = True
+            return 'recovered_at'
+        return None
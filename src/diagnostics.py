@@ -0,0 +1,328 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Thread, Semaphore
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from src.memory import get_usage, count_history
+
+"""
+This module gives visibility over where the time and memory of the program go, while it runs.
+"""
+
+logger = logging.getLogger()
+
+
+class Timers:
+    """
+    Accumulates the time spent in some parts of the program, from any thread.
+    The garbage collector pauses are measured too, once :meth:`track_gc` has been called.
+
+    :ivar dict stats: the total time, number of calls and longest call of each part since the last read
+    :ivar float since: the time of the last read
+    :ivar Semaphore sem: a semaphore to make the timers multi-thread safe
+    """
+
+    def __init__(self):
+        self.stats = defaultdict(lambda: [0, 0, 0])
+        self.since = time.time()
+        self.sem = Semaphore()
+        self.gc_start = None
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Measures the time spent running the code in the context.
+
+        :param str name: the name of the measured part
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name, duration):
+        """
+        Adds a call to the stats of **name**.
+
+        :param str name: the name of the measured part
+        :param float duration: the duration of the call in seconds
+        """
+        self.sem.acquire()
+        stats = self.stats[name]
+        stats[0] += duration
+        stats[1] += 1
+        stats[2] = max(stats[2], duration)
+        self.sem.release()
+
+    def track_gc(self):
+        """
+        Measures the pauses of the garbage collector under the name **'gc'**.
+        """
+        if self.on_gc not in gc.callbacks:
+            gc.callbacks.append(self.on_gc)
+
+    def on_gc(self, phase, _):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.add('gc', time.perf_counter() - self.gc_start)
+            self.gc_start = None
+
+    def read(self):
+        """
+        Returns the stats since the last read, and starts over.
+
+        :return: for each part, the time spent per second, the number of calls and the longest call, in seconds
+        :rtype: dict
+        """
+        self.sem.acquire()
+        t = time.time()
+        elapsed = max(t - self.since, 1e-6)
+        stats = {name: {'per_second': total / elapsed, 'calls': calls, 'max': longest}
+                 for name, (total, calls, longest) in self.stats.items()}
+        self.stats.clear()
+        self.since = t
+        self.sem.release()
+        return stats
+
+
+TIMERS = Timers()
+"""
+The timers shared by the whole program.
+"""
+
+
+class ProbeActivity:
+    """
+    Follows how many probes are sent and waiting for their response over time, to show whether they come in bursts.
+    The probes only update a few counters, so the activity stays exact and takes the same memory however rarely
+    it is read.
+
+    :param float slot: the duration in seconds of the slots over which the probes sent are counted
+    :ivar int sent: the number of probes sent since the last read
+    :ivar int in_flight: the number of probes waiting for their response
+    :ivar int peak: the most probes in flight since the last read
+    :ivar int current: the index of the slot of the latest probe sent
+    :ivar int in_slot: the number of probes sent in the current slot
+    :ivar int busiest: the most probes sent in a slot since the last read, the current slot aside
+    :ivar float since: the time of the last read
+    :ivar Semaphore sem: a semaphore to make the counters multi-thread safe
+    """
+
+    def __init__(self, slot=0.1):
+        self.slot = slot
+        self.sent = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.current = None
+        self.in_slot = 0
+        self.busiest = 0
+        self.since = time.time()
+        self.sem = Semaphore()
+
+    def on_sent(self, t):
+        """
+        Records that a probe was sent at time **t**.
+        """
+        slot = int(t / self.slot)
+        self.sem.acquire()
+        self.sent += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        if slot != self.current:
+            self.busiest = max(self.busiest, self.in_slot)
+            self.current = slot
+            self.in_slot = 0
+        self.in_slot += 1
+        self.sem.release()
+
+    def on_done(self):
+        """
+        Records that a probe got its response.
+        """
+        self.sem.acquire()
+        self.in_flight -= 1
+        self.sem.release()
+
+    def read(self):
+        """
+        Returns the activity since the last read, and starts over.
+
+        :return: the number of probes sent, the number of probes in flight now and at the peak, and the number of
+            probes sent in the busiest slot and in an average slot. Their ratio is the burstiness: 1 when the probes
+            are evenly spread, much more when they are sent in bursts
+        :rtype: dict
+        """
+        t = time.time()
+        self.sem.acquire()
+        sent, in_flight, peak = self.sent, self.in_flight, self.peak
+        busiest = max(self.busiest, self.in_slot)
+        self.sent = 0
+        self.peak = in_flight
+        self.busiest = 0
+        self.sem.release()
+        mean = sent * self.slot / max(t - self.since, self.slot)
+        self.since = t
+        return {'sent': sent, 'in_flight': in_flight, 'peak_in_flight': peak, 'peak_per_slot': busiest,
+                'mean_per_slot': mean, 'burstiness': busiest / mean if mean else None, 'slot': self.slot}
+
+
+PROBE_ACTIVITY = ProbeActivity()
+"""
+The activity of the probes of the whole program.
+"""
+
+
+def get_rss():
+    """
+    Returns the memory used by the program (resident set size) in bytes, or None if it can't be read.
+
+    :rtype: Union[int,None]
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def collect(global_monitor):
+    """
+    Gathers the current diagnostics of the program, including an estimate of the memory used by each website,
+    see :func:`memory.get_usage`.
+
+    :param global_monitor.GlobalMonitor global_monitor: the monitor to inspect
+    :return: a JSON serializable dict
+    :rtype: dict
+    """
+    sites = []
+    histories = count_history(global_monitor.ui)
+    memory = {'samples': 0, 'availability': 0, 'buckets': 0, 'history': 0, 'total': 0}
+    for site, monitor in list(global_monitor.site_monitors.items()):
+        scheduler = monitor.request_scheduler
+        sites.append({'name': site[0], 'in_flight': scheduler.in_flight, 'skipped': scheduler.n_skipped,
+                      'new_results': len(scheduler.new_results), 'pending': len(scheduler.results.pending),
+                      'stored': len(scheduler.results), 'capacity': scheduler.results.capacity})
+        usage = get_usage(monitor, histories.get(site[0], 0))
+        sites[-1]['memory'] = usage['total']
+        for part in memory:
+            memory[part] += usage[part]
+    budget = global_monitor.memory_budget
+    if budget:
+        memory.update({'budget': budget.total, 'trimmed': len(budget.trimmed), 'history_size': budget.history_size})
+    notifier = getattr(global_monitor, 'notifier', None)
+    return {'time': time.time(), 'threads': threading.active_count(), 'rss': get_rss(),
+            'timers': TIMERS.read(), 'gc_counts': list(gc.get_count()), 'probes': PROBE_ACTIVITY.read(),
+            'notifications': notifier.read() if notifier else None, 'memory': memory, 'sites': sites}
+
+
+def dump(diagnostics, directory):
+    """
+    Writes the diagnostics to a JSON file.
+
+    :param dict diagnostics: the diagnostics returned by :func:`collect`
+    :param str directory: the folder to write the file in
+    :return: the path of the file
+    :rtype: str
+    """
+    path = os.path.join(directory, f"diagnostics_{time.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(path, 'w') as file:
+        json.dump(diagnostics, file, indent=2)
+    logger.info(f"Diagnostics written to {path}")
+    return path
+
+
+class SamplingProfiler(Thread):
+    """
+    Samples the stacks of all the threads every **interval** during **duration** seconds, then writes a report
+    with the functions the program spent the most time in, and the lines that allocated the most memory.
+    Unlike cProfile, which only follows the thread that enabled it, sampling sees every thread and
+    barely slows the program down.
+
+    :param str directory: the folder to write the report in
+    :param float duration: the time in seconds to profile for
+    :param float interval: the time in seconds between two samples
+    :ivar Counter own: the number of samples where each function was running
+    :ivar Counter cumulative: the number of samples where each function was in the stack
+    :ivar str path: the path of the report, once written
+    """
+
+    def __init__(self, directory, duration=10, interval=0.005):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.n_samples = 0
+        self.end = time.time() + duration
+        self.path = None
+        self.set_stop = False
+
+    def run(self):
+        trace_memory = not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        while not self.set_stop and time.time() < self.end:
+            self.sample()
+            time.sleep(self.interval)
+        self.duration = time.time() - start
+        memory = tracemalloc.take_snapshot().statistics('lineno')[:20] if trace_memory else []
+        if trace_memory:
+            tracemalloc.stop()
+        self.path = self.write_report(memory)
+
+    def sample(self):
+        """
+        Records the function each thread is running, and the functions in its stack.
+        """
+        me = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            self.n_samples += 1
+            self.own[self.describe(frame)] += 1
+            seen = set()
+            while frame is not None:
+                seen.add(self.describe(frame))
+                frame = frame.f_back
+            self.cumulative.update(seen)
+
+    @staticmethod
+    def describe(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def write_report(self, memory):
+        """
+        Writes the report next to the logs.
+
+        :param list memory: the tracemalloc statistics of the lines allocating the most memory
+        :return: the path of the report
+        :rtype: str
+        """
+        path = os.path.join(self.directory, f"profile_{time.strftime('%Y-%m-%d_%H-%M-%S')}.txt")
+        total = max(self.n_samples, 1)
+        lines = [f"{self.n_samples} samples over {self.duration:.1f} seconds", "",
+                 "Functions running (% of the samples):"]
+        lines.extend([f"    {100 * n / total:6.2f}%  {name}" for name, n in self.own.most_common(30)])
+        lines.extend(["", "Functions in the stack (% of the samples):"])
+        lines.extend([f"    {100 * n / total:6.2f}%  {name}" for name, n in self.cumulative.most_common(30)])
+        if memory:
+            lines.extend(["", "Memory allocated while profiling:"])
+            lines.extend([f"    {stat.size / 1024:10.1f} KiB  {stat.traceback}" for stat in memory])
+        with open(path, 'w') as file:
+            file.write("\n".join(lines) + "\n")
+        logger.info(f"Profile written to {path}")
+        return path
+
+    def stop(self):
+        self.set_stop = True
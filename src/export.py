@@ -0,0 +1,275 @@
+from importlib.util import find_spec
+import logging
+import os
+import time
+
+"""
+This module exports the responses of the websites to columnar files, much faster to load for offline analysis
+than the text of the raw logs. The responses are either read from the raw logs, in chunks so that the memory used
+doesn't depend on their size, or taken from the monitors' queues.
+
+Two formats are available:
+
+ - **npz**: a NumPy archive per website and day (UTC), **{website name}_{YYYY-MM-DD}.npz**, holding the
+   **time** (float64), **code** (int16) and **elapsed** (float32) arrays, sorted by time. Requires numpy.
+ - **arrow**: a single Arrow IPC file, **responses.arrow**, with the same columns and a dictionary encoded
+   **site** column. Requires pyarrow.
+"""
+
+logger = logging.getLogger()
+
+FORMATS = ('npz', 'arrow')
+#  The libraries each format needs
+REQUIREMENTS = {'npz': ('numpy',), 'arrow': ('numpy', 'pyarrow')}
+#  The number of bytes of raw logs read at once
+CHUNK_SIZE = 2 ** 20
+DAY = 86400
+
+
+class NpzWriter:
+    """
+    Writes the responses of each website and day to a NumPy archive.
+    The responses of a day are kept in memory until a later day shows up, or another website: the raw logs being
+    in time order, the memory used is at most about a day of responses of one website.
+
+    :param str directory: the folder to write the archives in
+    :ivar dict buffers: the columns of the responses not written yet, by website name and day
+    :ivar set written: the website names and days already written. Late responses are merged with them
+    """
+
+    def __init__(self, directory):
+        import numpy as np
+        self.np = np
+        self.directory = directory
+        self.buffers = {}
+        self.written = set()
+
+    def path(self, name, day):
+        return os.path.join(self.directory, f"{name}_{time.strftime('%Y-%m-%d', time.gmtime(day * DAY))}.npz")
+
+    def write(self, name, times, codes, elapsed):
+        """
+        Adds responses of a website.
+
+        :param str name: the name of the website
+        :param numpy.ndarray times: the request times
+        :param numpy.ndarray codes: the status codes
+        :param numpy.ndarray elapsed: the response times
+        """
+        np = self.np
+        if not len(times):
+            return
+        days = np.floor(times / DAY).astype(np.int64)
+        for day in np.unique(days).tolist():
+            selected = days == day
+            self.buffers.setdefault((name, day), []).append((times[selected], codes[selected], elapsed[selected]))
+        last = int(days.max())
+        for key in [key for key in self.buffers if key[0] != name or key[1] < last]:
+            self.flush(key)
+
+    def flush(self, key):
+        """
+        Writes the buffered responses of a website and day.
+
+        :param tuple key: the website name and the day
+        """
+        np = self.np
+        parts = self.buffers.pop(key)
+        path = self.path(*key)
+        if key in self.written:
+            with np.load(path) as archive:
+                parts.insert(0, (archive['time'], archive['code'], archive['elapsed']))
+        times, codes, elapsed = [np.concatenate(column) for column in zip(*parts)]
+        order = np.argsort(times, kind='stable')
+        np.savez(path, time=times[order], code=codes[order], elapsed=elapsed[order])
+        self.written.add(key)
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(key)
+
+
+class ArrowWriter:
+    """
+    Writes the responses of all the websites to a single Arrow IPC file, one record batch per call to :meth:`write`.
+    The website names are dictionary encoded, with the same dictionary for every batch.
+
+    :param str directory: the folder to write **responses.arrow** in
+    :param list names: the names of all the websites that can be written
+    """
+
+    def __init__(self, directory, names):
+        import numpy as np
+        import pyarrow as pa
+        self.np = np
+        self.pa = pa
+        self.indexes = {name: i for i, name in enumerate(names)}
+        self.dictionary = pa.array(list(names), pa.string())
+        self.schema = pa.schema([('site', pa.dictionary(pa.int32(), pa.string())), ('time', pa.float64()),
+                                 ('code', pa.int16()), ('elapsed', pa.float32())])
+        self.file = pa.OSFile(os.path.join(directory, 'responses.arrow'), 'wb')
+        self.writer = pa.ipc.new_file(self.file, self.schema)
+
+    def write(self, name, times, codes, elapsed):
+        """
+        Adds responses of a website, see :meth:`NpzWriter.write`.
+        """
+        np, pa = self.np, self.pa
+        if not len(times):
+            return
+        sites = pa.DictionaryArray.from_arrays(np.full(len(times), self.indexes[name], np.int32), self.dictionary)
+        self.writer.write_batch(pa.record_batch([sites, times, codes, elapsed], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+
+def check_format(export_format):
+    """
+    Checks that the libraries a format needs are installed, so that a missing one is reported before any export.
+
+    :param str export_format: one of **FORMATS**
+    :raises ValueError: if the format is unknown, or a library it needs isn't installed
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format {export_format}. Choose among {', '.join(FORMATS)}")
+    missing = [module for module in REQUIREMENTS[export_format] if find_spec(module) is None]
+    if missing:
+        raise ValueError(f"The {export_format} export format requires {' and '.join(missing)}. "
+                         f"Install it with pip install {' '.join(missing)}")
+
+
+def get_writer(export_format, directory, names):
+    """
+    Creates the writer of a format, after creating the folder if needed.
+
+    :param str export_format: one of **FORMATS**
+    :param str directory: the folder to write the files in
+    :param list names: the names of the websites to export
+    :rtype: Union[NpzWriter,ArrowWriter]
+    """
+    check_format(export_format)
+    os.makedirs(directory, exist_ok=True)
+    return NpzWriter(directory) if export_format == 'npz' else ArrowWriter(directory, names)
+
+
+def read_raw(path, chunk_size=CHUNK_SIZE):
+    """
+    Reads a raw log file, made of lines **time status_code elapsed**, in chunks.
+    The malformed lines, such as the last line of a program killed while writing it, are logged and skipped.
+
+    :param str path: the path of the file
+    :param int chunk_size: about the number of bytes read at once
+    :return: a generator of the request times, status codes and response times of each chunk, as numpy arrays
+    """
+    import numpy as np
+    with open(path) as file:
+        n_lines = 0
+        while True:
+            lines = file.readlines(chunk_size)
+            if not lines:
+                return
+            try:
+                columns = np.loadtxt(lines, ndmin=2)
+            except ValueError:
+                columns = np.array(parse_raw(lines, path, n_lines), ndmin=2).reshape(-1, 3)
+            n_lines += len(lines)
+            yield columns[:, 0], columns[:, 1].astype(np.int16), columns[:, 2].astype(np.float32)
+
+
+def parse_raw(lines, path, first_line=0):
+    """
+    Parses the lines of a raw log file one at a time, skipping the malformed ones.
+
+    :param list lines: the lines
+    :param str path: the path of the file, for the log
+    :param int first_line: the number of lines of the file before these ones
+    :return: the time, status code and response time of each valid line
+    :rtype: list
+    """
+    rows = []
+    for line, text in enumerate(lines, first_line + 1):
+        fields = text.split()
+        if not fields:
+            continue
+        try:
+            if len(fields) != 3:
+                raise ValueError(f"expected 3 fields, found {len(fields)}")
+            rows.append([float(field) for field in fields])
+        except ValueError as e:
+            logger.warning(f"Skipped line {line} of {path}: {e}")
+    return rows
+
+
+def export_logs(names, logs_path, directory, export_format='npz'):
+    """
+    Exports the raw logs of websites.
+
+    :param list names: the names of the websites, whose raw logs are **{logs_path}/{name}_raw.txt**
+    :param str logs_path: the folder holding the raw logs
+    :param str directory: the folder to write the exported files in
+    :param str export_format: one of **FORMATS**
+    :return: the number of responses exported
+    :rtype: int
+    """
+    writer = get_writer(export_format, directory, names)
+    n = 0
+    for name in names:
+        path = os.path.join(logs_path, name + '_raw.txt')
+        if os.path.isfile(path):
+            for columns in read_raw(path):
+                writer.write(name, *columns)
+                n += len(columns[0])
+    writer.close()
+    logger.info(f"Exported {n} responses from {logs_path} to {directory}")
+    return n
+
+
+def export_monitors(global_monitor, directory, export_format='npz'):
+    """
+    Exports the responses currently held by the monitors' queues.
+
+    :param GlobalMonitor global_monitor: the monitor whose websites to export
+    :param str directory: the folder to write the exported files in
+    :param str export_format: one of **FORMATS**
+    :return: the number of responses exported
+    :rtype: int
+    """
+    import numpy as np
+    monitors = list(global_monitor.site_monitors.items())
+    writer = get_writer(export_format, directory, [site[0] for site, _ in monitors])
+    n = 0
+    for site, monitor in monitors:
+        results = monitor.request_scheduler.results
+        if hasattr(results, 'get_columns'):
+            columns = results.get_columns(float('-inf'), float('inf'))
+        else:
+            responses = results.get_slice(float('-inf'), float('inf'))
+            columns = (np.array([r[0] for r in responses], np.float64), np.array([r[1] for r in responses], np.int16),
+                       np.array([r[2] for r in responses], np.float32))
+        writer.write(site[0], *columns)
+        n += len(columns[0])
+    writer.close()
+    logger.info(f"Exported {n} responses in memory to {directory}")
+    return n
+
+
+def load_npz(directory, name):
+    """
+    Loads the responses of a website exported as npz, all days together.
+
+    :param str directory: the folder of the exported files
+    :param str name: the name of the website
+    :return: the request times, status codes and response times
+    :rtype: tuple
+    """
+    import numpy as np
+    paths = sorted([entry for entry in os.listdir(directory) if entry.startswith(name + '_')
+                    and entry.endswith('.npz') and len(entry) == len(name) + 15])
+    columns = ([], [], [])
+    for path in paths:
+        with np.load(os.path.join(directory, path)) as archive:
+            for column, key in zip(columns, ('time', 'code', 'elapsed')):
+                column.append(archive[key])
+    return tuple([np.concatenate(column) if column else np.empty(0) for column in columns])
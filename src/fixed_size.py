@@ -1,3 +1,5 @@
+from collections import deque
+from operator import itemgetter
 from threading import Semaphore
 from functools import partial
 
@@ -10,47 +12,92 @@ They both have a limited capacity of items to hold and are multi-thread safe.
 class FixedSizeQueue:
     """A fixed size queue where items are kept in ascending order when compared by key.
 
+    Adding elements never waits: they are appended to a lock-free hand-off deque, and moved to the sorted list
+    in a single batch by the next reader. This way, the threads producing the data never contend with each other
+    or with the readers, and each reader only holds the semaphore for one batch merge and a binary search.
+
     :param int capacity: the maximum number of elements kept in the queue
     :param key: the function to use to compare the elements
-    :ivar sem: a semaphore to make the queue multi-thread safe
-    :ivar list h: the inner list to store elements
+    :ivar sem: a semaphore protecting the sorted list
+    :ivar deque pending: the elements added since the last read, in order of arrival
+    :ivar list items: the inner sorted list to store elements
     """
 
     def __init__(self, capacity, key):
         self.capacity = capacity
-        self.h = []
+        self.items = []
+        self.pending = deque(maxlen=capacity)
         self.sem = Semaphore()
         self.key = key
 
-    def add(self, e):
+    @property
+    def h(self):
+        """
+        The sorted list of the elements, including the ones added since the last read.
+
+        :rtype: list
         """
-        adds an element to the queue, while keeping it increasing with respect to **key**
+        self.sem.acquire()
+        self.flush()
+        self.sem.release()
+        return self.items
 
-        :note: A binary heap might have been better for insertion, but I opted for a regular
-            list as heaps mess up the order of the elements, and we need it.
-            Additionally the items to be added should be pretty much in order
-            most of the time so very little comparisons are done
+    def add(self, e):
+        """
+        adds an element to the queue. It is put in its place, with respect to **key**, by the next read.
 
         :param e: the element to add to the queue
+        """
+        # appending to a deque is atomic, so no lock is needed
+        self.pending.append(e)
 
+    def add_many(self, elements):
         """
-        self.sem.acquire()
-        # Adds item to its place
-        val = self.key(e)
-        for i in range(len(self.h) - 1, -1, -1):
-            if val >= self.key(self.h[i]):
-                self.h.insert(i + 1, e)
-                break
-        else:
-            self.h.insert(0, e)
+        adds several elements to the queue at once.
+
+        :param list elements: the elements to add
+        """
+        self.pending.extend(elements)
+
+    def flush(self):
+        """
+        Moves the pending elements to the sorted list. Must be called with the semaphore acquired.
+
+        :note: The elements should be pretty much in order most of the time, in which case they are
+            just appended. Otherwise the list is sorted again, which is close to linear for a list made
+            of two sorted runs.
+        """
+        if not self.pending:
+            return
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        batch.sort(key=self.key)
+        in_order = not self.items or self.key(batch[0]) >= self.key(self.items[-1])
+        self.items.extend(batch)
+        if not in_order:
+            self.items.sort(key=self.key)
         # Ensures the length is below capacity
-        if len(self.h) > self.capacity:
-            self.h = self.h[-self.capacity:]
+        if len(self.items) > self.capacity:
+            del self.items[:-self.capacity]
+
+    def resize(self, capacity):
+        """
+        Changes the maximum number of elements kept, dropping the oldest ones beyond it.
+
+        :param int capacity: the new capacity
+        """
+        self.sem.acquire()
+        self.flush()
+        self.capacity = capacity
+        if len(self.items) > capacity:
+            del self.items[:-capacity]
         self.sem.release()
 
     def get_slice(self, min_value, max_value):
         """
         gets the list of all values in lust whose **key** value is between **min_value** and **max_value**.
+        The returned list is a copy, which won't change when elements are added.
 
         :param int min_value: the maximum value.
         :param int max_value: the minimum value.
@@ -59,18 +106,10 @@ class FixedSizeQueue:
         if min_value > max_value:
             return []
         self.sem.acquire()
-        min_slice = max_slice = 0
-        # Get the index of the smallest value that is gt min_value
-        for i in range(len(self.h)):
-            if self.key(self.h[i]) >= min_value:
-                min_slice = i
-                break
-        # Get the index of the greater value that is lt both min_slice and max_value
-        for i in range(len(self.h) - 1, min_slice - 1, -1):
-            if self.key(self.h[i]) <= max_value:
-                max_slice = i + 1
-                break
-        h_slice = self.h[min_slice:max_slice]
+        self.flush()
+        min_slice = bisect(self.items, min_value, self.key, False)
+        max_slice = bisect(self.items, max_value, self.key, True)
+        h_slice = self.items[min_slice:max_slice]
         self.sem.release()
         return h_slice
 
@@ -84,6 +123,145 @@ class FixedSizeQueue:
         return self.h.__getitem__(item)
 
 
+class ColumnarQueue(FixedSizeQueue):
+    """A :class:`FixedSizeQueue` of responses, **(time, status code, elapsed time)**, sorted by time.
+
+    The responses are stored in three numpy arrays (float64 times, int16 status codes, float32 elapsed times),
+    which takes about 18 bytes per response instead of more than 100 for a list of tuples, and allows
+    computing the metrics of a window with vectorized operations, see :meth:`get_columns`.
+    numpy is only needed when this queue is used.
+
+    :param int capacity: the maximum number of responses kept in the queue
+    :ivar int start: the position of the oldest response in the arrays
+    :ivar int end: the position after the most recent response in the arrays
+    """
+
+    def __init__(self, capacity, key=None):
+        import numpy as np
+        super().__init__(capacity, key=itemgetter(0))
+        self.np = np
+        #  Some room is left after the responses, so they are only moved back to the start once in a while
+        size = capacity + capacity // 4 + 1
+        self.times = np.empty(size, np.float64)
+        self.codes = np.empty(size, np.int16)
+        self.elapsed = np.empty(size, np.float32)
+        self.start = 0
+        self.end = 0
+
+    @property
+    def h(self):
+        """
+        The responses, as a list of tuples.
+
+        :rtype: list
+        """
+        return self.get_slice(float('-inf'), float('inf'))
+
+    def flush(self):
+        """
+        Moves the pending responses to the arrays. Must be called with the semaphore acquired.
+        """
+        if not self.pending:
+            return
+        np = self.np
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        times, codes, elapsed = zip(*batch)
+        times = np.array(times, np.float64)
+        order = np.argsort(times, kind='stable')[-self.capacity:]
+        n = len(order)
+        if self.end + n > len(self.times):
+            kept = min(self.end - self.start, self.capacity - n)
+            for column in (self.times, self.codes, self.elapsed):
+                column[:kept] = column[self.end - kept:self.end]
+            self.start, self.end = 0, kept
+        new_end = self.end + n
+        self.times[self.end:new_end] = times[order]
+        self.codes[self.end:new_end] = np.array(codes, np.int16)[order]
+        self.elapsed[self.end:new_end] = np.array(elapsed, np.float32)[order]
+        if self.end > self.start and self.times[self.end] < self.times[self.end - 1]:
+            #  Only the responses after the first late one need to be sorted again
+            first = self.start + int(np.searchsorted(self.times[self.start:self.end], self.times[self.end], 'right'))
+            order = np.argsort(self.times[first:new_end], kind='stable')
+            for column in (self.times, self.codes, self.elapsed):
+                column[first:new_end] = column[first:new_end][order]
+        self.end = new_end
+        self.start = max(self.start, self.end - self.capacity)
+
+    def resize(self, capacity):
+        """
+        Changes the maximum number of responses kept, and moves the most recent ones to arrays of the new size,
+        so that the memory of the old arrays is released.
+
+        :param int capacity: the new capacity
+        """
+        self.sem.acquire()
+        self.flush()
+        kept = min(self.end - self.start, capacity)
+        size = capacity + capacity // 4 + 1
+        for name in ('times', 'codes', 'elapsed'):
+            column = getattr(self, name)
+            resized = self.np.empty(size, column.dtype)
+            resized[:kept] = column[self.end - kept:self.end]
+            setattr(self, name, resized)
+        self.start, self.end = 0, kept
+        self.capacity = capacity
+        self.sem.release()
+
+    def get_columns(self, min_value, max_value):
+        """
+        gets the times, status codes and elapsed times of the responses whose time is between **min_value**
+        and **max_value**. The returned arrays are copies, which won't change when responses are added.
+
+        :param float min_value: the minimum time
+        :param float max_value: the maximum time
+        :rtype: tuple
+        """
+        self.sem.acquire()
+        self.flush()
+        times = self.times[self.start:self.end]
+        low = self.start + int(self.np.searchsorted(times, min_value, 'left'))
+        high = self.start + int(self.np.searchsorted(times, max_value, 'right'))
+        if min_value > max_value:
+            high = low
+        columns = self.times[low:high].copy(), self.codes[low:high].copy(), self.elapsed[low:high].copy()
+        self.sem.release()
+        return columns
+
+    def get_slice(self, min_value, max_value):
+        times, codes, elapsed = self.get_columns(min_value, max_value)
+        return list(zip(times.tolist(), codes.tolist(), elapsed.tolist()))
+
+    def __len__(self):
+        self.sem.acquire()
+        self.flush()
+        length = self.end - self.start
+        self.sem.release()
+        return length
+
+
+def bisect(items, value, key, right):
+    """
+    Finds where **value** would be inserted in the sorted list **items** with a binary search.
+
+    :param list items: the list sorted by **key**
+    :param value: the value to look for
+    :param key: the function giving the value of each element
+    :param bool right: whether to return the position after the elements equal to **value**, or before them
+    :rtype: int
+    """
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high) // 2
+        middle_value = key(items[middle])
+        if middle_value < value or (right and middle_value == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
 FixedSizeList = partial(FixedSizeQueue, key=lambda _: 1)
 """
 Partial class of FixedSizeQueue, which basically serves as a List with a fixed size.
@@ -0,0 +1,116 @@
+from bisect import bisect_left, bisect_right, insort
+
+"""
+This module gives an overview of all the monitored websites, with the worst ones first,
+kept up to date as the monitors publish their metrics instead of sorting every website for every frame.
+"""
+
+#  The rankings of the websites, and whether the lowest value comes first when showing the worst websites
+RANKINGS = {'availability': True, 'p99': False, 'errors': False}
+#  The upper bounds in seconds of the bands of the latency distribution. The last band has no upper bound
+LATENCY_BANDS = (0.1, 0.25, 0.5, 1, 2.5)
+
+
+class FleetIndex:
+    """
+    Keeps the websites ordered by each of the **RANKINGS**, along with fleet-wide aggregates.
+    Each ranking is a list of **(value, name)** sorted with a binary search, so updating a website moves
+    a single entry, and the worst or best websites are read from either end of the list.
+    The websites without a value for a ranking, for instance before their first window, are left out of it.
+
+    :ivar dict health: the latest values of each website, by name
+    :ivar dict rankings: the sorted **(value, name)** of each ranking
+    :ivar list names: the names of the websites, sorted, to find those starting with a prefix
+    :ivar float sum_availability: the sum of the availabilities of the websites
+    :ivar int n_available: the number of websites with an availability
+    :ivar int n_down: the number of websites currently down
+    :ivar list bands: the number of websites in each latency band, according to their p99
+    """
+
+    def __init__(self):
+        self.health = {}
+        self.rankings = {ranking: [] for ranking in RANKINGS}
+        self.names = []
+        self.sum_availability = 0
+        self.n_available = 0
+        self.n_down = 0
+        self.bands = [0] * (len(LATENCY_BANDS) + 1)
+
+    def update(self, name, health):
+        """
+        Replaces the values of a website.
+
+        :param str name: the name of the website
+        :param dict health: the website's **availability**, **p99** and **errors** (None if unknown),
+            and whether it is **down**, see :meth:`site_monitor.SiteMonitor.get_health`
+        """
+        old = self.health.get(name)
+        if old is None:
+            insort(self.names, name)
+        else:
+            self.account(old, -1)
+            for ranking in RANKINGS:
+                if old[ranking] is not None:
+                    order = self.rankings[ranking]
+                    del order[bisect_left(order, (old[ranking], name))]
+        self.health[name] = health
+        self.account(health, 1)
+        for ranking in RANKINGS:
+            if health[ranking] is not None:
+                insort(self.rankings[ranking], (health[ranking], name))
+
+    def account(self, health, sign):
+        """
+        Adds the values of a website to the aggregates, or takes them out with a **sign** of -1.
+        """
+        if health['availability'] is not None:
+            self.sum_availability += sign * health['availability']
+            self.n_available += sign
+        if health['down']:
+            self.n_down += sign
+        if health['p99'] is not None:
+            self.bands[bisect_left(LATENCY_BANDS, health['p99'])] += sign
+
+    @property
+    def availability(self):
+        """
+        The average availability of the websites, or None if none is known yet.
+        """
+        return self.sum_availability / self.n_available if self.n_available else None
+
+    def top(self, ranking, n, prefix='', worst=True):
+        """
+        Returns the worst (or best) websites of a ranking.
+
+        :param str ranking: one of **RANKINGS**
+        :param int n: the number of websites to return
+        :param str prefix: only the websites whose name starts with it are returned
+        :param bool worst: whether to start from the worst websites or from the best ones
+        :return: the **(value, name)** of the websites
+        :rtype: list
+        """
+        order = self.rankings[ranking]
+        from_start = RANKINGS[ranking] == worst
+        if prefix:
+            start = bisect_left(self.names, prefix)
+            end = bisect_right(self.names, prefix + '\U0010ffff')
+            #  When few websites match, sorting them is cheaper than walking the ranking
+            if end - start < len(order) // 8:
+                matching = [(self.health[name][ranking], name) for name in self.names[start:end]
+                            if self.health[name][ranking] is not None]
+                matching.sort(reverse=not from_start)
+                return matching[:n]
+        entries = order if from_start else reversed(order)
+        result = []
+        for entry in entries:
+            if len(result) == n:
+                break
+            if entry[1].startswith(prefix):
+                result.append(entry)
+        return result
+
+    def count(self, prefix=''):
+        """
+        Returns the number of websites whose name starts with **prefix**.
+        """
+        return bisect_right(self.names, prefix + '\U0010ffff') - bisect_left(self.names, prefix)
@@ -1,65 +1,186 @@
+from heapq import nlargest
 from threading import Thread
-from src.site_monitor import SiteMonitor, EXCEPTION_RAISED
+from src.site_monitor import SiteMonitor, EXCEPTION_RAISED, ADAPTIVE_MIN_FACTOR
 import time
-from src.user_interface import UserInterface
-from src.utils import get_local_time
+from src.utils import TIME_FORMATTER, get_phase, get_probe_phases, get_shared_probes, TokenBucket, InFlightLimit
+from src.snapshot import Snapshotter, load_snapshot
+from src.anomaly import describe_anomaly
+from src.diagnostics import TIMERS, SamplingProfiler, collect, dump
+from src.windows import DEFAULT_WINDOWS, AVAILABILITY_KEY
+from src.fleet import FleetIndex
+from src.timeline import Timeline
+from src.memory import MemoryBudget
+from src.availability import AvailabilityPolicy
 import os
 import logging
 
 logger = logging.getLogger()
 
+#  The number of site monitors created and started at each iteration of the main loop
+STARTUP_BATCH = 100
+#  The file of the logs folder the events of the websites are saved in, see :class:`timeline.Timeline`
+TIMELINE_FILE = 'timeline.jsonl'
+#  The time in seconds the profiler runs for when toggled from the user interface
+PROFILE_DURATION = 10
+#  The time in seconds between two logs of the memory used by the websites, and the number of websites listed
+MEMORY_LOG_PERIOD = 60
+MEMORY_LOG_SITES = 5
+#  How the response time statistics of the windows are named in the logs
+LOGGED_STATS = {'avg_elapsed': 'average response time', 'max_elapsed': 'maximum response time',
+                'p50': 'median response time', 'p90': '90th percentile of the response time',
+                'p95': '95th percentile of the response time', 'p99': '99th percentile of the response time'}
+
 
 class GlobalMonitor:
     """
     The class that monitors the different websites, formats the metrics and outputs them to screen.
 
     :param list sites: the list of websites to monitor. Each element is of the format **(interval, utl, timeout)**
-    :ivar dict site_monitors: the dict containing the different websites and their :class:`site_monitor.SiteMonitor`
+    :param str logs_path: the folder to write the logs in
+    :param bool adaptive: whether the probe intervals adapt to the websites' behaviour
+    :param float probe_budget: the maximum number of probes per second over all the websites. Unlimited if None
+    :param availability.AvailabilityPolicy availability_policy: when the websites are considered down or recovered
+    :param str snapshot_path: where to save the state of the monitors periodically. If a snapshot already exists
+        there, the monitors start from it
+    :param float snapshot_interval: the time in seconds between two snapshots
+    :param bool seasonal: whether the usual response time of the websites is learned for each hour of the day
+    :param bool columnar: whether the responses are stored in numpy arrays rather than lists of tuples
+    :param int window_workers: the number of processes computing the metrics of the windows.
+        If 0, each monitor computes its own metrics
+    :param list windows: the windows over which the metrics are computed, see :class:`windows.WindowSpec`
+    :param int max_in_flight: the maximum number of requests of a website waiting for their response. Unlimited if None
+    :param int global_in_flight: the maximum number of requests waiting for their response over all the websites.
+        Unlimited if None
+    :param str overload_policy: what to do with the probes beyond these limits, see
+        :data:`site_monitor.OVERLOAD_POLICIES`
+    :param str store_path: a SQLite database to store the responses and the metrics in, see
+        :class:`storage.SQLiteStore`. Nothing is stored if None
+    :param float store_retention: the time in seconds the responses and metrics are kept in the database
+    :param str export_format: the format the responses in memory are exported to, see :data:`export.FORMATS`
+    :param list notify_urls: the webhooks and chat hooks to send the availability transitions to,
+        see :class:`notifier.Notifier`
+    :param float notify_window: the time in seconds the transitions of a website are merged over
+    :param monitor_factory: the callable creating the monitor of each website, :class:`site_monitor.SiteMonitor`
+        by default
+    :param site_chunks: more lists of websites, read one at a time once all the previous websites are started,
+        for instance a :class:`sites.SitesReader` over a large input file. None if **sites** are all the websites
+    :param float memory_budget: the memory in bytes the responses stored by the websites and the histories of the
+        user interface are sized within, see :class:`memory.MemoryBudget`. Unlimited if None
+    :ivar dict site_monitors: the dict containing the different websites and their :class:`site_monitor.SiteMonitor`.
+        The monitors are created and started in batches of **STARTUP_BATCH** once the monitoring starts,
+        so the first requests are sent without waiting for every monitor to be ready.
+        Their metrics updates are spread over time according to their names, see :func:`utils.get_phase`,
+        and so are their probes, see :func:`utils.get_probe_phases`.
+    :ivar dict shared_probes: the website sending the requests of each website making the same probes as another,
+        see :func:`utils.get_shared_probes`. The websites sending requests are started first
+    :ivar dict probe_owners: the website sending the requests of each url and timeout, for the websites added later
     :ivar dict metrics: the latest metrics retrieved for each website, sorted by time
         contains the last 1000 of each retrieved stat
+    :ivar fleet.FleetIndex fleet: ranks the websites, updated whenever their monitor publishes new metrics
+    :ivar timeline.Timeline timeline: the events of the websites shown on the logs page, saved in
+        **{logs_path}/TIMELINE_FILE** so that they survive a restart
+    :ivar memory.MemoryBudget memory_budget: shares the memory budget between the websites, if any
+    :ivar dict diagnostics: the latest diagnostics of the program, see :func:`diagnostics.collect`
+    :ivar diagnostics.SamplingProfiler profiler: the last profiler started from the user interface
     """
 
-    def __init__(self, sites, logs_path="./logfiles"):
+    def __init__(self, sites, logs_path="./logfiles", adaptive=False, probe_budget=None,
+                 availability_policy=None, snapshot_path=None, snapshot_interval=60,
+                 monitor_factory=SiteMonitor, seasonal=False, columnar=False, window_workers=0,
+                 windows=DEFAULT_WINDOWS, max_in_flight=None, global_in_flight=None, overload_policy='skip',
+                 store_path=None, store_retention=None, export_format='npz', notify_urls=None, notify_window=5,
+                 site_chunks=None, memory_budget=None):
         self.site_monitors = {}
         self.metrics = {}
         self.cum_metrics = {}
+        self.fleet = FleetIndex()
         self.set_stop = False
         self.logs_path = logs_path
-        self.sites = sites
+        self.sites = []
+        self.shared_probes = {}
+        self.probe_owners = {}
+        self.probe_phases = {}
+        self.start_order = []
+        self.site_chunks = iter(site_chunks) if site_chunks is not None else None
         self.ui = None
-        for site in sites:
-            self.site_monitors[site] = SiteMonitor(*site)
+        self.memory_budget = None
+        if memory_budget:
+            self.memory_budget = MemoryBudget(memory_budget, columnar, ADAPTIVE_MIN_FACTOR if adaptive else 1,
+                                              windows, (availability_policy or AvailabilityPolicy()).window)
+        self.add_sites(sites)
+        self.bucket = TokenBucket(probe_budget) if probe_budget else None
+        self.monitor_settings = {'adaptive': adaptive, 'bucket': self.bucket,
+                                 'availability_policy': availability_policy, 'seasonal': seasonal,
+                                 'columnar': columnar, 'windows': windows, 'max_in_flight': max_in_flight,
+                                 'in_flight_limit': InFlightLimit(global_in_flight) if global_in_flight else None,
+                                 'overload_policy': overload_policy}
+        self.notifier = None
+        if notify_urls:
+            from src.notifier import Notifier
+            self.notifier = self.monitor_settings['notifier'] = Notifier(notify_urls, notify_window)
+        if window_workers:
+            from src.window_pool import WindowPool
+            self.monitor_settings['window_pool'] = WindowPool(window_workers)
+        self.monitor_factory = monitor_factory
+        self.n_started = 0
         self.writer = Writer(self.site_monitors, logs_path)
+        self.snapshotter = Snapshotter(self, snapshot_path, snapshot_interval) if snapshot_path else None
+        self.export_format = export_format
+        self.store = None
+        if store_path:
+            from src.storage import SQLiteStore
+            self.store = SQLiteStore(self, store_path, retention=store_retention)
+        self.restored_ui = None
+        self.restored_states = {}
+        self.diagnostics = None
+        self.memory_logged = time.time()
+        self.profiler = None
+        if snapshot_path and os.path.isfile(snapshot_path):
+            self.restore(snapshot_path)
         if not os.path.isdir(logs_path):
             os.mkdir(logs_path)
+        self.timeline = Timeline(os.path.join(logs_path, TIMELINE_FILE))
 
     def start(self, screen):
         """
         Start monitoring the websites and show the data on the terminal.
         :param screen: reference to the curses screen
         """
+        from src.user_interface import UserInterface
         logger.info("Main Started created")
+        TIMERS.track_gc()
         t = time.time()
-        self.ui = UserInterface(self.sites, screen)
-        self.writer.start()
-        for monitor in self.site_monitors.values():
-            monitor.start()
+        self.start_monitoring()
+        self.ui = UserInterface(self.sites, screen, self.monitor_settings['windows'], self.fleet,
+                                self.timeline, self.memory_budget and self.memory_budget.history_size)
+        if self.restored_ui:
+            self.ui.restore_state(self.restored_ui)
         try:
             while not self.set_stop:
                 # Stops the execution if one of the children thread has an exception
                 if EXCEPTION_RAISED:
                     self.stop()
                 else:
+                    if not self.all_started:
+                        self.start_batch()
                     metrics = {}
                     if time.time() - t > 1:
                         self.update_metrics()
-                        self.log()
+                        with TIMERS.measure('log'):
+                            self.log()
                         metrics = self.metrics
+                        self.update_diagnostics()
                         t = time.time()
                     # We could the returned value to add more features, like adding/removing sites to monitor at runtime
-                    val = self.ui.update_and_display(metrics)
+                    val = self.ui.update_and_display(metrics, self.diagnostics)
                     if val == 'q':
                         self.stop()
+                    elif val == 'p':
+                        self.toggle_profiler()
+                    elif val == 'd' and self.diagnostics:
+                        dump(self.diagnostics, self.logs_path)
+                    elif val == 'e':
+                        self.export()
                     time.sleep(0.01)
         except Exception as e:
             self.stop()
@@ -69,53 +190,249 @@ class GlobalMonitor:
         """
         Stops the monitoring.
         """
-        self.ui.stop()
+        if self.ui:
+            self.ui.stop()
+        if self.profiler:
+            self.profiler.stop()
         self.writer.stop()
-        for monitor in self.site_monitors.values():
+        if 'window_pool' in self.monitor_settings:
+            self.monitor_settings['window_pool'].stop()
+        if self.snapshotter:
+            self.snapshotter.stop()
+            self.snapshotter.join()
+        if self.store:
+            self.store.stop()
+            self.store.join()
+        if self.notifier:
+            self.notifier.stop()
+            #  The senders are daemon threads, the alerts still held would be lost on exit
+            if self.notifier.is_alive():
+                self.notifier.join(self.notifier.timeout + 1)
+        for monitor in list(self.site_monitors.values()):
             monitor.stop()
         self.set_stop = True
         logger.info("Main Monitorer set to stop")
 
+    def restore(self, path):
+        """
+        Restores the monitors from a snapshot. Websites absent from the snapshot start from scratch.
+
+        :param str path: the snapshot file
+        """
+        t = time.time()
+        self.restored_ui, self.restored_states = load_snapshot(path)
+        logger.info(f"Loaded {len(self.restored_states)} websites from {path} in {time.time() - t:.3f} seconds")
+
+    def start_monitoring(self):
+        """
+        Starts the background threads and the first batch of site monitors, without any user interface.
+        """
+        self.writer.start()
+        if self.snapshotter:
+            self.snapshotter.start()
+        if self.store:
+            self.store.start()
+        if self.notifier:
+            self.notifier.start()
+        if 'window_pool' in self.monitor_settings:
+            self.monitor_settings['window_pool'].start()
+        self.start_batch()
+
+    def add_sites(self, sites):
+        """
+        Adds websites to monitor, started after the websites already added.
+        The probes are only shared with the websites added before when these don't probe less often, since they
+        may already be started, and the websites of a host are only spread over their interval among those added
+        at the same time.
+
+        :param list sites: the websites, as **(name, url, interval, timeout)**
+        """
+        shared = get_shared_probes(sites)
+        for site in sites:
+            if site[0] not in shared:
+                owner = self.probe_owners.get((site[1], site[3]))
+                if owner and owner[2] <= site[2]:
+                    shared[site[0]] = owner
+                else:
+                    self.probe_owners[(site[1], site[3])] = site
+        for name, owner in shared.items():
+            shared[name] = shared.get(owner[0], owner)
+        self.shared_probes.update(shared)
+        self.probe_phases.update(get_probe_phases([site for site in sites if site[0] not in shared]))
+        self.start_order.extend(sorted(sites, key=lambda site: site[0] in shared))
+        self.sites.extend(sites)
+        if self.memory_budget:
+            self.share_memory(sites)
+        if self.ui:
+            self.ui.changed[0] = True
+
+    def share_memory(self, sites):
+        """
+        Shares the memory budget again with the websites added. The websites already started keep fewer responses
+        if their share shrank, and so do the histories of the user interface.
+
+        :param list sites: the websites added
+        """
+        budget = self.memory_budget
+        capacities = budget.add(sites)
+        for site, monitor in list(self.site_monitors.items()):
+            monitor.resize(capacities[site[0]])
+        if self.ui:
+            self.ui.history_size = budget.history_size
+        trimmed = budget.trimmed
+        logger.info(f"Memory budget of {budget.total / 2 ** 20:.1f} MB for {len(capacities)} websites:"
+                    f" {len(trimmed)} keep less than 10 minutes of responses"
+                    f"{' (' + ', '.join(trimmed[:MEMORY_LOG_SITES]) + ')' if trimmed else ''},"
+                    f" {budget.history_size} values are kept in each history")
+        if budget.allocated > budget.total:
+            logger.warning(f"The memory budget is too small: the websites need about"
+                           f" {budget.allocated / 2 ** 20:.1f} MB with the fewest responses")
+
+    @property
+    def all_started(self):
+        """
+        Whether all the websites are monitored, including those of the chunks not read yet.
+        """
+        return self.site_chunks is None and self.n_started == len(self.sites)
+
+    def start_batch(self):
+        """
+        Creates and starts the next **STARTUP_BATCH** site monitors, after reading the next chunk of websites
+        if all those read are started.
+        """
+        if self.n_started == len(self.sites) and self.site_chunks is not None:
+            chunk = next(self.site_chunks, None)
+            if chunk is None:
+                self.site_chunks = None
+            else:
+                self.add_sites(chunk)
+        for site in self.start_order[self.n_started:self.n_started + STARTUP_BATCH]:
+            if site[0] in self.shared_probes:
+                probes = {'scheduler': self.site_monitors[self.shared_probes[site[0]]].request_scheduler}
+            else:
+                probes = {'probe_phase': self.probe_phases[site[0]]}
+            if self.memory_budget:
+                probes['capacity'] = self.memory_budget.capacities[site[0]]
+            monitor = self.monitor_factory(*site, phase=get_phase(site[0]), **probes, **self.monitor_settings)
+            if site[0] in self.restored_states:
+                monitor.restore_state(*self.restored_states.pop(site[0]))
+            self.site_monitors[site] = monitor
+            monitor.start()
+            self.n_started += 1
+        if self.all_started:
+            logger.info(f"All {self.n_started} site monitors started")
+
+    def export(self):
+        """
+        Exports the responses held by the monitors in the background, to a new folder of the logs folder.
+        """
+        from src.export import export_monitors
+        directory = os.path.join(self.logs_path, f"export_{time.strftime('%Y-%m-%d_%H-%M-%S')}")
+
+        def run():
+            #  Nobody waits for the thread, its errors would go unnoticed
+            try:
+                export_monitors(self, directory, self.export_format)
+            except Exception:
+                logger.exception(f"The export of the responses in memory to {directory} failed")
+
+        Thread(target=run, daemon=True).start()
+        logger.info(f"Exporting the responses in memory to {directory}")
+
+    def update_diagnostics(self):
+        """
+        Gathers the diagnostics shown on the diagnostics page.
+        """
+        self.diagnostics = collect(self)
+        profiler = self.profiler
+        self.diagnostics['profiler'] = {'running': bool(profiler and profiler.is_alive()),
+                                        'end': profiler and profiler.end, 'report': profiler and profiler.path}
+        if time.time() - self.memory_logged > MEMORY_LOG_PERIOD:
+            self.memory_logged = time.time()
+            self.log_memory()
+
+    def log_memory(self):
+        """
+        Logs the memory used by the websites, estimated by the latest diagnostics, and the websites using the most.
+        """
+        memory = self.diagnostics['memory']
+        largest = nlargest(MEMORY_LOG_SITES, self.diagnostics['sites'], key=lambda site: site['memory'])
+        sites = ', '.join([f"{site['name']} ({site['memory'] / 2 ** 10:.0f} KB)" for site in largest])
+        budget = f" of a {memory['budget'] / 2 ** 20:.1f} MB budget" if 'budget' in memory else ''
+        logger.info(f"Memory used by the websites: {memory['total'] / 2 ** 20:.1f} MB{budget} (responses"
+                    f" {memory['samples'] / 2 ** 20:.1f} MB, availability {memory['availability'] / 2 ** 20:.1f} MB,"
+                    f" windows {memory['buckets'] / 2 ** 20:.1f} MB, histories {memory['history'] / 2 ** 20:.1f} MB),"
+                    f" the most by {sites}")
+
+    def toggle_profiler(self):
+        """
+        Starts profiling for **PROFILE_DURATION** seconds, or stops the running profiler early.
+        The report is written in the logs folder.
+        """
+        if self.profiler and self.profiler.is_alive():
+            self.profiler.stop()
+        else:
+            self.profiler = SamplingProfiler(self.logs_path, PROFILE_DURATION)
+            self.profiler.start()
+            logger.info(f"Profiling for {PROFILE_DURATION} seconds")
+
+    @property
+    def first_probe(self):
+        """
+        The time the first request was sent by any of the monitors, or None if none has been sent yet.
+        """
+        times = [m.request_scheduler.first_probe for m in list(self.site_monitors.values())
+                 if m.request_scheduler.first_probe]
+        return min(times) if times else None
+
     def update_metrics(self):
         logger.info("Metrics updated")
         # for every site
-        for site, monitor in self.site_monitors.items():
+        for site, monitor in list(self.site_monitors.items()):
             self.metrics[site] = monitor.read_metrics()
+            if self.metrics[site]:
+                self.fleet.update(site[0], monitor.get_health())
+                if self.store:
+                    self.store.add_metrics(site[0], self.metrics[site])
 
     def log(self):
         """
-        Logs the metrics in the appropriate file after formatting it
+        Logs the metrics retrieved by :meth:`update_metrics` in the appropriate file after formatting it
         """
-        for site, monitor in self.site_monitors.items():
-            total_metrics = monitor.read_metrics()
+        for site, total_metrics in self.metrics.items():
             for duration, metric in total_metrics:
                 name, _, interval, _ = site
                 interval = str(interval).replace('.', '')
                 path = os.path.join(self.logs_path, name + '_' + str(interval) + '.txt')
                 with open(path, 'a') as file:
-                    t = get_local_time(metric['time']).strftime('%Y-%m-%d %H:%M:%S')
-                    if duration == 120:
+                    t = TIME_FORMATTER.format(metric['time'])
+                    if duration == 'anomalies':
+                        for anomaly in metric['anomalies']:
+                            at = TIME_FORMATTER.format(anomaly['time'])
+                            file.write(f"[{t}] Latency anomaly at {at}: {describe_anomaly(anomaly)}\n")
+                    elif duration == AVAILABILITY_KEY:
                         file.write(f"[{t}] Website availability is {100 * metric['availability']:10.0f}%\n")
                         if 'unavailable_since' in metric.keys():
-                            rt = get_local_time(metric['unavailable_since']).strftime('%Y-%m-%d %H:%M:%S')
+                            rt = TIME_FORMATTER.format(metric['unavailable_since'])
                             file.write(f"[{t}] Website is unavailable since {rt}\n")
                         elif 'recovered_at' in metric.keys():
-                            rt = get_local_time(metric['recovered_at']).strftime('%Y-%m-%d %H:%M:%S')
+                            rt = TIME_FORMATTER.format(metric['recovered_at'])
                             file.write(f"[{t}] Website recovered at {rt}\n")
                     else:
-                        codes = "{" + " ,".join([f"{k} : {v}" for k, v in metric['codes_count'].items()]) + " }"
-                        if duration == 10:
-                            wait = 60
-                        elif duration == 60:
-                            wait = 600
-                        else:
-                            raise ValueError("Unexpected Error. Duration is either 10, 60 or 120 seconds")
-                        file.write(
-                            f"[{t}] The average response time for the last {wait} seconds is {metric['avg_elapsed']:10.2f}\n")
-                        file.write(
-                            f"[{t}] The maximum response time for the last {wait} seconds is {metric['max_elapsed']:10.2f}\n")
-                        file.write(
-                            f"[{t}] The response codes counts for the last {wait} seconds is {codes}\n")
+                        window = f"the last {metric['duration']} seconds"
+                        for stat, value in metric.items():
+                            if value is None:
+                                #  Every probe of the window was skipped
+                                continue
+                            elif stat == 'codes_count':
+                                codes = "{" + " ,".join([f"{k} : {v}" for k, v in value.items()]) + " }"
+                                file.write(f"[{t}] The response codes counts for {window} is {codes}\n")
+                            elif stat == 'availability':
+                                file.write(f"[{t}] The availability for {window} is {100 * value:10.0f}%\n")
+                            elif stat == 'skipped':
+                                file.write(f"[{t}] The number of skipped probes for {window} is {value}\n")
+                            elif stat in LOGGED_STATS:
+                                file.write(f"[{t}] The {LOGGED_STATS[stat]} for {window} is {value:10.2f}\n")
 
 
 class Writer(Thread):
@@ -139,12 +456,13 @@ class Writer(Thread):
                     self.stop()
                 else:
                     if time.time() - t > 10:
-                        for site, monitor in self.site_monitors.items():
+                        for site, monitor in list(self.site_monitors.items()):
                             responses = monitor.request_scheduler.results.get_slice(t - 10, t)
                             t = time.time()
-                            name = os.path.join(self.logs_path, site[0] + '_raw.txt')
-                            with open(name, 'a') as f:
-                                f.writelines(["%s %s %s\n" % x for x in responses])
+                            if responses:
+                                name = os.path.join(self.logs_path, site[0] + '_raw.txt')
+                                with open(name, 'a') as f:
+                                    f.writelines(["%s %s %s\n" % x for x in responses])
                     time.sleep(1)
         except Exception as e:
             EXCEPTION_RAISED = True
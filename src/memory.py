@@ -0,0 +1,166 @@
+from src.fixed_size import ColumnarQueue
+from src.windows import DEFAULT_WINDOWS, WindowEngine
+
+"""
+This module shares a memory budget between the websites, and estimates how much memory each of them uses.
+
+Each website keeps its latest responses, by default those of the last 10 minutes, which is what costs the most
+when a website is probed very often. Older responses are only kept summarized, in the buckets of the
+:class:`windows.WindowEngine` of its monitor, which the metrics of the windows are computed from. Keeping fewer
+responses thus loses the raw responses, not the metrics.
+The sizes below are estimates of the memory taken by each kind of data, measured on CPython.
+"""
+
+#  The bytes taken by a stored response, as a tuple in a list, or as a row of the arrays of a ColumnarQueue
+SAMPLE_BYTES = {False: 120, True: 18}
+#  The bytes taken by an entry of the window of an AvailabilityTracker
+AVAILABILITY_BYTES = 100
+#  The bytes taken by the summary of a bucket of a WindowEngine, with a few latency buckets in its sketch
+BUCKET_BYTES = 2000
+#  The bytes taken by a value of the histories shown by the user interface, on average
+HISTORY_BYTES = 64
+#  The time in seconds covered by the responses kept by a website without budget
+STORED_DURATION = 600
+#  The fewest responses kept by a website, whatever the budget
+MIN_SAMPLES = 100
+#  The fewest and the most values kept in each history of the user interface
+MIN_HISTORY = 10
+MAX_HISTORY = 1000
+#  The share of the budget given to the histories of the user interface
+HISTORY_SHARE = 0.05
+
+
+class MemoryBudget:
+    """
+    Shares a memory budget between the responses stored by the websites and the histories of the user interface.
+
+    The buckets of the windows are needed by the metrics, so their memory is set aside first. The rest is shared
+    between the responses stored and the entries of the availability windows, see
+    :class:`availability.AvailabilityTracker`: a website storing fewer responses than it receives merges the
+    responses of its availability window in proportion, see :func:`get_resolution`.
+    The budget is shared evenly between the websites: the websites needing less than their share keep all their
+    responses, and leave the rest to the others. The websites probed the most often are thus the ones keeping
+    less than **STORED_DURATION** seconds of responses, and never less than **MIN_SAMPLES** responses.
+    The shares only shrink as websites are added, so the responses of the websites already started are trimmed
+    rather than moved.
+
+    :param float total: the budget in bytes
+    :param bool columnar: whether the responses are stored in numpy arrays
+    :param float min_factor: the shortest interval between two probes of a website, as a fraction of its
+        configured interval, **site_monitor.ADAPTIVE_MIN_FACTOR** when the intervals are adaptive
+    :param list windows: the windows over which the metrics are computed, see :class:`windows.WindowSpec`
+    :param float availability_window: the duration in seconds of the availability windows
+    :ivar int n_buckets: the most buckets kept by the engine of a website
+    :ivar int n_histories: the number of histories of a website in the user interface
+    :ivar dict demands: the number of responses each website keeps without budget, by name
+    :ivar dict capacities: the number of responses each website keeps, by name
+    :ivar int history_size: the number of values kept in each history of the user interface
+    """
+
+    def __init__(self, total, columnar=False, min_factor=1, windows=DEFAULT_WINDOWS, availability_window=120):
+        self.total = total
+        #  Each response stored comes with availability_window / STORED_DURATION entries of the availability window
+        self.sample_bytes = SAMPLE_BYTES[columnar] + AVAILABILITY_BYTES * availability_window / STORED_DURATION
+        self.min_factor = min_factor
+        self.n_buckets = max([spec.duration for spec in windows]) // WindowEngine(windows).resolution + 1
+        #  The availability adds its time, value, and when the website went down or recovered
+        self.n_histories = sum([len(spec.stats) + 2 for spec in windows]) + 4
+        self.demands = {}
+        self.capacities = {}
+        self.history_size = MAX_HISTORY
+
+    @property
+    def trimmed(self):
+        """
+        The names of the websites keeping less responses than without budget.
+
+        :rtype: list
+        """
+        return [name for name, capacity in self.capacities.items() if capacity < self.demands[name]]
+
+    @property
+    def allocated(self):
+        """
+        The bytes the websites are expected to take once their buffers and histories are full.
+        Can exceed the budget when it can't even hold the buckets and the fewest responses of each website.
+
+        :rtype: int
+        """
+        n = len(self.capacities)
+        return (sum(self.capacities.values()) * self.sample_bytes + n * self.n_buckets * BUCKET_BYTES
+                + n * self.n_histories * self.history_size * HISTORY_BYTES)
+
+    def add(self, sites):
+        """
+        Adds websites, and shares the budget again.
+
+        :param list sites: the websites, as **(name, url, interval, timeout)**
+        :return: the number of responses kept by each website, by name, including the websites added before
+        :rtype: dict
+        """
+        for name, _, interval, _ in sites:
+            self.demands[name] = int(STORED_DURATION / (interval * self.min_factor))
+        n = len(self.demands)
+        history = self.total * HISTORY_SHARE
+        self.history_size = int(min(MAX_HISTORY, max(MIN_HISTORY, history / (n * self.n_histories * HISTORY_BYTES))))
+        remaining = max(self.total - history - n * self.n_buckets * BUCKET_BYTES, 0) / self.sample_bytes
+        capacities = {}
+        for i, (name, demand) in enumerate(sorted(self.demands.items(), key=lambda item: item[1])):
+            capacity = min(demand, max(int(remaining / (n - i)), MIN_SAMPLES))
+            capacities[name] = min(capacity, self.capacities.get(name, capacity))
+            remaining = max(remaining - capacities[name], 0)
+        self.capacities = capacities
+        return capacities
+
+
+def get_resolution(capacity, demand):
+    """
+    Returns the resolution of the availability window of a website keeping fewer responses than it receives,
+    see :class:`availability.AvailabilityTracker`.
+
+    :param int capacity: the number of responses kept
+    :param int demand: the number of responses received over **STORED_DURATION**
+    :return: the time in seconds between two entries of the availability window, 0 to keep every response
+    :rtype: float
+    """
+    return STORED_DURATION / capacity if capacity < demand else 0
+
+
+def get_usage(monitor, n_history=0):
+    """
+    Estimates the memory used by a website.
+
+    :param site_monitor.SiteMonitor monitor: the monitor of the website
+    :param int n_history: the number of values of its histories in the user interface
+    :return: the bytes taken by its stored responses, its availability window, the buckets of its windows, its
+        histories, and in total
+    :rtype: dict
+    """
+    results = monitor.request_scheduler.results
+    #  Moves the responses added since the last read to the queue first
+    stored = len(results)
+    if isinstance(results, ColumnarQueue):
+        samples = results.times.nbytes + results.codes.nbytes + results.elapsed.nbytes
+    else:
+        samples = stored * SAMPLE_BYTES[False]
+    availability = len(monitor.tracker.samples) * AVAILABILITY_BYTES
+    buckets = len(monitor.engine.buckets) * BUCKET_BYTES
+    history = n_history * HISTORY_BYTES
+    return {'samples': samples, 'availability': availability, 'buckets': buckets, 'history': history,
+            'total': samples + availability + buckets + history}
+
+
+def count_history(ui):
+    """
+    Counts the values of the histories of each website in the user interface.
+
+    :param user_interface.UserInterface ui: the user interface, if any
+    :return: the number of values, by name
+    :rtype: dict
+    """
+    counts = {}
+    if ui is None:
+        return counts
+    for (site, _), history in list(ui.cum_metrics.items()):
+        counts[site[0]] = counts.get(site[0], 0) + sum([len(values) for values in list(history.values())])
+    return counts
@@ -0,0 +1,242 @@
+from collections import deque
+from threading import Thread
+import json
+import logging
+import time
+from src.utils import InFlightLimit, TIME_FORMATTER
+
+"""
+This module pushes the availability transitions of the websites to webhooks and chat hooks.
+
+The monitors only append the transitions to a bounded queue, and a single thread coalesces them, groups them in
+batches and hands the batches to short-lived sender threads, so a slow or unreachable receiver never delays the
+monitoring.
+"""
+
+logger = logging.getLogger()
+
+#  The prefix of the destinations expecting a chat message, {"text": ...}, rather than the alerts as JSON
+CHAT_PREFIX = 'chat+'
+
+
+class Destination:
+    """
+    A receiver of the alerts.
+
+    :param str url: the url the alerts are posted to. Urls starting with **CHAT_PREFIX** receive a chat message
+    :param int concurrency: the maximum number of batches being sent to this destination at once
+    :param int max_batches: the maximum number of batches waiting to be sent. Beyond it, the oldest one is dropped
+    :ivar bool chat: whether the destination expects a chat message
+    :ivar utils.InFlightLimit limit: the batches being sent
+    :ivar deque batches: the batches waiting to be sent, as **(time to send at, attempt, alerts)**
+    :ivar int n_dropped: the number of batches dropped because too many were waiting
+    """
+
+    def __init__(self, url, concurrency=2, max_batches=100):
+        self.chat = url.startswith(CHAT_PREFIX)
+        self.url = url[len(CHAT_PREFIX):] if self.chat else url
+        self.limit = InFlightLimit(concurrency)
+        self.batches = deque(maxlen=max_batches)
+        self.n_dropped = 0
+
+    def add(self, batch):
+        """
+        Queues a batch. If too many batches are waiting, for instance because the destination is down, the oldest
+        one is dropped to make room.
+
+        :param tuple batch: the batch, as **(time to send at, attempt, alerts)**
+        :return: the alerts of the batch dropped, if any
+        :rtype: list
+        """
+        dropped = []
+        if len(self.batches) == self.batches.maxlen:
+            dropped = self.batches[0][2]
+            self.n_dropped += 1
+            logger.warning(f"Dropped a batch of {len(dropped)} alerts waiting to be sent to {self.url}")
+        self.batches.append(batch)
+        return dropped
+
+    def payload(self, alerts):
+        """
+        Formats a batch of alerts for this destination.
+
+        :param list alerts: the alerts
+        :rtype: dict
+        """
+        alerts = [{k: v for k, v in alert.items() if k != 'queued'} for alert in alerts]
+        if not self.chat:
+            return {'alerts': alerts}
+        return {'text': '\n'.join([describe_alert(alert) for alert in alerts])}
+
+
+def describe_alert(alert):
+    """
+    Describes an alert for humans.
+
+    :param dict alert: the alert
+    :rtype: str
+    """
+    text = f"{alert['site']} ({alert['url']}) is {'down' if alert['state'] == 'down' else 'back up'} since " \
+           f"{TIME_FORMATTER.format(alert['time'])}"
+    if alert['transitions'] > 1:
+        text += f", after changing {alert['transitions']} times in {alert['time'] - alert['since']:.0f} seconds"
+    return text
+
+
+class Notifier(Thread):
+    """
+    Sends the availability transitions of the websites to the destinations.
+
+    The transitions of a website are held for **window** seconds after the first one, and the transitions of a
+    flapping website are merged into a single alert carrying its latest state and the number of transitions.
+    The alerts ready at the same time are sent in a single batch to each destination, with at most **concurrency**
+    batches being sent to a destination at once. A failed batch is sent again after **backoff** seconds, doubled
+    at every attempt, up to **retries** times.
+
+    :param list destinations: the urls to post the alerts to, see :class:`Destination`
+    :param float window: the time in seconds the transitions of a website are merged over
+    :param int capacity: the maximum number of transitions waiting to be processed. Beyond it, they are dropped
+    :param int concurrency: the maximum number of batches being sent to each destination at once
+    :param int max_batches: the maximum number of batches waiting to be sent to each destination
+    :param int retries: the maximum number of times a batch is sent again
+    :param float backoff: the time in seconds before the first retry
+    :param float timeout: the time in seconds to wait for a destination to answer
+    :ivar deque events: the transitions not processed yet, in order of arrival
+    :ivar dict pending: the alert being merged for each website, by name
+    :ivar deque done: the batches sent, as **(destination, attempt, alerts, success)**, to be accounted for
+    :ivar int n_sent: the number of alerts delivered, counted once per destination
+    :ivar int n_dropped: the number of alerts lost, because the queue was full or after the last retry
+    :ivar int n_retried: the number of batches sent again
+    :ivar deque latencies: the time between the transition and its delivery of the latest alerts delivered
+    :ivar list senders: the threads sending a batch, to wait for when the notifier stops
+    """
+
+    def __init__(self, destinations, window=5, capacity=10000, concurrency=2, max_batches=100, retries=3, backoff=1,
+                 timeout=5):
+        super().__init__(daemon=True)
+        self.destinations = [Destination(url, concurrency, max_batches) for url in destinations]
+        self.window = window
+        self.capacity = capacity
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.events = deque()
+        self.pending = {}
+        self.done = deque()
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_retried = 0
+        self.latencies = deque(maxlen=1000)
+        self.senders = []
+        self.set_stop = False
+
+    def notify(self, site, url, state, t, availability=None):
+        """
+        Queues a transition. Never blocks: if the queue is full, the transition is dropped.
+
+        :param str site: the name of the website
+        :param str url: its url
+        :param str state: **'down'** or **'up'**
+        :param float t: the time of the transition
+        :param float availability: the availability of the website
+        """
+        if len(self.events) >= self.capacity:
+            self.n_dropped += 1
+            return
+        self.events.append({'site': site, 'url': url, 'state': state, 'time': t, 'since': t, 'transitions': 1,
+                            'availability': availability, 'queued': time.time()})
+
+    def run(self):
+        while not self.set_stop:
+            self.process()
+            time.sleep(0.05)
+        #  The alerts still held are sent once, without waiting for their window, and have the time to be delivered
+        self.process(flush=True)
+        for sender in self.senders:
+            sender.join(self.timeout)
+
+    def process(self, flush=False):
+        """
+        Merges the new transitions, batches the alerts whose window is over and starts sending the batches due.
+
+        :param bool flush: whether to send all the alerts held, even if their window isn't over
+        """
+        while self.events:
+            event = self.events.popleft()
+            alert = self.pending.get(event['site'])
+            if alert is None:
+                self.pending[event['site']] = event
+            else:
+                alert.update({'state': event['state'], 'time': event['time'], 'availability': event['availability'],
+                              'transitions': alert['transitions'] + 1})
+        now = time.time()
+        ready = [site for site, alert in self.pending.items() if flush or now - alert['queued'] > self.window]
+        if ready:
+            alerts = [self.pending.pop(site) for site in ready]
+            for destination in self.destinations:
+                self.n_dropped += len(destination.add((now, 0, alerts)))
+        while self.done:
+            self.account(*self.done.popleft())
+        self.senders = [sender for sender in self.senders if sender.is_alive()]
+        for destination in self.destinations:
+            for _ in range(len(destination.batches)):
+                batch = destination.batches.popleft()
+                if batch[0] <= now and destination.limit.acquire():
+                    self.senders.append(Thread(target=self.send, args=(destination, *batch[1:]), daemon=True))
+                    self.senders[-1].start()
+                else:
+                    destination.batches.append(batch)
+
+    def send(self, destination, attempt, alerts):
+        """
+        Posts a batch of alerts to a destination. Runs in its own thread.
+
+        :param Destination destination: the destination
+        :param int attempt: the number of times the batch has already been sent
+        :param list alerts: the alerts
+        """
+        import requests
+        try:
+            response = requests.post(destination.url, data=json.dumps(destination.payload(alerts)),
+                                     headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+            success = response.status_code < 300
+        except requests.exceptions.RequestException:
+            success = False
+        destination.limit.release()
+        self.done.append((destination, attempt, alerts, success))
+
+    def account(self, destination, attempt, alerts, success):
+        """
+        Records the result of a batch, and schedules it again if it failed and can be retried.
+        """
+        now = time.time()
+        if success:
+            self.n_sent += len(alerts)
+            self.latencies.extend([now - alert['queued'] for alert in alerts])
+        elif attempt < self.retries:
+            self.n_retried += 1
+            self.n_dropped += len(destination.add((now + self.backoff * 2 ** attempt, attempt + 1, alerts)))
+        else:
+            self.n_dropped += len(alerts)
+            logger.warning(f"Dropped {len(alerts)} alerts after failing to send them {attempt + 1} times "
+                           f"to {destination.url}")
+
+    def read(self):
+        """
+        Returns the delivery counters.
+
+        :return: the number of alerts sent, dropped and waiting for their window, the number of retries, of
+            batches waiting to be sent and of batches dropped because too many were waiting, and the average and
+            maximum delivery latency of the latest alerts, None if none was delivered
+        :rtype: dict
+        """
+        latencies = list(self.latencies)
+        return {'sent': self.n_sent, 'dropped': self.n_dropped, 'retried': self.n_retried,
+                'waiting': len(self.events) + len(self.pending),
+                'batches': sum([len(destination.batches) for destination in self.destinations]),
+                'dropped_batches': sum([destination.n_dropped for destination in self.destinations]),
+                'avg_latency': sum(latencies) / len(latencies) if latencies else None,
+                'max_latency': max(latencies) if latencies else None}
+
+    def stop(self):
+        self.set_stop = True
@@ -0,0 +1,280 @@
+from bisect import bisect_right
+from collections import deque
+from heapq import heappush, heappop
+from itertools import accumulate
+from operator import itemgetter
+import json
+import math
+import random
+import time
+from src.fixed_size import FixedSizeQueue, ColumnarQueue
+from src.memory import STORED_DURATION
+from src.site_monitor import SiteMonitor
+from src.utils import get_phase, get_probe_phases
+from src.windows import DEFAULT_WINDOWS
+
+"""
+This module simulates websites over a virtual time, so that the monitoring can be tested and benchmarked without
+a server, sockets or waiting: a :class:`Simulation` runs the real :class:`site_monitor.SiteMonitor` of each
+website in a single thread, and the probes are answered in-process by a seeded :class:`Target`.
+
+The same seed and script always give the same responses, and so the same metrics.
+A scenario can be written as a JSON list of websites, see :func:`load_scenario`::
+
+    [{"name": "shop", "interval": 1, "timeout": 2, "seed": 1,
+      "latency": {"distribution": "lognormal", "median": 0.1, "sigma": 0.5},
+      "codes": {"200": 98, "500": 2},
+      "outages": [{"start": 600, "end": 900, "code": 503, "probability": 0.9}]}]
+"""
+
+#  The parameters of each latency distribution, in seconds
+LATENCY_DISTRIBUTIONS = {'constant': ('value',), 'uniform': ('low', 'high'), 'exponential': ('mean',),
+                         'lognormal': ('median', 'sigma')}
+#  The virtual time a simulation starts at
+START = 1.7e9
+#  The scheme of the urls of the simulated websites
+URL_SCHEME = 'sim://'
+
+
+class Target:
+    """
+    A simulated website, answering each probe with a status code drawn from **codes** and a response time drawn
+    from **latency**, except during its outages.
+
+    :param int seed: the seed of the random draws
+    :param dict latency: the distribution of the response times, with its parameters, see
+        **LATENCY_DISTRIBUTIONS**: **{'distribution': 'uniform', 'low': 0.05, 'high': 0.2}**
+    :param dict codes: the weight of each status code, **{200: 99, 500: 1}**. Always 200 if None
+    :param list outages: the outages, each a dict with its **start** and **end**, in seconds since the start of
+        the simulation, its status **code** (503 by default, 408 for timeouts) and the **probability** that a
+        probe fails during the outage (1 by default)
+    """
+
+    def __init__(self, seed=0, latency=None, codes=None, outages=()):
+        self.random = random.Random(seed)
+        latency = dict(latency or {'distribution': 'constant', 'value': 0.1})
+        distribution = latency.pop('distribution', None)
+        if distribution not in LATENCY_DISTRIBUTIONS or set(latency) != set(LATENCY_DISTRIBUTIONS[distribution]):
+            choices = ', '.join([f"{k} ({' '.join(v)})" for k, v in LATENCY_DISTRIBUTIONS.items()])
+            raise ValueError(f"Unknown latency {distribution} {latency}. Choose among {choices}")
+        self.latency = self.get_latency(distribution, latency)
+        codes = codes or {200: 1}
+        self.codes = [int(code) for code in codes]
+        self.weights = list(accumulate(codes.values()))
+        self.outages = sorted([(outage['start'], outage['end'], outage.get('code', 503),
+                                outage.get('probability', 1)) for outage in outages])
+
+    def get_latency(self, distribution, parameters):
+        """
+        Returns the function drawing a response time.
+
+        :param str distribution: one of **LATENCY_DISTRIBUTIONS**
+        :param dict parameters: its parameters
+        :rtype: function
+        """
+        draw = self.random
+        if distribution == 'constant':
+            return lambda: parameters['value']
+        if distribution == 'uniform':
+            return lambda: draw.uniform(parameters['low'], parameters['high'])
+        if distribution == 'exponential':
+            return lambda: draw.expovariate(1 / parameters['mean'])
+        mu = math.log(parameters['median'])
+        return lambda: draw.lognormvariate(mu, parameters['sigma'])
+
+    def respond(self, t, timeout):
+        """
+        Answers a probe.
+
+        :param float t: the time the probe is sent, in seconds since the start of the simulation
+        :param float timeout: the time after which the probe times out
+        :return: the status code and the response time. A response slower than **timeout** is a timeout, 408
+        :rtype: tuple
+        """
+        code = None
+        for start, end, outage_code, probability in self.outages:
+            if start > t:
+                break
+            if t < end and (probability >= 1 or self.random.random() < probability):
+                code = outage_code
+                break
+        if code is None:
+            code = self.codes[bisect_right(self.weights, self.random.random() * self.weights[-1])]
+        elapsed = self.latency()
+        if code == 408 or elapsed > timeout:
+            return 408, timeout
+        return code, elapsed
+
+
+class VirtualClock:
+    """
+    The time of a simulation, moved forward by the simulation rather than by the wall clock.
+    Called like **time.time**.
+
+    :param float start: the unix time the simulation starts at
+    :ivar float now: the current time
+    """
+
+    def __init__(self, start=START):
+        self.start = start
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedProbes:
+    """
+    Probes a :class:`Target` in-process, once per **interval** of virtual time. The responses are stored once
+    their response time has elapsed, as the requests of a :class:`site_monitor.RequestScheduler` would.
+    Offers the attributes of a :class:`site_monitor.RequestScheduler` read by the
+    :class:`site_monitor.SiteMonitor`, and can be shared through :class:`site_monitor.ProbeFeed`.
+
+    :param Target target: the simulated website
+    :param str url: the url of the website
+    :param float interval: the interval between two probes
+    :param float timeout: the time after which a probe times out
+    :param VirtualClock clock: the time of the simulation
+    :param bool columnar: whether to store the responses in numpy arrays, see :class:`fixed_size.ColumnarQueue`
+    :param float phase: when to send the first probe, as a fraction of the interval. If 0, after one interval
+    :ivar float next_probe: the time of the next probe
+    :ivar list pending: the probes waiting for their response, as a heap of **(arrival, time, code, elapsed)**
+    :ivar int n_sent: the number of probes sent
+    """
+
+    def __init__(self, target, url, interval, timeout, clock, columnar=False, phase=0):
+        self.target = target
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        self.adaptive = False
+        queue = ColumnarQueue if columnar else FixedSizeQueue
+        self.results = queue(int(STORED_DURATION / interval), key=itemgetter(0))
+        self.new_results = deque(maxlen=self.results.capacity)
+        self.next_probe = clock() + (phase or 1) * interval
+        self.pending = []
+        self.first_probe = None
+        self.n_sent = 0
+        self.n_skipped = 0
+        self.feeds = []
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    def advance(self):
+        """
+        Sends the probes due and stores the responses arrived, up to the current time of the clock.
+        """
+        now = self.clock.now
+        start = self.clock.start
+        while self.next_probe <= now:
+            t = self.next_probe
+            code, elapsed = self.target.respond(t - start, self.timeout)
+            heappush(self.pending, (t + elapsed, t, code, elapsed))
+            if self.first_probe is None:
+                self.first_probe = t
+            self.n_sent += 1
+            self.next_probe += self.interval
+        while self.pending and self.pending[0][0] <= now:
+            _, t, code, elapsed = heappop(self.pending)
+            self.store((t, code, elapsed))
+
+    def store(self, e):
+        """
+        Stores a response, see :meth:`site_monitor.RequestScheduler.store`.
+        """
+        self.results.add(e)
+        self.new_results.append(e)
+        for feed in self.feeds:
+            feed.store(e)
+
+    def start(self):
+        """
+        Nothing to do, the probes are sent by :meth:`advance`.
+        """
+
+    def stop(self):
+        """
+        Nothing to do, the probes stop with the simulation.
+        """
+
+
+class Simulation:
+    """
+    Monitors simulated websites over a virtual time, in a single thread. At every **step** of virtual time,
+    the probes due are sent, the responses arrived are stored, and each :class:`site_monitor.SiteMonitor`
+    consumes them and computes the metrics due, as its thread would.
+
+    :param list sites: the websites, as **(name, url, interval, timeout)**
+    :param dict targets: the :class:`Target` of each website, by name. A website without a target always answers
+        200 in 100 ms
+    :param float step: the virtual time in seconds between two steps
+    :param float start: the unix time the simulation starts at
+    :param bool columnar: whether the responses are stored in numpy arrays
+    :param list windows: the windows over which the metrics are computed, see :class:`windows.WindowSpec`
+    :param settings: the other settings of the monitors, see :class:`site_monitor.SiteMonitor`
+    :ivar VirtualClock clock: the time of the simulation
+    :ivar int n_steps: the number of steps simulated. The time is computed from it, so that it doesn't drift
+    :ivar dict monitors: the monitor of each website, by name
+    """
+
+    def __init__(self, sites, targets, step=0.1, start=START, columnar=False, windows=DEFAULT_WINDOWS, **settings):
+        self.step = step
+        self.clock = VirtualClock(start)
+        self.n_steps = 0
+        self.monitors = {}
+        phases = get_probe_phases(sites)
+        for name, url, interval, timeout in sites:
+            probes = SimulatedProbes(targets.get(name) or Target(), url, interval, timeout, self.clock, columnar,
+                                     phases[name])
+            self.monitors[name] = SiteMonitor(name, url, interval, timeout, columnar=columnar, windows=windows,
+                                              phase=get_phase(name), clock=self.clock, request_scheduler=probes,
+                                              **settings)
+
+    @property
+    def n_probes(self):
+        """
+        The number of probes sent so far.
+        """
+        return sum([monitor.request_scheduler.n_sent for monitor in self.monitors.values()])
+
+    def run(self, duration):
+        """
+        Moves the virtual time forward.
+
+        :param float duration: the virtual time in seconds to simulate
+        :return: the number of probes sent, and the wall clock time in seconds it took
+        :rtype: tuple
+        """
+        t = time.time()
+        n = self.n_probes
+        end = self.clock.now + duration
+        monitors = list(self.monitors.values())
+        while self.clock.now < end:
+            self.n_steps += 1
+            self.clock.now = min(self.clock.start + self.n_steps * self.step, end)
+            for monitor in monitors:
+                monitor.request_scheduler.advance()
+                monitor.step()
+        return self.n_probes - n, time.time() - t
+
+
+def load_scenario(path):
+    """
+    Reads the simulated websites of a scenario file, a JSON list of websites with their **name**, **interval**,
+    **timeout** and the arguments of their :class:`Target`.
+
+    :param str path: the scenario file
+    :return: the websites, as **(name, url, interval, timeout)**, and their targets by name
+    :rtype: tuple
+    """
+    with open(path) as file:
+        scenario = json.load(file)
+    sites, targets = [], {}
+    for website in scenario:
+        name = website.pop('name')
+        sites.append((name, URL_SCHEME + name, website.pop('interval', 1), website.pop('timeout', 5)))
+        targets[name] = Target(**website)
+    return sites, targets
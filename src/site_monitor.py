@@ -1,13 +1,31 @@
 from operator import itemgetter
-from threading import Thread, Semaphore
-from src.utils import Requester
+from threading import Thread, Semaphore, Lock
+from src.utils import get_requester, SKIPPED
+from src.availability import AvailabilityTracker
+from src.anomaly import LatencyDetector
+from src.snapshot import encode_metric, decode_metric
+from src.diagnostics import TIMERS, PROBE_ACTIVITY
+from src.windows import WindowEngine, DEFAULT_WINDOWS, AVAILABILITY_KEY
+import math
 import time
-from collections import Counter
+from collections import Counter, deque
 import logging
-from src.fixed_size import FixedSizeQueue
+from src.fixed_size import FixedSizeQueue, ColumnarQueue
+from src.memory import STORED_DURATION, get_resolution
 
 EXCEPTION_RAISED = False
 
+#  Settings of the adaptive mode. The interval moves between MIN_FACTOR and MAX_FACTOR times the configured one
+ADAPTIVE_MIN_FACTOR = 0.5
+ADAPTIVE_MAX_FACTOR = 8
+ADAPTIVE_STRETCH = 1.25
+#  A response is a latency excursion when it is this many times slower than the average response time
+LATENCY_EXCURSION = 3
+#  After this many excursions in a row, the response time has changed for good: their average becomes the new one
+REBASELINE_EXCURSIONS = 10
+#  What to do with a probe when too many requests are in flight: skip it, or record it as a timeout without sending it
+OVERLOAD_POLICIES = ('skip', 'timeout')
+
 logger = logging.getLogger()
 
 
@@ -17,33 +35,85 @@ class SiteMonitor(Thread):
     The methods have been implemented here instead of in :class:`request_scheduler.RequestScheduler` to
     avoid delaying the requests made periodically.
 
-    :ivar request_scheduler request_scheduler: the scheduler making requests once per interval.
+    :ivar request_scheduler request_scheduler: the scheduler making requests once per interval, shifted by
+        **probe_phase**, a fraction of the interval. When given the **scheduler** of another website probing
+        the same url, the monitor reads its responses through a :class:`ProbeFeed` instead of sending requests.
+        Another object offering the same attributes can be given instead, for instance a
+        :class:`simulator.SimulatedProbes`
+    :ivar clock: the function returning the current unix time, **time.time** unless the time is simulated,
+        see :class:`simulator.VirtualClock`
     :ivar str name: the website's name
-    :ivar float availability: the availability of the website during the last two minutes.
-    :ivar Union[float,None] unavailable_since: the unix time of the first time the url became unavailable.
-        Is None if the site is available.
-    :ivar Union[float,None] recovered_at: the unix time since the website recovered.
-        Is None if the website is currently unavailable or the availability never went below 80%
-    :ivar dict last_updates: holds the time of the last updates to the metrics
+    :ivar availability.AvailabilityTracker tracker: follows the availability with every new response,
+        according to **availability_policy**
+    :ivar anomaly.LatencyDetector detector: flags unusual response times as the responses come in
+    :ivar list anomalies: the anomalies detected since the last time they were read
+    :ivar Union[float,None] unavailable_since: the unix time of the request that made the availability
+        cross the threshold. Is None if the site is available.
+    :ivar Union[float,None] recovered_at: the unix time of the request that brought the availability back.
+        Is None if the website is currently unavailable or the availability never went below the threshold
+    :ivar notifier.Notifier notifier: sends the transitions to the webhooks, if any
+    :ivar dict windows: the windows over which the metrics are computed, by key
+    :ivar windows.WindowEngine engine: computes the metrics of all the windows as the responses come in
+    :ivar window_pool.WindowPool window_pool: the pool computing the metrics in other processes, if any.
+        The pool computes them from the stored responses instead of the engine, for the windows they cover
+    :ivar float min_interval: the shortest interval between two responses stored. The responses stored cover at
+        least **capacity** times this interval, where the **capacity** of the queue is limited by the memory
+        budget, if any, see :class:`memory.MemoryBudget`
+    :ivar set pending_windows: the windows sent to the pool whose metrics haven't been published yet
+    :ivar health_key: the key of the shortest window, whose 99th percentile and server errors are reported
+        by :meth:`get_health`
+    :ivar dict last_updates: holds the time of the last updates to the metrics. The first updates are shifted
+        by **phase**, a fraction of their period
     :ivar dict is_read: a dict with booleans representing whether the latest metric
         on each time-frame has been retrieved or not.
     :ivar bool set_stop: whether the monitor has been set to stop.
     :ivar Semaphore metric_sem: a semaphore to protect read and write
+    :ivar Lock engine_lock: protects the engine while its state is copied to a snapshot. A lock rather than a
+        semaphore, since it is taken at every step
     """
 
-    def __init__(self, name, url, interval, timeout):
+    def __init__(self, name, url, interval, timeout, adaptive=False, bucket=None, availability_policy=None,
+                 seasonal=False, columnar=False, window_pool=None, phase=0, windows=DEFAULT_WINDOWS,
+                 max_in_flight=None, in_flight_limit=None, overload_policy='skip', probe_phase=0, scheduler=None,
+                 notifier=None, clock=time.time, request_scheduler=None, capacity=None):
         super(SiteMonitor, self).__init__()
-        self.request_scheduler = RequestScheduler(interval, url, timeout)
+        self.clock = clock
+        if request_scheduler:
+            self.request_scheduler = request_scheduler
+        elif scheduler:
+            self.request_scheduler = ProbeFeed(scheduler, interval, columnar, capacity)
+        else:
+            self.request_scheduler = RequestScheduler(interval, url, timeout, adaptive, bucket, columnar,
+                                                      max_in_flight, in_flight_limit, overload_policy, probe_phase,
+                                                      capacity)
+        self.min_interval = interval * ADAPTIVE_MIN_FACTOR if adaptive and not scheduler else interval
+        stored = self.request_scheduler.results.capacity
+        self.tracker = AvailabilityTracker(availability_policy, get_resolution(stored, self.demand))
+        self.restored_columns = None
+        self.restored_engine = None
+        self.detector = LatencyDetector(seasonal=seasonal)
+        self.anomalies = []
         self.name = name
         self.timeout = timeout
         self.unavailable_since = None
         self.recovered_at = None
-        t = time.time()
-        self.last_updates = {10: t, 60: t, 120: t}
+        self.notifier = notifier
+        self.window_pool = window_pool
+        self.pending_windows = set()
+        t = clock()
+        self.windows = {spec.key: spec for spec in windows}
+        #  The buckets end when the windows do, see :meth:`get_window`
+        self.engine = WindowEngine(windows, t - timeout)
+        self.health_key = min(windows, key=lambda spec: spec.duration).key
+        self.window_health = {'p99': None, 'errors': None}
+        periods = {**{key: spec.period for key, spec in self.windows.items()}, AVAILABILITY_KEY: 120}
+        #  Shifts the updates by a fraction of their period, so that the websites don't all update at once
+        self.last_updates = {key: t - phase * period for key, period in periods.items()}
         self.metrics = {}
-        self.is_read = {10: True, 60: True, 120: True}
+        self.is_read = {key: True for key in periods}
         self.set_stop = False
         self.metrics_sem = Semaphore()
+        self.engine_lock = Lock()
 
     def stop(self):
         """
@@ -55,80 +125,265 @@ class SiteMonitor(Thread):
 
     def run(self):
         """
-        Starts monitoring the website. Each 10 seconds, calculate the metrics over the last 10 minutes,
-            each minute calculate the metrics over the last hour, and update the availability every two minutes.
+        Starts monitoring the website. Calculates the metrics of each window once per period (by default,
+            over the last 10 minutes every 10 seconds and over the last hour every minute),
+            and reports the availability every two minutes.
+            The availability itself is followed with every response, and transitions are reported right away.
         """
         logger.info(f"Started monitoring {self.name}")
         global EXCEPTION_RAISED
-        self.request_scheduler.start()
+        self.start_probing()
         try:
             while not self.set_stop:
                 # Stops the execution if an other thread has an exception
                 if EXCEPTION_RAISED:
                     self.stop()
                 else:
-                    t = time.time()
-                    if t - self.last_updates[10] > 10:
-                        self.update_metrics(10, 600)
-                    if t - self.last_updates[60] > 60:
-                        self.update_metrics(60, 3600)
-                    if t - self.last_updates[120] > 120:
-                        self.update_availability()
+                    self.step()
                     time.sleep(0.01)
         except Exception as e:
             EXCEPTION_RAISED = True
             self.stop()
             raise e
 
-    def update_metrics(self, delay, duration):
+    def step(self):
+        """
+        Consumes the new responses, and updates the metrics of the windows and the availability that are due.
+        Called in a loop by :meth:`run`, or by a :class:`simulator.Simulation` at every step of the virtual time.
+        """
+        #  Released even if the step fails, the snapshots would wait for it otherwise
+        self.engine_lock.acquire()
+        try:
+            self.consume_responses()
+            t = self.clock()
+            for key, spec in self.windows.items():
+                if t - self.last_updates[key] > spec.period:
+                    self.update_metrics(key)
+        finally:
+            self.engine_lock.release()
+        if t - self.last_updates[AVAILABILITY_KEY] > 120:
+            self.update_availability()
+
+    def update_metrics(self, key):
+        """
+        Computes the metrics of a window and stores them.
+
+        :param key: the key of the window
+        """
+        spec = self.windows[key]
+        logger.info(f"Updated metrics for {self.name} with delay = {spec.period} and duration = {spec.duration}")
+        if self.window_pool and self.covers(spec.duration):
+            if key not in self.pending_windows:
+                self.pending_windows.add(key)
+                self.window_pool.submit(self, key)
+            return
+        with TIMERS.measure('get_metrics'):
+            stats = self.engine.evaluate(key, self.get_window(self.last_updates[key], spec.duration, spec.period)[1])
+        self.publish_metrics(key, stats)
+
+    def covers(self, duration):
+        """
+        Tells whether the responses stored cover a window. Otherwise, its older responses are only found in the
+        buckets of the engine.
+
+        :param float duration: the duration of the window in seconds
+        :rtype: bool
+        """
+        return (self.request_scheduler.results.capacity + 1) * self.min_interval >= duration
+
+    def resize(self, capacity):
+        """
+        Stores fewer responses, dropping the oldest ones. The metrics of the windows no longer covered by the
+        responses stored are computed from the buckets of the engine, and the responses of the availability window
+        are merged into as many entries, see :func:`memory.get_resolution`.
+
+        :param int capacity: the number of responses to keep
+        """
+        results = self.request_scheduler.results
+        if capacity < results.capacity:
+            results.resize(capacity)
+            logger.info(f"The responses stored for {self.name} are limited to {capacity}")
+        self.tracker.resolution = get_resolution(results.capacity, self.demand)
+
+    @property
+    def demand(self):
+        """
+        The number of responses stored without memory budget, those of the last **memory.STORED_DURATION** seconds.
+
+        :rtype: int
+        """
+        return int(STORED_DURATION / self.min_interval)
+
+    def publish_metrics(self, key, stats):
         """
-        Retrieves the metrics and stores them.
+        Stores the statistics of a window chosen in its spec, unless it had no responses.
+        Either way, the window is computed again one period later.
+
+        :param key: the key of the window
+        :param dict stats: the statistics of the window, with at least its average and maximum response times,
+            None when every probe was skipped
+        """
+        self.pending_windows.discard(key)
+        spec = self.windows[key]
+        self.metrics_sem.acquire()
+        self.last_updates[key] = self.clock()
+        if stats:
+            self.metrics[key] = {'time': self.clock(), 'duration': spec.duration,
+                                 **{stat: stats[stat] for stat in spec.stats if stat in stats}}
+            self.is_read[key] = False
+            if key == self.health_key:
+                self.window_health = {'p99': stats.get('p99'),
+                                      'errors': sum([v for k, v in stats['codes_count'].items() if 500 <= k < 600])}
+        self.metrics_sem.release()
+        if stats and stats['avg_elapsed'] is not None:
+            self.add_anomaly(self.detector.check_window(self.clock(), stats['avg_elapsed'], stats['max_elapsed'],
+                                                        spec.duration))
+
+    def start_probing(self):
+        """
+        Puts back the restored responses, if any, and starts sending requests.
+        """
+        self.restore_responses()
+        self.request_scheduler.start()
 
-        :param delay: the interval between each two metric updates.
-        :param duration: the time window over which to calculate the metrics.
+    def consume_responses(self):
         """
-        logger.info(f"Updated metrics for {self.name} with delay = {delay} and duration = {duration} for {self.name}")
-        metrics = self.get_metrics(self.last_updates[delay], duration, delay)
-        if metrics:
-            _, codes_count, max_elapsed, avg_elapsed = metrics
+        Feeds the responses received since the last call to the availability tracker,
+        and publishes the availability as soon as the website goes down or recovers.
+        """
+        new_results = self.request_scheduler.new_results
+        while new_results:
+            t, code, elapsed = new_results.popleft()
+            self.engine.add(t, code, elapsed)
+            transition = self.tracker.add(t, code)
+            if transition:
+                self.set_transition(transition, t)
+            #  Failed requests are accounted for in the availability, only the served ones are checked for latency
+            if SKIPPED < code < 400:
+                self.add_anomaly(self.detector.update(t, elapsed))
+
+    def add_anomaly(self, anomaly):
+        """
+        Stores an anomaly until it is read.
+
+        :param dict anomaly: the anomaly, or None
+        """
+        if anomaly:
             self.metrics_sem.acquire()
-            self.last_updates[delay] = time.time()
-            self.metrics[delay] = {'time': time.time(), 'codes_count': codes_count, 'max_elapsed': max_elapsed,
-                                   'avg_elapsed': avg_elapsed}
-            self.is_read[delay] = False
+            self.anomalies.append(anomaly)
             self.metrics_sem.release()
+            logger.info(f"Latency anomaly for {self.name}: {anomaly}")
+
+    def set_transition(self, transition, t):
+        """
+        Records that the website went down or recovered, and publishes the availability right away.
+
+        :param str transition: either **'unavailable_since'** or **'recovered_at'**
+        :param float t: the time of the transition
+        """
+        self.metrics_sem.acquire()
+        if transition == 'unavailable_since':
+            self.unavailable_since = t
+            self.recovered_at = None
+        else:
+            self.unavailable_since = None
+            self.recovered_at = t
+        self.metrics_sem.release()
+        logger.info(f"Availability of {self.name} crossed the threshold ({transition})")
+        if self.notifier:
+            self.notifier.notify(self.name, self.request_scheduler.url,
+                                 'down' if transition == 'unavailable_since' else 'up', t, self.tracker.availability)
+        self.update_availability()
 
     def update_availability(self):
         """
-        calculates the availability and stores it.
+        Stores the current availability, along with the time the website went down or recovered.
         """
         logger.info(f"Updated availability for {self.name}")
-        metrics = self.get_metrics(self.last_updates[120], 120, 120)
-        if metrics:
-            availability, _, _, _ = metrics
+        availability = self.tracker.availability
+        if availability is not None:
             self.metrics_sem.acquire()
-            self.is_read[120] = False
-            t = time.time()
-            #  If it is available but was unavailable during the previous check
-            if availability >= 0.8 and self.unavailable_since:
-                self.unavailable_since = None
-                self.recovered_at = t - 120
-            elif availability < 0.8:
-                #  If it has recovered during the previous check
-                if self.recovered_at:
-                    self.unavailable_since = t - 120
-                    self.recovered_at = None
-                #  If this is the first time it goes down
-                elif not self.unavailable_since:
-                    self.unavailable_since = t - 120
-            self.last_updates[120] = t
-            self.metrics[120] = {'time': t, 'availability': availability}
+            self.is_read[AVAILABILITY_KEY] = False
+            t = self.clock()
+            self.last_updates[AVAILABILITY_KEY] = t
+            metric = self.metrics[AVAILABILITY_KEY] = {'time': t, 'availability': availability}
             if self.unavailable_since:
-                self.metrics[120]['unavailable_since'] = self.unavailable_since
+                metric['unavailable_since'] = self.unavailable_since
             if self.recovered_at:
-                self.metrics[120]['recovered_at'] = self.recovered_at
+                metric['recovered_at'] = self.recovered_at
             self.metrics_sem.release()
 
+    def get_state(self):
+        """
+        Copies the state of the monitor, to be saved in a snapshot.
+
+        :return: a JSON serializable dict holding the metrics, availability and windows state, the stored responses,
+            and the encoded summaries of the windows, see :meth:`windows.WindowEngine.get_state`
+        :rtype: tuple
+        """
+        responses = self.request_scheduler.results.get_slice(float('-inf'), float('inf'))
+        self.engine_lock.acquire()
+        engine, summaries = self.engine.get_state()
+        self.engine_lock.release()
+        self.metrics_sem.acquire()
+        state = {'metrics': [[k, encode_metric(v)] for k, v in self.metrics.items()],
+                 'last_updates': list(self.last_updates.items()),
+                 'unavailable_since': self.unavailable_since, 'recovered_at': self.recovered_at,
+                 'available': self.tracker.available, 'interval': self.request_scheduler.interval,
+                 'engine': engine}
+        self.metrics_sem.release()
+        return state, responses, summaries
+
+    def restore_state(self, state, columns, summaries=b''):
+        """
+        Restores the state saved by :meth:`get_state`. Should be called before the monitor is started.
+        The responses and the summaries of the windows are only put back by :meth:`restore_responses` when the
+        monitor starts, so that restoring many websites is spread over their threads.
+
+        :param dict state: the metrics, availability and windows state
+        :param tuple columns: the times, status codes and elapsed times of the responses to put back in the queue
+        :param summaries: the encoded summaries of the windows, empty if the snapshot holds none
+        """
+        self.restored_columns = columns
+        if summaries:
+            self.restored_engine = (state['engine'], summaries)
+        self.tracker.available = state['available']
+        self.metrics = {k: decode_metric(v) for k, v in state['metrics']}
+        self.last_updates.update({k: v for k, v in state['last_updates']})
+        self.unavailable_since = state['unavailable_since']
+        self.recovered_at = state['recovered_at']
+        if self.request_scheduler.adaptive:
+            self.request_scheduler.interval = state['interval']
+
+    def restore_responses(self):
+        """
+        Puts the responses restored by :meth:`restore_state` back in the queue and in the availability window,
+        and the summaries back in the windows of the metrics. The windows are only computed from the responses when
+        the snapshot holds no summaries, or summaries of buckets of another length: the windows longer than the
+        responses stored then miss their older responses until they are covered again.
+        """
+        restored = False
+        if self.restored_engine:
+            engine, self.restored_engine = self.restored_engine, None
+            self.engine_lock.acquire()
+            try:
+                restored = self.engine.restore_state(*engine)
+            finally:
+                self.engine_lock.release()
+        if self.restored_columns:
+            responses = list(zip(*self.restored_columns))
+            self.restored_columns = None
+            self.request_scheduler.results.add_many(responses)
+            available = self.tracker.available
+            self.engine_lock.acquire()
+            for t, code, elapsed in responses:
+                self.tracker.add(t, code)
+                if not restored:
+                    self.engine.add(t, code, elapsed)
+            self.engine_lock.release()
+            self.tracker.available = available
+            logger.info(f"Restored {len(responses)} responses for {self.name}")
+
     def get_metrics(self, end, duration, delay):
         """
         get the metrics over the specified time window ending at **end**
@@ -140,63 +395,175 @@ class SiteMonitor(Thread):
         :param end: the end of the lookup window
         :param duration: the duration of the window
         :param delay: the delay between two lookups
+        :return: the availability, codes count, maximum and average response times, and number of skipped probes,
+            or None if no probe was sent. The availability and the response times are None if every probe was
+            skipped
         """
-
-        # TODO maybe detect sudden spikes in avg/max response times,
-        #  or when max and avg response times are way different, or mean vs avg response time
         logger.info(f"Retrieved metrics for the last {duration} seconds")
-        responses = self.request_scheduler.results.get_slice(end + delay - duration - self.timeout,
-                                                             end + delay - self.timeout)
+        if isinstance(self.request_scheduler.results, ColumnarQueue):
+            return self.get_columnar_metrics(end, duration, delay)
+        responses = self.request_scheduler.results.get_slice(*self.get_window(end, duration, delay))
         #  If the user sets the request interval too high, responses could be empty
         if responses:
             _, status_codes, elapsed = zip(*responses)
             codes_count = Counter(status_codes)
+            skipped = codes_count.pop(SKIPPED, 0)
+            if skipped:
+                elapsed = [e for _, code, e in responses if code != SKIPPED]
+                if not elapsed:
+                    return None, codes_count, None, None, skipped
             max_elapsed = max(elapsed)
             avg_elapsed = sum(elapsed) / len(elapsed)
-            availability = sum([codes_count[k] for k in codes_count.keys() if k < 400]) / len(responses)
-            return availability, codes_count, max_elapsed, avg_elapsed
+            availability = sum([codes_count[k] for k in codes_count.keys() if k < 400]) / len(elapsed)
+            return availability, codes_count, max_elapsed, avg_elapsed, skipped
+
+    def get_window(self, end, duration, delay):
+        """
+        Returns the start and end times of the responses used by :meth:`get_metrics`.
+
+        :rtype: tuple
+        """
+        return end + delay - duration - self.timeout, end + delay - self.timeout
+
+    def get_columnar_metrics(self, end, duration, delay):
+        """
+        Same as :meth:`get_metrics`, computed with vectorized operations on the columns of a
+        :class:`fixed_size.ColumnarQueue`.
+        """
+        results = self.request_scheduler.results
+        _, status_codes, elapsed = results.get_columns(*self.get_window(end, duration, delay))
+        codes, counts = results.np.unique(status_codes, return_counts=True)
+        #  The codes are sorted, the skipped probes come first
+        skipped = 0
+        if len(codes) and codes[0] == SKIPPED:
+            elapsed = elapsed[status_codes != SKIPPED]
+            skipped = int(counts[0])
+            codes, counts = codes[1:], counts[1:]
+        codes_count = Counter(dict(zip(codes.tolist(), counts.tolist())))
+        if len(elapsed):
+            availability = int(counts[codes < 400].sum()) / len(elapsed)
+            return availability, codes_count, float(elapsed.max()), float(elapsed.mean(dtype='float64')), skipped
+        if skipped:
+            return None, codes_count, None, None, skipped
 
     def read_metrics(self):
         """
         Returns the unread metrics and marks them as read. The returned metrics are sorted for logging.
+        The latency anomalies detected since the last call are returned under the key **'anomalies'**.
 
         :return: the unread metrics, sorted by time
         :rtype: list
         """
         self.metrics_sem.acquire()
         metrics_dict = {}
-        for k in [10, 60, 120]:
+        for k in self.is_read:
             if not self.is_read[k]:
                 metrics_dict[k] = self.metrics[k]
                 self.is_read[k] = True
+        if self.anomalies:
+            metrics_dict['anomalies'] = {'time': self.anomalies[-1]['time'], 'anomalies': self.anomalies}
+            self.anomalies = []
         self.metrics_sem.release()
         metrics = sorted(metrics_dict.items(), key=lambda x: x[1]['time'])
         return metrics
 
+    def get_health(self):
+        """
+        Returns the figures used to compare the website with the others, see :class:`fleet.FleetIndex`.
+
+        :return: the current availability, the 99th percentile of the response time and the number of server
+            errors (5xx) over the shortest window, each None if unknown, and whether the website is down
+        :rtype: dict
+        """
+        self.metrics_sem.acquire()
+        health = {'availability': self.tracker.availability, **self.window_health,
+                  'down': self.unavailable_since is not None}
+        self.metrics_sem.release()
+        return health
+
 
 class RequestScheduler(Thread):
     """
     This class creates a :class:`requester.Requester` object every *interval* and stores the results in a queue.
+    The kind of probe depends on the url's scheme: **tcp://** urls only open a connection, **tls://** urls
+    complete a TLS handshake, and anything else is requested over HTTP.
+
+    In adaptive mode, the interval stretches up to **ADAPTIVE_MAX_FACTOR** times the configured one while every
+    response is successful, and is halved down to **ADAPTIVE_MIN_FACTOR** times the configured one as soon as
+    an error or a latency excursion shows up.
 
     :param string url: the url to make requests to.
     :param float interval: the interval between requests in seconds
     :param timeout: the time to wait in seconds before considering that the response timed-out.
+    :param bool adaptive: whether the interval should adapt to the website's behaviour.
+    :param utils.TokenBucket bucket: a bucket shared by all the schedulers to enforce a global probe rate.
+        A probe is delayed until a token is available.
+    :param bool columnar: whether to store the responses in numpy arrays, see :class:`fixed_size.ColumnarQueue`
+    :param int max_in_flight: the maximum number of requests of this website waiting for their response.
+        Unlimited if None
+    :param utils.InFlightLimit in_flight_limit: a limit shared by all the schedulers on the number of requests
+        waiting for their response
+    :param str overload_policy: what to do with a probe when a limit is reached, one of **OVERLOAD_POLICIES**.
+        Skipped probes are stored with the status code **utils.SKIPPED**, and the others as timeouts
+    :param float phase: when to send the first probe, as a fraction of the interval. The websites sharing an
+        interval keep sending their probes at different times. If 0, the first probe is sent after one interval
+    :param int capacity: the maximum number of responses stored. Those of the last 10 minutes if None
     :ivar fixed_size.FixedSizeQueue results: stores the request responses.
+    :ivar deque new_results: the responses not yet consumed by the :class:`SiteMonitor`, in order of arrival.
+    :ivar float avg_elapsed: a moving average of the response time, used to detect latency excursions.
+    :ivar list excursions: the response times of the latest excursions in a row, see **REBASELINE_EXCURSIONS**
+    :ivar float first_probe: the time the first request was sent, None until then.
+    :ivar float next_probe: the time the next request is due. It moves by one interval after each request, so
+        that the requests keep their phase.
+    :ivar list requesters: the requests sent and still running when the last one was sent.
+    :ivar int n_skipped: the number of probes not sent because a limit was reached
+    :ivar list feeds: the :class:`ProbeFeed` of the websites sharing the responses of this scheduler
     """
 
-    def __init__(self, interval, url, timeout):
+    def __init__(self, interval, url, timeout, adaptive=False, bucket=None, columnar=False, max_in_flight=None,
+                 in_flight_limit=None, overload_policy='skip', phase=0, capacity=None):
         super(RequestScheduler, self).__init__()
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy {overload_policy}. Choose among {', '.join(OVERLOAD_POLICIES)}")
         self.url = url
+        self.requester = get_requester(url)
+        #  An invalid url is reported when the website is added, rather than by each probe
+        self.requester.check_url(url)
         self.interval = interval
-        self.results = FixedSizeQueue(int(600 / interval), key=itemgetter(0))
+        self.adaptive = adaptive
+        self.min_interval = interval * ADAPTIVE_MIN_FACTOR if adaptive else interval
+        self.max_interval = interval * ADAPTIVE_MAX_FACTOR if adaptive else interval
+        self.bucket = bucket
+        queue = ColumnarQueue if columnar else FixedSizeQueue
+        self.results = queue(capacity or int(STORED_DURATION / self.min_interval), key=itemgetter(0))
+        self.new_results = deque(maxlen=self.results.capacity)
         self.timeout = timeout
+        self.avg_elapsed = None
+        self.excursions = []
+        self.last_seen = 0
+        self.first_probe = None
+        self.next_probe = None
+        self.requesters = []
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = in_flight_limit
+        self.overload_policy = overload_policy
+        self.phase = phase
+        self.n_skipped = 0
+        self.feeds = []
         self.set_stop = False
 
+    @property
+    def in_flight(self):
+        """
+        The number of requests waiting for their response.
+        """
+        return sum([r.is_alive() for r in self.requesters])
+
     def run(self):
         """
         start making requests every **interval**
         """
-        t = time.time()
+        self.next_probe = time.time() + (self.phase or 1) * self.interval
         global EXCEPTION_RAISED
         try:
             while not self.set_stop:
@@ -204,18 +571,198 @@ class RequestScheduler(Thread):
                     self.stop()
                 else:
                     #   Used this instead of time.sleep(self.interval) to reduce the number of iterations 'lost'
-                    if time.time() - t > self.interval:
-                        req = Requester(self.url, self.results, self.timeout)
-                        req.start()
-                        t = time.time()
-                    time.sleep(self.interval / 1000)
+                    #   If the global budget is exhausted, the probe is retried at the next iteration
+                    #   When too many requests are in flight, the probe isn't sent and is handled by the policy
+                    if time.time() >= self.next_probe:
+                        self.requesters = [r for r in self.requesters if r.is_alive()]
+                        if not self.reserve():
+                            t = time.time()
+                            self.skip(t)
+                            self.schedule(t)
+                        elif not self.bucket or self.bucket.consume():
+                            if self.adaptive:
+                                self.adapt()
+                            req = self.requester(self.url, self, self.timeout)
+                            req.start()
+                            self.requesters.append(req)
+                            t = time.time()
+                            self.schedule(t)
+                            PROBE_ACTIVITY.on_sent(t)
+                            if self.first_probe is None:
+                                self.first_probe = t
+                        elif self.in_flight_limit:
+                            self.in_flight_limit.release()
+                    time.sleep(self.min_interval / 1000)
         except Exception as e:
             EXCEPTION_RAISED = True
             self.stop()
             raise e
 
+    def schedule(self, t):
+        """
+        Moves the next request one interval later. The requests missed while the scheduler was late, for instance
+        waiting for a token of the bucket, aren't caught up: the next one is sent at the next time in phase.
+
+        :param float t: the current time
+        """
+        self.next_probe += self.interval
+        if self.next_probe < t:
+            self.next_probe += math.ceil((t - self.next_probe) / self.interval) * self.interval
+
+    def reserve(self):
+        """
+        Checks that a new request stays within the in-flight limits, and takes its place in the shared limit.
+
+        :return: whether the request can be sent
+        :rtype: bool
+        """
+        if self.max_in_flight is not None and len(self.requesters) >= self.max_in_flight:
+            return False
+        return not self.in_flight_limit or self.in_flight_limit.acquire()
+
+    def skip(self, t):
+        """
+        Records a probe that isn't sent because too many requests are in flight, according to the overload policy.
+
+        :param float t: the time the probe should have been sent
+        """
+        self.n_skipped += 1
+        if self.overload_policy == 'skip':
+            self.store((t, SKIPPED, 0))
+        else:
+            self.store((t, 408, self.timeout))
+
+    def add(self, e):
+        """
+        Stores a response. Called by the :class:`utils.Requester` threads once they are done.
+
+        :param e: the response, as **(time, status code, elapsed time)**
+        """
+        self.store(e)
+        PROBE_ACTIVITY.on_done()
+        if self.in_flight_limit:
+            self.in_flight_limit.release()
+
+    def store(self, e):
+        """
+        Stores a response in the queue and hands it to the :class:`SiteMonitor`, and to the feeds sharing it.
+
+        :param e: the response, as **(time, status code, elapsed time)**
+        """
+        self.results.add(e)
+        self.new_results.append(e)
+        for feed in self.feeds:
+            feed.store(e)
+
+    def adapt(self):
+        """
+        Updates the interval based on the responses received since the last update.
+        """
+        responses = self.results.get_slice(self.last_seen, float('inf'))
+        responses = [r for r in responses if r[0] > self.last_seen]
+        if not responses:
+            return
+        self.last_seen = responses[-1][0]
+        degraded = False
+        for _, code, elapsed in responses:
+            if code == SKIPPED:
+                continue
+            if code >= 400:
+                degraded = True
+            elif self.avg_elapsed and elapsed > LATENCY_EXCURSION * self.avg_elapsed:
+                degraded = True
+                self.excursions.append(elapsed)
+                if len(self.excursions) >= REBASELINE_EXCURSIONS:
+                    self.avg_elapsed = sum(self.excursions) / len(self.excursions)
+                    self.excursions = []
+            else:
+                self.excursions = []
+                self.avg_elapsed = elapsed if self.avg_elapsed is None else 0.9 * self.avg_elapsed + 0.1 * elapsed
+        if degraded:
+            self.interval = max(self.interval / 2, self.min_interval)
+        else:
+            self.interval = min(self.interval * ADAPTIVE_STRETCH, self.max_interval)
+
     def stop(self):
         """
         stop making requests
         """
         self.set_stop = True
+
+
+class ProbeFeed:
+    """
+    The responses of a website taken from the :class:`RequestScheduler` of another website making the same probes,
+    so that the url isn't probed twice. The scheduler probes at the smallest interval of the websites sharing it,
+    and the feed keeps about one response per **interval** of its own website, so its metrics are computed from
+    as many responses as if it made its own requests.
+    Offers the attributes of a :class:`RequestScheduler` read by the :class:`SiteMonitor`.
+
+    :param RequestScheduler scheduler: the scheduler sending the requests
+    :param float interval: the interval between two responses kept
+    :param bool columnar: whether to store the responses in numpy arrays, see :class:`fixed_size.ColumnarQueue`
+    :param int capacity: the maximum number of responses stored. Those of the last 10 minutes if None
+    :ivar float due: the time from which the next response is kept, None until the first one
+    :ivar Semaphore due_sem: a semaphore guarding **due**, the responses being stored by the threads of the requests
+    :ivar int n_skipped: the number of skipped probes kept
+    """
+
+    def __init__(self, scheduler, interval, columnar=False, capacity=None):
+        self.scheduler = scheduler
+        self.url = scheduler.url
+        self.interval = interval
+        self.timeout = scheduler.timeout
+        self.adaptive = False
+        queue = ColumnarQueue if columnar else FixedSizeQueue
+        self.results = queue(capacity or int(STORED_DURATION / interval), key=itemgetter(0))
+        self.new_results = deque(maxlen=self.results.capacity)
+        self.due = None
+        self.due_sem = Semaphore()
+        self.n_skipped = 0
+        scheduler.feeds.append(self)
+
+    @property
+    def first_probe(self):
+        return self.scheduler.first_probe
+
+    @property
+    def in_flight(self):
+        """
+        Always 0, the requests are counted by the scheduler sending them.
+        """
+        return 0
+
+    def store(self, e):
+        """
+        Keeps a response of the scheduler if one is due. Called by the scheduler.
+
+        :param e: the response, as **(time, status code, elapsed time)**
+        """
+        #  Keeps the response the closest to when it is due, so that the responses are kept once per interval
+        #  on average, even when the interval isn't a multiple of the scheduler's
+        tolerance = self.scheduler.interval / 2
+        self.due_sem.acquire()
+        kept = self.due is None or e[0] >= self.due - tolerance
+        if self.due is None:
+            self.due = e[0] + self.interval
+        elif kept:
+            self.due = max(self.due + self.interval, e[0] + self.interval - tolerance)
+        self.due_sem.release()
+        if not kept:
+            return
+        if e[1] == SKIPPED:
+            self.n_skipped += 1
+        self.results.add(e)
+        self.new_results.append(e)
+
+    def start(self):
+        """
+        Nothing to do, the requests are sent by the scheduler.
+        """
+
+    def stop(self):
+        """
+        Stops taking the responses of the scheduler. The scheduler stops with its own website.
+        """
+        if self in self.scheduler.feeds:
+            self.scheduler.feeds.remove(self)
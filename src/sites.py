@@ -0,0 +1,237 @@
+import csv
+import json
+import logging
+import math
+from urllib.parse import urlsplit
+from src.utils import PROBES
+
+logger = logging.getLogger()
+
+"""
+This module reads the websites to monitor from the input file, a line at a time, so that the first websites can be
+monitored while the rest of a large file is still being read.
+
+Two formats are accepted:
+
+ - **CSV**: **name, url, interval, timeout** on each line. A field containing commas is quoted,
+   **"shop, eu",https://shop.example.com/?a=1,10,2**. An optional first line names the columns.
+ - **JSON Lines**: an object with the same keys on each line, **{"name": "shop", "url": "...", "interval": 10,
+   "timeout": 2}**. Chosen when the file ends with **.jsonl** or **.ndjson**, or when its first character is **{**.
+"""
+
+#  The fields of each website, in their order in the CSV files
+FIELDS = ('name', 'url', 'interval', 'timeout')
+#  The extensions of the JSON Lines files
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+#  The number of websites handed at once
+CHUNK_SIZE = 1000
+#  The maximum number of errors listed in the message of :class:`SitesFileError`
+MAX_ERRORS_SHOWN = 100
+
+
+class SitesFileError(ValueError):
+    """
+    Raised when the input file can't be read, or when some of its lines are invalid, see :class:`SitesReader`.
+
+    :param str path: the input file
+    :param list errors: the invalid lines, as **(line number, reason)**
+    :param str reason: why the file can't be read, if it can't
+    """
+
+    def __init__(self, path, errors=(), reason=None):
+        self.path = path
+        self.errors = list(errors)
+        if reason:
+            super().__init__(f"Could not read the input file {path}: {reason}")
+            return
+        lines = [f"    line {line}: {reason}" for line, reason in errors[:MAX_ERRORS_SHOWN]]
+        if len(errors) > MAX_ERRORS_SHOWN:
+            lines.append(f"    ... and {len(errors) - MAX_ERRORS_SHOWN} more")
+        super().__init__(f"{len(errors)} errors in {path}. Each line should hold the name, url, interval and "
+                         f"timeout of a website:\n" + "\n".join(lines))
+
+
+def check_url(url):
+    """
+    Checks that a url can be probed, see :data:`utils.PROBES`.
+
+    :param str url: the url
+    :return: why the url can't be probed, or None if it can
+    :rtype: str
+    """
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port
+    except ValueError as e:
+        return f"invalid url {url!r} ({e})"
+    if parsed.scheme.lower() not in PROBES:
+        return f"the url {url!r} should start with one of {', '.join([s + '://' for s in PROBES])}"
+    if not parsed.hostname:
+        return f"the url {url!r} has no host"
+    if parsed.scheme.lower() == 'tcp' and port is None:
+        return f"the url {url!r} has no port"
+    return None
+
+
+def check_site(fields):
+    """
+    Checks the fields of a website and converts them.
+
+    :param list fields: the name, url, interval and timeout, as read from the file
+    :return: the website, as **(name, url, interval, timeout)**, and the reasons it is invalid, if any
+    :rtype: tuple
+    """
+    if len(fields) != len(FIELDS):
+        return None, [f"expected {len(FIELDS)} fields, found {len(fields)}"]
+    name, url, interval, timeout = [str(field).strip() for field in fields]
+    errors = []
+    if not name:
+        errors.append("the name is empty")
+    reason = check_url(url)
+    if reason:
+        errors.append(reason)
+    durations = []
+    for field, value in (('interval', interval), ('timeout', timeout)):
+        try:
+            durations.append(float(value))
+        except ValueError:
+            errors.append(f"the {field} {value!r} isn't a number")
+            continue
+        if not 0 < durations[-1] < math.inf:
+            errors.append(f"the {field} should be a positive number of seconds, not {value}")
+    if errors:
+        return None, errors
+    return (name, url, *durations), errors
+
+
+class SitesReader:
+    """
+    Reads an input file, in chunks of **chunk_size** websites. All the lines are checked, and the errors are
+    gathered with their line number, to be reported together with a :class:`SitesFileError`.
+    The errors found before the first chunk is handed are raised, since no website is monitored yet: a file
+    holding less than a chunk is thus entirely checked before any website is handed. The invalid lines of the
+    next chunks are only logged and skipped, so that a mistake near the end of a large file doesn't stop the
+    websites already monitored, unless **strict**, in which case the errors are raised at the end of the file.
+
+    :param str path: the input file
+    :param int chunk_size: the number of websites of each chunk
+    :param bool strict: whether to raise the errors of the whole file at its end rather than skip the invalid
+        lines of the chunks after the first
+    :ivar list errors: the invalid lines, as **(line number, reason)**
+    :ivar set names: the names of the websites read so far, which must be unique
+    :ivar int n_sites: the number of websites read so far
+    :ivar int n_logged: the number of errors logged so far
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, strict=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.strict = strict
+        self.errors = []
+        self.names = set()
+        self.n_sites = 0
+        self.n_logged = 0
+
+    def __iter__(self):
+        try:
+            file = open(self.path, newline='')
+        except OSError as e:
+            raise SitesFileError(self.path, reason=e.strerror or str(e))
+        with file:
+            chunk = []
+            started = False
+            for line, fields in self.read_jsonl(file) if self.is_jsonl(file) else self.read_csv(file):
+                site, errors = check_site(fields)
+                if site and site[0] in self.names:
+                    errors.append(f"the name {site[0]!r} is already used")
+                    site = None
+                self.errors.extend([(line, reason) for reason in errors])
+                if site:
+                    self.names.add(site[0])
+                    chunk.append(site)
+                    self.n_sites += 1
+                    if len(chunk) == self.chunk_size:
+                        self.check(started)
+                        yield chunk
+                        chunk = []
+                        started = True
+        self.check(started)
+        if self.strict and self.errors:
+            raise SitesFileError(self.path, self.errors)
+        if chunk:
+            yield chunk
+
+    def check(self, started):
+        """
+        Raises the errors found before the first chunk is handed, and logs those found since the last chunk once
+        the websites are monitored, unless **strict**.
+
+        :param bool started: whether a chunk was already handed
+        :raises SitesFileError: if a line read before the first chunk is invalid
+        """
+        if self.strict or not self.errors or len(self.errors) == self.n_logged:
+            return
+        if not started:
+            raise SitesFileError(self.path, self.errors)
+        for line, reason in self.errors[self.n_logged:]:
+            logger.warning(f"Skipped line {line} of {self.path}: {reason}")
+        self.n_logged = len(self.errors)
+
+    def is_jsonl(self, file):
+        """
+        Tells whether the file is in JSON Lines, from its extension or its first character.
+        """
+        if self.path.lower().endswith(JSONL_EXTENSIONS):
+            return True
+        start = file.read(1024).lstrip()
+        file.seek(0)
+        return start.startswith('{')
+
+    @staticmethod
+    def read_csv(file):
+        """
+        Reads the fields of each line of a CSV file, skipping the empty lines and the column names.
+
+        :return: a generator of the line number and the fields of each website
+        """
+        reader = csv.reader(file, skipinitialspace=True)
+        for fields in reader:
+            if not fields or fields == [''] or (reader.line_num == 1 and tuple(fields) == FIELDS):
+                continue
+            yield reader.line_num, fields
+
+    def read_jsonl(self, file):
+        """
+        Reads the fields of each line of a JSON Lines file, skipping the empty lines. The malformed lines are
+        recorded in **errors** and skipped too.
+
+        :return: a generator of the line number and the fields of each website
+        """
+        for line, text in enumerate(file, 1):
+            if not text.strip():
+                continue
+            try:
+                site = json.loads(text)
+            except ValueError as e:
+                self.errors.append((line, f"invalid JSON ({e})"))
+                continue
+            if not isinstance(site, dict):
+                self.errors.append((line, "expected an object"))
+                continue
+            missing = [field for field in FIELDS if field not in site]
+            if missing:
+                self.errors.append((line, f"missing {', '.join(missing)}"))
+                continue
+            yield line, [site[field] for field in FIELDS]
+
+
+def get_sites(file_path):
+    """
+    Reads all the websites of an input file.
+
+    :param str file_path: the path to read from
+    :return: the websites to monitor, as **(name, url, interval, timeout)**
+    :rtype: list
+    :raises SitesFileError: if any line is invalid
+    """
+    return [site for chunk in SitesReader(file_path, strict=True) for site in chunk]
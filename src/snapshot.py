@@ -0,0 +1,169 @@
+from array import array
+from collections import Counter
+from threading import Thread
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+"""
+This module saves the state of the monitors to disk, so that a restarted program starts with valid metrics.
+
+A snapshot file is made of a small binary header, a JSON document holding the metrics and the state of every
+website, and the responses of all the websites stored as three columns:
+the request times (float64), the response times (float32) and the status codes (int16).
+The summaries of the windows of every website follow, see :meth:`windows.WindowEngine.get_state`, so that the
+windows longer than the responses stored are valid as soon as the program restarts.
+"""
+
+MAGIC = b'SMSNAP01'
+HEADER = struct.Struct('<QQ')
+
+logger = logging.getLogger()
+
+
+def encode_metric(metric):
+    """
+    Makes a metric dict JSON serializable. The status codes counters are the only values needing a conversion.
+
+    :param dict metric: the metric to encode
+    :rtype: dict
+    """
+    return {k: ({str(code): n for code, n in v.items()} if k == 'codes_count' else v) for k, v in metric.items()}
+
+
+def decode_metric(metric):
+    """
+    Reverts :func:`encode_metric`.
+
+    :param dict metric: the metric read from the snapshot
+    :rtype: dict
+    """
+    return {k: (Counter({int(code): n for code, n in v.items()}) if k == 'codes_count' else v)
+            for k, v in metric.items()}
+
+
+def write_snapshot(path, sites, ui_state=None):
+    """
+    Writes a snapshot atomically: the data is written to a temporary file which then replaces **path**.
+
+    :param str path: where to write the snapshot
+    :param list sites: a list of **(name, state, responses, summaries)**, where state is a JSON serializable dict,
+        responses a list of **(time, status code, elapsed time)** and summaries the encoded summaries of the windows
+    :param dict ui_state: the state of the user interface, if any
+    """
+    times, elapsed, codes = array('d'), array('f'), array('h')
+    header = {'time': time.time(), 'sites': [], 'ui': ui_state}
+    for name, state, responses, summaries in sites:
+        header['sites'].append({'name': name, 'count': len(responses), 'state': state, 'summaries': len(summaries)})
+        for t, code, e in responses:
+            times.append(t)
+            codes.append(code)
+            elapsed.append(e)
+    document = json.dumps(header, separators=(',', ':')).encode()
+    # Pads the document so that the columns are aligned when the file is memory-mapped
+    document += b' ' * (-(len(MAGIC) + HEADER.size + len(document)) % 8)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(len(document), len(times)))
+        f.write(document)
+        f.write(times.tobytes())
+        f.write(elapsed.tobytes())
+        f.write(codes.tobytes())
+        for _, _, _, summaries in sites:
+            f.write(summaries)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    """
+    Reads a snapshot written by :func:`write_snapshot`.
+    The file is memory-mapped and the responses are returned as read-only views over the mapping, so loading
+    does not depend on the number of stored responses. The mapping is closed once all the views are released.
+
+    :param str path: the snapshot to read
+    :return: the state of the user interface, and a dict mapping each website name to its state, its
+        **(times, status codes, elapsed times)** columns and its encoded summaries, empty in the snapshots written
+        before the summaries were saved
+    :rtype: tuple
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(f'{path} is not a valid snapshot file')
+        document_length, n = HEADER.unpack(f.read(HEADER.size))
+        header = json.loads(f.read(document_length))
+        if not n and not any([s.get('summaries') for s in header['sites']]):
+            return header['ui'], {s['name']: (s['state'], ((), (), ()), b'') for s in header['sites']}
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = len(MAGIC) + HEADER.size + document_length
+    view = memoryview(m)
+    times = view[offset:offset + 8 * n].cast('d')
+    elapsed = view[offset + 8 * n:offset + 12 * n].cast('f')
+    codes = view[offset + 12 * n:offset + 14 * n].cast('h')
+    sites = {}
+    start = 0
+    summaries_start = offset + 14 * n
+    for site in header['sites']:
+        end = start + site['count']
+        summaries_end = summaries_start + site.get('summaries', 0)
+        sites[site['name']] = (site['state'], (times[start:end], codes[start:end], elapsed[start:end]),
+                               view[summaries_start:summaries_end])
+        start = end
+        summaries_start = summaries_end
+    return header['ui'], sites
+
+
+class Snapshotter(Thread):
+    """
+    A thread writing a snapshot of every monitor periodically.
+    The state is copied quickly from the monitors, and the encoding and writing happen in this thread,
+    so the requests are never delayed by a snapshot.
+
+    :param GlobalMonitor global_monitor: the monitor to save
+    :param str path: the path of the snapshot file
+    :param float interval: the time in seconds between two snapshots. A last snapshot is written when stopping.
+        A failed snapshot is logged, and the next one is tried after another interval.
+    """
+
+    def __init__(self, global_monitor, path, interval=60):
+        super().__init__()
+        self.global_monitor = global_monitor
+        self.path = path
+        self.interval = interval
+        self.set_stop = False
+
+    def run(self):
+        t = time.time()
+        while not self.set_stop:
+            if time.time() - t > self.interval:
+                self.try_snapshot()
+                t = time.time()
+            time.sleep(0.1)
+        self.try_snapshot()
+
+    def try_snapshot(self):
+        """
+        Writes a snapshot, logging the error if it fails, so that the thread keeps running.
+        """
+        try:
+            self.snapshot()
+        except Exception:
+            logger.exception(f"The snapshot to {self.path} failed")
+
+    def snapshot(self):
+        """
+        Writes a snapshot of the monitors right away.
+        """
+        start = time.time()
+        sites = [(site[0], *monitor.get_state()) for site, monitor in list(self.global_monitor.site_monitors.items())]
+        ui = self.global_monitor.ui
+        write_snapshot(self.path, sites, ui.get_state() if ui else None)
+        logger.info(f"Snapshot of {len(sites)} websites written in {time.time() - start:.3f} seconds")
+
+    def stop(self):
+        self.set_stop = True
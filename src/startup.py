@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+import time
+
+"""
+This module measures where the time goes while the program starts.
+"""
+
+
+class StartupProfiler:
+    """
+    Records the duration of each step of the startup, and the time at which some milestones are reached.
+
+    :ivar float start: the time at which the profiler was created, used as the origin of the milestones
+    :ivar list phases: the name and duration in seconds of each step, in the order they were run
+    :ivar list milestones: the name and time since **start** of each milestone
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.milestones = []
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures the duration of the code run in the context.
+
+        :param str name: the name of the step
+        """
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - t))
+
+    def milestone(self, name, t=None):
+        """
+        Records that a milestone has been reached.
+
+        :param str name: the name of the milestone
+        :param float t: the unix time at which the milestone was reached. Defaults to now.
+        """
+        self.milestones.append((name, (t or time.time()) - self.start))
+
+    def report(self):
+        """
+        Formats the recorded steps and milestones, in milliseconds.
+
+        :return: the report, one line per step or milestone
+        :rtype: list[str]
+        """
+        width = max([len(name) for name, _ in self.phases + self.milestones] + [0])
+        lines = ["Startup steps:"]
+        lines.extend([f"    {name:<{width}} : {1000 * d:8.1f} ms" for name, d in self.phases])
+        lines.append("Milestones (since the program started):")
+        lines.extend([f"    {name:<{width}} : {1000 * d:8.1f} ms" for name, d in self.milestones])
+        return lines
@@ -0,0 +1,183 @@
+from collections import deque
+from threading import Thread
+import json
+import logging
+import math
+import sqlite3
+import time
+from src.snapshot import encode_metric
+
+"""
+This module stores the responses and the metrics of all the websites in a SQLite database, which can be queried
+across websites, unlike the text files of the logs folder.
+
+The database has two tables, both indexed by website and time:
+
+ - **samples (site, time, code, elapsed, partition)**: every response
+ - **metrics (site, time, key, metric, partition)**: every metric published, as JSON
+
+**partition** is the index of the time partition of the row, so that the rows past the retention are deleted
+a whole partition at a time.
+"""
+
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (site TEXT, time REAL, code INTEGER, elapsed REAL, partition INTEGER);
+CREATE INDEX IF NOT EXISTS samples_site_time ON samples (site, time);
+CREATE INDEX IF NOT EXISTS samples_partition ON samples (partition);
+CREATE TABLE IF NOT EXISTS metrics (site TEXT, time REAL, key TEXT, metric TEXT, partition INTEGER);
+CREATE INDEX IF NOT EXISTS metrics_site_time ON metrics (site, time);
+CREATE INDEX IF NOT EXISTS metrics_partition ON metrics (partition);
+"""
+
+
+class SQLiteStore(Thread):
+    """
+    A thread writing the responses and the metrics of the websites to a SQLite database.
+
+    Every **period**, the responses received since the last write are read from the monitors' queues, like
+    :class:`agent.Agent` does, and written with the metrics handed by :meth:`add_metrics` in a single transaction.
+    The probes are never delayed: this thread is the only one writing to the database, and the database is in
+    WAL mode, so that it can be read by other programs while it is written.
+    A failed write, for instance when the disk is full, is logged and tried again at the next period, with the
+    responses and the metrics it couldn't write.
+
+    :param GlobalMonitor global_monitor: the monitor whose websites to store
+    :param str path: the path of the database
+    :param float period: the time in seconds between two writes
+    :param float retention: the time in seconds the rows are kept for. Forever if None
+    :param float partition: the length in seconds of the time partitions deleted at once
+    :ivar dict last_ends: the end of the last responses written for each website
+    :ivar deque new_metrics: the metrics not written yet, as **(website name, key, metric)**
+    :ivar int n_samples: the number of responses written
+    :ivar float busy: the time in seconds spent writing
+    :ivar bool failing: whether the last write failed
+    """
+
+    def __init__(self, global_monitor, path, period=1, retention=None, partition=3600):
+        super().__init__()
+        self.global_monitor = global_monitor
+        self.path = path
+        self.period = period
+        self.retention = retention
+        self.partition = partition
+        self.connection = None
+        self.last_ends = {}
+        self.new_metrics = deque()
+        self.n_samples = 0
+        self.busy = 0
+        self.failing = False
+        self.set_stop = False
+
+    def connect(self):
+        """
+        Opens the database, creating its tables if needed. The connection can only be used by the calling thread.
+        """
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        #  In WAL mode, a crash can only lose the last transactions, never corrupt the database
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def run(self):
+        self.connect()
+        t = time.time()
+        while not self.set_stop:
+            if time.time() - t > self.period:
+                t = time.time()
+                self.try_write()
+            time.sleep(0.01)
+        #  The program is exiting, the responses more recent than the timeout won't be written later
+        self.try_write(final=True)
+        self.connection.close()
+
+    def try_write(self, final=False):
+        """
+        Writes the new responses and metrics, logging the error if it fails, so that the thread keeps running.
+        Only the first of consecutive failures is logged.
+
+        :param bool final: whether it is the last write, see :meth:`write`
+        """
+        try:
+            self.write(final)
+        except Exception:
+            if not self.failing:
+                logger.exception(f"Writing to {self.path} failed, the rows are kept for the next write")
+            self.failing = True
+            return
+        if self.failing:
+            logger.info(f"Writing to {self.path} works again")
+        self.failing = False
+
+    def add_metrics(self, name, metrics):
+        """
+        Hands metrics to be written. Never blocks.
+
+        :param str name: the name of the website
+        :param list metrics: the metrics, as returned by :meth:`site_monitor.SiteMonitor.read_metrics`
+        """
+        self.new_metrics.extend([(name, key, metric) for key, metric in metrics])
+
+    def collect(self, final=False):
+        """
+        Reads the responses received by each monitor since the last write. Responses more recent than the timeout
+        are left for the next write, as earlier requests could still be waiting for their response.
+
+        :param bool final: whether to read all the responses, when no other response is expected
+        :return: the rows of the responses, and the new end of each website's responses
+        :rtype: tuple
+        """
+        rows = []
+        ends = {}
+        now = time.time()
+        for site, monitor in list(self.global_monitor.site_monitors.items()):
+            start = self.last_ends.get(site[0], float('-inf'))
+            end = float('inf') if final else now - monitor.timeout
+            ends[site[0]] = end
+            rows.extend([(site[0], t, code, elapsed, math.floor(t / self.partition))
+                         for t, code, elapsed in monitor.request_scheduler.results.get_slice(start, end) if t > start])
+        return rows, ends
+
+    def write(self, final=False):
+        """
+        Writes the new responses and metrics in a single transaction, then deletes the expired partitions.
+        If the transaction fails, it is rolled back: the responses are read again and the metrics written at the
+        next write.
+
+        :param bool final: whether to write all the responses, including those more recent than the timeout
+        :raises sqlite3.Error: if the transaction fails
+        """
+        start = time.time()
+        samples, ends = self.collect(final)
+        pending = []
+        while self.new_metrics:
+            pending.append(self.new_metrics.popleft())
+        metrics = [(name, metric['time'], str(key), json.dumps(encode_metric(metric)),
+                    math.floor(metric['time'] / self.partition)) for name, key, metric in pending]
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?)', samples)
+                self.connection.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?)', metrics)
+        except sqlite3.Error:
+            self.new_metrics.extendleft(reversed(pending))
+            raise
+        self.last_ends.update(ends)
+        self.n_samples += len(samples)
+        if self.retention:
+            self.expire(time.time() - self.retention)
+        self.busy += time.time() - start
+
+    def expire(self, before):
+        """
+        Deletes the partitions ending before **before**.
+
+        :param float before: the unix time before which the rows are deleted
+        """
+        oldest = math.floor(before / self.partition)
+        with self.connection:
+            for table in ('samples', 'metrics'):
+                self.connection.execute(f'DELETE FROM {table} WHERE partition < ?', (oldest,))
+
+    def stop(self):
+        self.set_stop = True
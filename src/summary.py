@@ -0,0 +1,271 @@
+from collections import Counter
+import math
+import struct
+from src.utils import SKIPPED
+
+"""
+This module contains the compact, mergeable summaries of the responses received during a time window,
+and the binary format used to send them over the network.
+"""
+
+#  The ratio between the bounds of two consecutive latency buckets. Quantiles are accurate within 2.5%
+GAMMA = 1.05
+LOG_GAMMA = math.log(GAMMA)
+#  Response times below this value (in seconds) all fall in the same bucket
+MIN_ELAPSED = 1e-4
+
+MAGIC = b'SMON'
+VERSION = 1
+FRAME = struct.Struct('<4sHI')
+RECORD = struct.Struct('<IddIddHH')
+CODE = struct.Struct('<HI')
+BUCKET = struct.Struct('<hI')
+NAME = struct.Struct('<IH')
+COUNT = struct.Struct('<HI')
+#  A summary saved in a snapshot, as a record without the id of its website
+SUMMARY = struct.Struct('<ddIddHH')
+
+
+class WindowSummary:
+    """
+    Summarizes the responses received during a time window. Two summaries can be merged, whether they cover
+    different time windows or were gathered from different places.
+    The response times are kept in a sketch: a histogram with logarithmic buckets, so quantiles can be estimated
+    with a bounded relative error whatever the number of responses.
+
+    :param float start: the start of the window
+    :param float end: the end of the window
+    :ivar int count: the number of responses
+    :ivar Counter codes_count: the number of responses for each status code, and of skipped probes under
+        **utils.SKIPPED**
+    :ivar float sum_elapsed: the sum of the response times
+    :ivar float max_elapsed: the maximum response time
+    :ivar Counter sketch: the number of responses in each latency bucket
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.codes_count = Counter()
+        self.sum_elapsed = 0
+        self.max_elapsed = 0
+        self.sketch = Counter()
+
+    def add(self, code, elapsed):
+        """
+        Adds a response to the summary.
+
+        :param int code: the status code
+        :param float elapsed: the response time
+        """
+        self.codes_count[code] += 1
+        if code == SKIPPED:
+            return
+        self.count += 1
+        self.sum_elapsed += elapsed
+        self.max_elapsed = max(self.max_elapsed, elapsed)
+        self.sketch[math.ceil(math.log(max(elapsed, MIN_ELAPSED)) / LOG_GAMMA)] += 1
+
+    def merge(self, other):
+        """
+        Adds the responses of another summary to this one.
+
+        :param WindowSummary other: the summary to merge
+        """
+        self.start = min(self.start, other.start)
+        self.end = max(self.end, other.end)
+        self.count += other.count
+        self.codes_count.update(other.codes_count)
+        self.sum_elapsed += other.sum_elapsed
+        self.max_elapsed = max(self.max_elapsed, other.max_elapsed)
+        self.sketch.update(other.sketch)
+
+    def remove(self, other):
+        """
+        Takes out the responses of a summary previously merged in this one.
+        The maximum response time can't be taken out, it is left as is.
+
+        :param WindowSummary other: the summary to take out
+        """
+        self.count -= other.count
+        self.codes_count -= other.codes_count
+        self.sum_elapsed = self.sum_elapsed - other.sum_elapsed if self.count else 0
+        self.sketch -= other.sketch
+
+    @property
+    def successes(self):
+        """
+        The number of responses with a status code below 400.
+        """
+        return sum([v for k, v in self.codes_count.items() if SKIPPED < k < 400])
+
+    @property
+    def availability(self):
+        """
+        The ratio of responses with a status code below 400.
+        """
+        return self.successes / self.count
+
+    @property
+    def avg_elapsed(self):
+        return self.sum_elapsed / self.count
+
+    def quantile(self, q):
+        """
+        Estimates a quantile of the response times.
+
+        :param float q: the quantile, between 0 and 1
+        :rtype: float
+        """
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.sketch):
+            seen += self.sketch[index]
+            if seen > rank:
+                #  The middle of the bucket, in relative terms
+                return min(2 * GAMMA ** index / (GAMMA + 1), self.max_elapsed)
+        return self.max_elapsed
+
+
+def encode_frame(agent, records, names):
+    """
+    Encodes a batch of summaries in a single frame.
+    Website names are dictionary-encoded: each name is only sent once per connection, then referred to by an id.
+
+    :param str agent: the name of the sending agent
+    :param list records: a list of **(website name, summary)**
+    :param dict names: the ids of the names already sent on this connection. Updated with the new ones.
+    :return: the frame, ready to be sent
+    :rtype: bytes
+    """
+    new_names = []
+    body = []
+    for name, summary in records:
+        if name not in names:
+            names[name] = len(names)
+            new_names.append(name)
+        body.append(RECORD.pack(names[name], summary.start, summary.end, summary.count, summary.sum_elapsed,
+                                summary.max_elapsed, len(summary.codes_count), len(summary.sketch)))
+        body.extend(CODE.pack(k, v) for k, v in summary.codes_count.items())
+        body.extend(BUCKET.pack(k, v) for k, v in summary.sketch.items())
+    agent = agent.encode()
+    header = [struct.pack('<H', len(agent)), agent, COUNT.pack(len(new_names), len(records))]
+    for name in new_names:
+        encoded = name.encode()
+        header.append(NAME.pack(names[name], len(encoded)))
+        header.append(encoded)
+    payload = b''.join(header + body)
+    return FRAME.pack(MAGIC, VERSION, len(payload)) + payload
+
+
+def decode_payload(payload, names):
+    """
+    Decodes the payload of a frame made by :func:`encode_frame`.
+
+    :param bytes payload: the payload, without the frame header
+    :param dict names: the names received so far on this connection, by id. Updated with the new ones.
+    :return: the name of the agent and the list of **(website name, summary)**
+    :rtype: tuple
+    """
+    view = memoryview(payload)
+    agent_length, = struct.unpack_from('<H', view)
+    offset = 2 + agent_length
+    agent = bytes(view[2:offset]).decode()
+    n_names, n_records = COUNT.unpack_from(view, offset)
+    offset += COUNT.size
+    for _ in range(n_names):
+        name_id, length = NAME.unpack_from(view, offset)
+        offset += NAME.size
+        names[name_id] = bytes(view[offset:offset + length]).decode()
+        offset += length
+    records = []
+    for _ in range(n_records):
+        name_id, start, end, count, sum_elapsed, max_elapsed, n_codes, n_buckets = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        summary = WindowSummary(start, end)
+        summary.count, summary.sum_elapsed, summary.max_elapsed = count, sum_elapsed, max_elapsed
+        for _ in range(n_codes):
+            code, n = CODE.unpack_from(view, offset)
+            summary.codes_count[code] = n
+            offset += CODE.size
+        for _ in range(n_buckets):
+            index, n = BUCKET.unpack_from(view, offset)
+            summary.sketch[index] = n
+            offset += BUCKET.size
+        records.append((names[name_id], summary))
+    return agent, records
+
+
+def encode_summaries(summaries):
+    """
+    Encodes summaries to be saved in a snapshot, in the binary format of the records of :func:`encode_frame`.
+
+    :param list summaries: the summaries
+    :rtype: bytes
+    """
+    body = []
+    for summary in summaries:
+        body.append(SUMMARY.pack(summary.start, summary.end, summary.count, summary.sum_elapsed,
+                                 summary.max_elapsed, len(summary.codes_count), len(summary.sketch)))
+        body.extend(CODE.pack(k, v) for k, v in summary.codes_count.items())
+        body.extend(BUCKET.pack(k, v) for k, v in summary.sketch.items())
+    return b''.join(body)
+
+
+def decode_summaries(buffer):
+    """
+    Reverts :func:`encode_summaries`.
+
+    :param buffer: the encoded summaries, for instance a view over a snapshot
+    :rtype: list
+    """
+    view = memoryview(buffer)
+    summaries = []
+    offset = 0
+    while offset < len(view):
+        start, end, count, sum_elapsed, max_elapsed, n_codes, n_buckets = SUMMARY.unpack_from(view, offset)
+        offset += SUMMARY.size
+        summary = WindowSummary(start, end)
+        summary.count, summary.sum_elapsed, summary.max_elapsed = count, sum_elapsed, max_elapsed
+        for code, n in CODE.iter_unpack(view[offset:offset + n_codes * CODE.size]):
+            summary.codes_count[code] = n
+        offset += n_codes * CODE.size
+        for index, n in BUCKET.iter_unpack(view[offset:offset + n_buckets * BUCKET.size]):
+            summary.sketch[index] = n
+        offset += n_buckets * BUCKET.size
+        summaries.append(summary)
+    return summaries
+
+
+def read_frame(sock):
+    """
+    Reads a whole frame from a socket.
+
+    :param socket.socket sock: the socket to read from
+    :return: the payload of the frame, or None if the connection was closed
+    :rtype: bytes
+    """
+    header = read_exactly(sock, FRAME.size)
+    if header is None:
+        return None
+    magic, version, length = FRAME.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Received an invalid frame")
+    return read_exactly(sock, length)
+
+
+def read_exactly(sock, n):
+    """
+    Reads exactly **n** bytes from a socket.
+
+    :return: the bytes read, or None if the connection was closed before
+    :rtype: bytes
+    """
+    buffer = bytearray()
+    while len(buffer) < n:
+        chunk = sock.recv(n - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
@@ -0,0 +1,178 @@
+from bisect import bisect_left, bisect_right
+import json
+import logging
+import os
+import time
+
+"""
+This module keeps the events of all the websites, when they went down or recovered and their latency anomalies,
+in a single timeline sorted by time, so that the logs page reads the events it shows instead of sorting them all
+for every frame. The timeline is written to a file as it grows, and read back when the program starts again.
+"""
+
+logger = logging.getLogger()
+
+#  The kinds of the events changing the availability of a website
+AVAILABILITY_KINDS = ('unavailable_since', 'recovered_at')
+#  The formats accepted when jumping to a time, in local time. Without a date, the time is taken today
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%H:%M:%S', '%H:%M')
+#  The number of events kept. The oldest ones are dropped once the timeline holds half as many more
+MAX_EVENTS = 100000
+
+
+class Timeline:
+    """
+    The events of the websites, as **(name, kind, time, description)**, sorted by time, along with the events
+    of each website on their own.
+    The times are kept in a separate list, to find where an event goes, or where a time starts, with a binary
+    search. The events mostly arrive in order, so they are nearly always appended at the end. Events at the same
+    time keep their order of arrival.
+    Only the latest **max_events** events are kept: the oldest ones are dropped by batches, and the file is
+    rewritten with the remaining ones, so neither the memory nor the file grow forever.
+
+    :param str path: the file the events are appended to, as JSON lines, and read from when it exists.
+        The events are only kept in memory if None
+    :param int max_events: the number of events kept
+    :ivar list times: the time of each event
+    :ivar list events: the events, sorted by time
+    :ivar dict sites: the times and the events of each website, by name
+    :ivar dict last_changes: the time of the latest availability change of each website, by name
+    """
+
+    def __init__(self, path=None, max_events=MAX_EVENTS):
+        self.path = path
+        self.max_events = max_events
+        self.times = []
+        self.events = []
+        self.sites = {}
+        self.last_changes = {}
+        if path and os.path.isfile(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, index):
+        return self.events[index]
+
+    def load(self):
+        """
+        Reads the events saved in **path**. A malformed line is skipped, and the last line is dropped from the file
+        if a crash cut it short, so that the next events start on a line of their own.
+        """
+        t = time.time()
+        events = []
+        with open(self.path, 'rb+') as file:
+            complete = 0
+            for line in file:
+                if not line.endswith(b'\n'):
+                    file.truncate(complete)
+                    logger.warning(f"Dropped the last line of {self.path}, cut short")
+                    break
+                complete += len(line)
+                try:
+                    events.append(tuple(json.loads(line)))
+                except ValueError:
+                    logger.warning(f"Skipped a malformed line of {self.path}")
+        self.insert(events)
+        self.compact()
+        logger.info(f"Loaded {len(events)} events from {self.path} in {time.time() - t:.3f} seconds")
+
+    def add(self, events):
+        """
+        Adds events and appends them to **path**.
+
+        :param list events: the events, as **(name, kind, time, description)**, in any order
+        """
+        if not events:
+            return
+        self.insert(events)
+        if self.path:
+            with open(self.path, 'a') as file:
+                file.write(''.join([json.dumps(event) + '\n' for event in events]))
+        self.compact()
+
+    def compact(self):
+        """
+        Drops the oldest events once the timeline holds half as many more as **max_events**, and rewrites the file
+        with the remaining ones. The events at the same time as the oldest event kept are kept too.
+        """
+        if len(self.events) <= 1.5 * self.max_events:
+            return
+        oldest = self.times[len(self.events) - self.max_events]
+        n = bisect_left(self.times, oldest)
+        del self.times[:n]
+        del self.events[:n]
+        for name, (times, events) in list(self.sites.items()):
+            i = bisect_left(times, oldest)
+            del times[:i]
+            del events[:i]
+            if not times:
+                del self.sites[name]
+        if self.path:
+            #  The file is replaced at once, a crash leaves either the old or the new one
+            with open(self.path + '.tmp', 'w') as file:
+                file.write(''.join([json.dumps(event) + '\n' for event in self.events]))
+            os.replace(self.path + '.tmp', self.path)
+        logger.info(f"Dropped the {n} oldest events of the timeline")
+
+    def insert(self, events):
+        """
+        Adds events to the timeline and to the events of their website, without saving them.
+        """
+        for event in events:
+            name, kind, t = event[:3]
+            if name not in self.sites:
+                self.sites[name] = ([], [])
+            for times, ordered in (self.sites[name], (self.times, self.events)):
+                if not times or t >= times[-1]:
+                    times.append(t)
+                    ordered.append(event)
+                else:
+                    i = bisect_right(times, t)
+                    times.insert(i, t)
+                    ordered.insert(i, event)
+            if kind in AVAILABILITY_KINDS and t >= self.last_changes.get(name, t):
+                self.last_changes[name] = t
+
+    def select(self, name=None):
+        """
+        Returns the events of a website, or of all the websites.
+
+        :param str name: the name of the website. All the websites if None
+        :return: the times and the events, sorted by time. Shared with the timeline: they must not be modified
+        :rtype: tuple
+        """
+        if name is None:
+            return self.times, self.events
+        return self.sites.get(name, ([], []))
+
+    def find(self, t, name=None):
+        """
+        Returns the index of the first event at or after a time.
+
+        :param float t: the unix time
+        :param str name: only count the events of this website, if any
+        :rtype: int
+        """
+        return bisect_left(self.select(name)[0], t)
+
+
+def parse_time(text):
+    """
+    Reads a local time typed by the user, in one of the **TIME_FORMATS**.
+
+    :param str text: the time, for instance **2024-01-31 13:05** or **13:05:30**
+    :return: the unix time, or None if the text isn't a time
+    :rtype: float
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            parsed = time.strptime(text.strip(), time_format)
+        except ValueError:
+            continue
+        if '%Y' not in time_format:
+            today = time.localtime()
+            parsed = time.struct_time((today.tm_year, today.tm_mon, today.tm_mday, *parsed[3:6], 0, 0, -1))
+        return time.mktime(parsed)
+    return None
@@ -1,11 +1,31 @@
 import curses
 from collections import defaultdict
-from operator import itemgetter
-from src.utils import get_local_time, array_to_plot
+from src.utils import TIME_FORMATTER, array_to_plot
+from src.snapshot import encode_metric, decode_metric
+from src.anomaly import describe_anomaly
+from src.diagnostics import TIMERS
+from src.windows import DEFAULT_WINDOWS, AVAILABILITY_KEY, describe_duration
+from src.fleet import FleetIndex, RANKINGS, LATENCY_BANDS
+from src.timeline import Timeline, AVAILABILITY_KINDS, parse_time
 import logging
 
 logger = logging.getLogger()
 
+#  The pages listed in the main menu before the websites
+PAGES = ['Summary', 'Fleet', 'Logs', 'Diagnostics']
+#  How each statistic of the windows is shown, see :data:`windows.STATS`
+STAT_NAMES = {'max_elapsed': 'Maximum Response Time', 'avg_elapsed': 'Average Response Time',
+              'p50': 'Median Response Time', 'p90': '90th Percentile', 'p95': '95th Percentile',
+              'p99': '99th Percentile', 'availability': 'Availability', 'codes_count': 'Response Code Count',
+              'skipped': 'Skipped Probes'}
+#  The titles of the rankings of the fleet page, when showing the worst and the best websites first
+RANKING_TITLES = {'availability': ('Lowest availability', 'Highest availability'),
+                  'p99': ('Highest 99th percentile of the response time',
+                          'Lowest 99th percentile of the response time'),
+                  'errors': ('Most server errors (5xx)', 'Fewest server errors (5xx)')}
+#  The maximum number of websites listed on the fleet page
+FLEET_TOP = 100
+
 
 class UserInterface:
     """
@@ -13,28 +33,51 @@ class UserInterface:
 
     :ivar screen: a reference to the curses screen object.
     :ivar list sites: stores the monitored websites
+    :ivar list windows: the windows of the metrics, see :class:`windows.WindowSpec`
     :ivar defaultdict stored_info: contains the string containing the metrics for each pair site
     :ivar defaultdict stored_plot: contains the plot for each pair (site, delay)
     :ivar defaultdict cum_metrics: contains the last few retrieved metrics
+    :ivar int history_size: the number of values kept in each history of **cum_metrics**, set by the memory budget,
+        see :class:`memory.MemoryBudget`. Unlimited if None
     :ivar defaultdict changed: remembers whether a (site, delay) s plot and info have been changed since the last update
-    :ivar defaultdict availability_changes: for each website, stores when it went down or recovered
+    :ivar timeline.Timeline timeline: when the websites went down or recovered, and their latency anomalies
+    :ivar dict diagnostics: the latest diagnostics of the program, shown on the diagnostics page
+    :ivar fleet.FleetIndex fleet: the rankings of the websites, shown on the fleet page
+    :ivar str ranking: the ranking shown on the fleet page, one of **fleet.RANKINGS**
+    :ivar bool worst_first: whether the fleet page lists the worst websites first
+    :ivar str prefix: only the websites whose name starts with it are listed on the fleet page
+    :ivar str log_site: only the events of the website with this name are shown on the logs page, if any
+    :ivar str jump: the time being typed to jump to on the logs page, see :func:`timeline.parse_time`
+    :ivar str typing: the attribute the key presses are added to, **'prefix'**, **'log_site'** or **'jump'**,
+        if any
     :ivar int cursor: the number of the page to render
     :ivar int max_cursor: the maximum value the cursor could have
     :ivar bool set_stop: whether the program should quit
     """
 
-    def __init__(self, sites, screen):
+    def __init__(self, sites, screen, windows=DEFAULT_WINDOWS, fleet=None, timeline=None, history_size=None):
         # Used defaultdict instead of dicts to allow adding / removing sites at run time later without much issues
         self.screen = screen
         self.h, self.w = self.screen.getmaxyx()
         self.init_curses()
         self.sites = sites
+        self.windows = sorted(windows, key=lambda spec: spec.duration)
         self.stored_info = defaultdict(list)
         self.stored_plot = defaultdict(list)
         self.stored_metrics = defaultdict(lambda: defaultdict(lambda: None))
         self.cum_metrics = defaultdict(lambda: defaultdict(list))
+        self.history_size = history_size
         self.changed = defaultdict(lambda: True)
-        self.availability_changes = defaultdict(list)
+        self.timeline = timeline or Timeline()
+        self.diagnostics = None
+        self.fleet = fleet or FleetIndex()
+        self.ranking = next(iter(RANKINGS))
+        self.worst_first = True
+        self.prefix = ''
+        self.log_site = ''
+        self.jump = ''
+        self.typing = None
+        self.fleet_rows = []
         self.current_page = 0
         self.cursor = 0
         self.max_cursor = len(sites)
@@ -53,6 +96,7 @@ class UserInterface:
         curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
         curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
         curses.init_pair(3, curses.COLOR_RED, curses.COLOR_BLACK)
+        curses.init_pair(4, curses.COLOR_YELLOW, curses.COLOR_BLACK)
 
     def stop(self):
         """
@@ -61,38 +105,56 @@ class UserInterface:
         self.set_stop = True
         curses.endwin()
 
-    def update_and_display(self, metrics):
+    def update_and_display(self, metrics, diagnostics=None):
         """
         Updates the UI's data and renders the screen
 
         :param metrics:
+        :param dict diagnostics: the latest diagnostics of the program, if any
+        :return: the action requested by the user: **'q'** to quit, **'p'** to toggle the profiler,
+            **'d'** to save the diagnostics, **'e'** to export the responses in memory
         """
+        if diagnostics:
+            self.diagnostics = diagnostics
+        events = []
         for site, metric in metrics.items():
             self.changed[(1, site)] = True
             self.changed[(2, site)] = True
-            self.changed[(3, site)] = True
             for delay, values in metric:
+                if delay == 'anomalies':
+                    events.extend([(site[0], a['kind'], a['time'], describe_anomaly(a)) for a in values['anomalies']])
+                    continue
                 # This is to avoid having both unavailable_since and recovered_at set at the same time
                 self.stored_metrics[(site, delay)]['unavailable_since'] = None
                 self.stored_metrics[(site, delay)]['recovered_at'] = None
                 for k, v in values.items():
                     self.stored_metrics[(site, delay)][k] = v
-                    self.cum_metrics[(site, delay)][k].append(v)
+                    history = self.cum_metrics[(site, delay)][k]
+                    history.append(v)
+                    if self.history_size and len(history) > self.history_size:
+                        del history[:-self.history_size]
+            events.extend(self.get_availability_changes(site))
+        self.timeline.add(events)
         #  Clears the screen and reads key presses
         res = self.get_keypress()
-        self.screen.erase()
-        # If screen is resized, update the height and width
-        if curses.is_term_resized(self.h, self.w):
-            self.h, self.w = self.screen.getmaxyx()
-        # renders the current page
-        if self.current_page == 0:
-            self.welcome_screen()
-        elif self.current_page == 1:
-            self.summary_screen()
-        elif self.current_page == 2:
-            self.log_screen()
-        else:
-            self.site_info()
+        with TIMERS.measure('render'):
+            self.screen.erase()
+            # If screen is resized, update the height and width
+            if curses.is_term_resized(self.h, self.w):
+                self.h, self.w = self.screen.getmaxyx()
+            # renders the current page
+            if self.current_page == 0:
+                self.welcome_screen()
+            elif self.current_page == 1:
+                self.summary_screen()
+            elif self.current_page == 2:
+                self.fleet_screen()
+            elif self.current_page == 3:
+                self.log_screen()
+            elif self.current_page == 4:
+                self.diagnostics_screen()
+            else:
+                self.site_info()
         return res
 
     def get_keypress(self):
@@ -101,19 +163,77 @@ class UserInterface:
 
         """
         ch = self.screen.getch()
-        if ch == curses.KEY_UP:
+        if self.typing:
+            self.type_text(ch)
+        elif ch == curses.KEY_UP:
             self.cursor = max(self.cursor - 1, 0)
         elif ch == curses.KEY_DOWN:
             self.cursor = min(self.cursor + 1, self.max_cursor)
         elif ch == ord('q') or ch == ord('Q'):
             return 'q'
+        elif ch == ord('p') or ch == ord('P'):
+            return 'p'
+        elif ch == ord('d') or ch == ord('D'):
+            return 'd'
+        elif ch == ord('e') or ch == ord('E'):
+            return 'e'
         elif ch == ord('h') or ch == ord('H'):
             self.cursor = 0
             self.current_page = 0
+        elif self.current_page == 2 and ch in (ord('s'), ord('S'), ord('r'), ord('R'), ord('/')):
+            if ch == ord('/'):
+                self.typing = 'prefix'
+            elif ch == ord('r') or ch == ord('R'):
+                self.worst_first = not self.worst_first
+            else:
+                rankings = list(RANKINGS)
+                self.ranking = rankings[(rankings.index(self.ranking) + 1) % len(rankings)]
+            self.cursor = 0
+        elif self.current_page == 3 and ch in (ord('/'), ord('t'), ord('T')):
+            self.typing = 'log_site' if ch == ord('/') else 'jump'
         elif ch == curses.KEY_ENTER or ch == 10 or ch == 13:
             if not self.current_page:
                 self.current_page = self.cursor + 1
                 self.cursor = 0
+            elif self.current_page == 2 and self.cursor < len(self.fleet_rows):
+                self.open_site(self.fleet_rows[self.cursor][1])
+
+    def type_text(self, ch):
+        """
+        Edits the text being typed: the name prefix filtering the fleet page, the website filtering the logs page
+        or the time to jump to on the logs page. Enter or escape stops the edition, and enter jumps to the time.
+
+        :param int ch: the key pressed
+        """
+        text = getattr(self, self.typing)
+        if ch in (curses.KEY_ENTER, 10, 13, 27):
+            if self.typing == 'jump':
+                t = parse_time(text) if ch != 27 else None
+                if t is not None:
+                    self.cursor = min(self.timeline.find(t, self.log_site or None), self.max_cursor)
+                self.jump = ''
+            self.typing = None
+            return
+        elif ch in (curses.KEY_BACKSPACE, 127, 8):
+            setattr(self, self.typing, text[:-1])
+        elif 32 <= ch < 127:
+            setattr(self, self.typing, text + chr(ch))
+        else:
+            return
+        if self.typing != 'jump':
+            self.cursor = 0
+
+    def open_site(self, name):
+        """
+        Shows the page of a website.
+
+        :param str name: the name of the website
+        """
+        for idx, site in enumerate(self.sites):
+            if site[0] == name:
+                self.current_page = idx + len(PAGES) + 1
+                self.cursor = 0
+                return
 
     def welcome_screen(self):
         """
@@ -133,17 +253,19 @@ class UserInterface:
         Please choose an option:
 
         |  0001 - Summary
-        |  0002 - Logs
-        |  0003 - site 1
-        |  0004 - site 2
+        |  0002 - Fleet
+        |  0003 - Logs
+        |  0004 - Diagnostics
+        |  0005 - site 1
+        |  0006 - site 2
 
         """
         #  If this screen has been changed (as in a new website has been added), recalculate the string
         if self.changed[0]:
             text = [" ________________", "|                |", "|                |", "| Site Monitorer |",
-                    "|                |", "|________________|", "", "Please choose an option:", "", "0001 - Summary",
-                    "0002 - Logs"]
-            text.extend([f"{idx + 3:04d} - {site[0]}" for idx, site in enumerate(self.sites)])
+                    "|                |", "|________________|", "", "Please choose an option:", ""]
+            text.extend([f"{idx + 1:04d} - {page}" for idx, page in enumerate(PAGES)])
+            text.extend([f"{idx + len(PAGES) + 1:04d} - {site[0]}" for idx, site in enumerate(self.sites)])
             self.changed[0] = False
             self.stored_info[0] = text
         welcome_message = self.stored_info[0]
@@ -161,7 +283,7 @@ class UserInterface:
                     self.screen.addstr(i - curs, 7, welcome_message[i], curses.color_pair(1))
                 else:
                     self.screen.addstr(i - curs, 7, welcome_message[i])
-        self.max_cursor = max(len(self.sites) + 1, 0)
+        self.max_cursor = max(len(self.sites) + len(PAGES) - 1, 0)
         #  Render
         self.screen.refresh()
 
@@ -204,71 +326,165 @@ class UserInterface:
         Renders the infos screen.
         """
         # Updates the info
-        site = self.sites[self.current_page - 3]
+        site = self.sites[self.current_page - len(PAGES) - 1]
         if self.changed[(1, site)]:
             self.update_site_info(site)
         if self.changed[(2, site)]:
             self.update_plot(site)
-        if self.changed[(3, site)]:
-            self.update_availability(site)
         # Add the info text
         text = self.stored_info[site][:]
         # Add the plots
-        if self.stored_plot[(site, 10)]:
-            text.extend(["", "", "The maximum response time over the last 60 s", "", *self.stored_plot[(site, 10)][0],
-                         "", "The average response time over the last 60 s", "", *self.stored_plot[(site, 10)][1], ""])
-        if self.stored_plot[(site, 60)]:
-            text.extend(
-                ["", "", "The maximum response time over the last 60 min", "", *self.stored_plot[(site, 60)][0],
-                 "", "The average response time over the last 60 min", "", *self.stored_plot[(site, 60)][1], ""])
-        if self.stored_plot[(site, 120)]:
-            text.extend(
-                ["", "", "The availability evolution:", "", *self.stored_plot[(site, 120)][0]])
-        #  Add the logs
-        availability = sorted(self.availability_changes[site], key=itemgetter(2))
-        if not availability:
+        for spec in self.windows:
+            for title, plot in self.stored_plot[(site, spec.key)]:
+                text.extend(["", "", f"The {title} over the last {describe_duration(spec.duration)},"
+                                     f" every {describe_duration(spec.period)}", "", *plot, ""])
+        for _, plot in self.stored_plot[(site, AVAILABILITY_KEY)]:
+            text.extend(["", "", "The availability evolution:", "", *plot])
+        #  Add the logs, only the events on screen are formatted
+        events = self.timeline.select(site[0])[1]
+        if not events:
             text.append("The website didn't go down.")
+        n = len(text)
+        self.max_cursor = max(n + len(events) - self.h, 0)
+        lines = text[self.cursor:self.cursor + self.h]
+        lines.extend([self.format_event(event)[0]
+                      for event in events[max(self.cursor - n, 0):max(self.cursor + self.h - n, 0)]])
+        for i, line in enumerate(lines):
+            self.screen.addstr(i, 5, line)
+        self.screen.refresh()
+
+    def fleet_screen(self):
+        """
+        Renders the fleet page: the average availability, the distribution of the response times over the
+        websites, and the worst (or best) websites of a ranking, optionally filtered by the start of their name.
+        """
+        window = describe_duration(self.windows[0].duration) if self.windows else ''
+        filtering = f"{self.prefix}_" if self.typing == 'prefix' else self.prefix
+        text = ["Fleet overview (s: next ranking, r: reverse the order, /: filter by name, enter: open a website)", ""]
+        availability = self.fleet.availability
+        text.append(f"Websites             : {self.fleet.count()} ({self.fleet.n_down} down)")
+        text.append("Average availability : "
+                    + (f"{100 * availability:.2f}%" if availability is not None else "--,--%"))
+        text.extend(["", f"99th percentile of the response time over the last {window}:"])
+        total = max(sum(self.fleet.bands), 1)
+        bounds = [f"< {int(1000 * b)} ms" for b in LATENCY_BANDS] + [f">= {int(1000 * LATENCY_BANDS[-1])} ms"]
+        for bound, n in zip(bounds, self.fleet.bands):
+            text.append(f"    {bound:<11}: {n:>6}  {'#' * round(40 * n / total)}")
+        title = RANKING_TITLES[self.ranking][0 if self.worst_first else 1]
+        text.extend(["", f"{title} over the last {window}" if self.ranking != 'availability' else title,
+                     f"Filter: {filtering or '(none)'} ({self.fleet.count(self.prefix)} websites)", ""])
+        self.fleet_rows = self.fleet.top(self.ranking, FLEET_TOP, self.prefix, self.worst_first)
+        self.max_cursor = max(len(self.fleet_rows) - 1, 0)
+        header = len(text)
+        for value, name in self.fleet_rows:
+            if self.ranking == 'availability':
+                formatted = f"{100 * value:10.2f}%"
+            elif self.ranking == 'p99':
+                formatted = f"{int(1000 * value):>8} ms"
+            else:
+                formatted = f"{value:>11}"
+            text.append(f"    {name[:40]:<40} {formatted}")
+        #  Scrolls so that the selected website stays on screen
+        offset = max(header + self.cursor - self.h + 1, 0)
+        for i in range(offset, min(offset + self.h, len(text))):
+            attributes = curses.color_pair(1) if self.fleet_rows and i == header + self.cursor else 0
+            self.screen.addstr(i - offset, 5, text[i][:max(self.w - 6, 0)], attributes)
+        self.screen.refresh()
+
+    def log_screen(self):
+        """
+        Renders the log screen: the events of the timeline on screen, optionally those of a single website.
+        """
+        filtering = f"{self.log_site}_" if self.typing == 'log_site' else self.log_site
+        header = ["Logs (/: filter by website, t: jump to a time)",
+                  f"Website: {filtering or '(all)'}" + (f"    Jump to: {self.jump}_" if self.typing == 'jump' else "")]
+        for i, line in enumerate(header):
+            self.screen.addstr(i, 5, line[:max(self.w - 6, 0)])
+        events = self.timeline.select(self.log_site or None)[1]
+        rows = max(self.h - len(header) - 1, 1)
+        self.max_cursor = max(len(events) - rows, 0)
+        if not events:
+            self.screen.addstr(len(header) + 1, 5, "No website went down.", curses.color_pair(2))
         else:
-            for data in availability:
-                site, stat, res = data
-                if res:
-                    if stat == 'unavailable_since':
-                        text.append(f"""site "{site[0]}" is unavailable since"""
-                                    f" {get_local_time(res).strftime('%Y-%m-%d %H:%M:%S')}")
-                    else:
-                        text.append(f"""site "{site[0]}" recovered at"""
-                                    f" {get_local_time(res).strftime('%Y-%m-%d %H:%M:%S')}")
+            for i in range(self.cursor, min(self.cursor + rows, len(events))):
+                text, color = self.format_event(events[i])
+                self.screen.addstr(i - self.cursor + len(header) + 1, 5, text[:max(self.w - 6, 0)],
+                                   curses.color_pair(color))
 
+    def diagnostics_screen(self):
+        """
+        Renders the diagnostics page: the threads, memory and time spent by the program,
+        and the requests, responses and memory of each website.
+        """
+        text = ["Diagnostics (press p to profile for a few seconds, d to save this page as JSON in the logs folder,",
+                "e to export the responses in memory to the logs folder)", ""]
+        data = self.diagnostics
+        if not data:
+            text.append("Collecting...")
+        else:
+            rss = f"{data['rss'] / 2 ** 20:.1f} MB" if data['rss'] else "--"
+            memory = data['memory']
+            budget = f", of a {memory['budget'] / 2 ** 20:.1f} MB budget" if 'budget' in memory else ""
+            used = [f"Memory of websites  : {memory['total'] / 2 ** 20:.1f} MB estimated{budget}",
+                    f"                      responses {memory['samples'] / 2 ** 20:.1f} MB, availability"
+                    f" {memory['availability'] / 2 ** 20:.1f} MB, windows {memory['buckets'] / 2 ** 20:.1f} MB,"
+                    f" histories {memory['history'] / 2 ** 20:.1f} MB"]
+            if 'budget' in memory:
+                used.append(f"                      {memory['trimmed']} websites keeping less than 10 minutes of"
+                            f" responses, {memory['history_size']} values per history")
+            text.extend([f"Threads             : {data['threads']}", f"Memory (RSS)        : {rss}", *used,
+                         f"Garbage collections : {' / '.join(map(str, data['gc_counts']))} pending per generation"])
+            probes = data['probes']
+            burstiness = f"{probes['burstiness']:.1f}" if probes['burstiness'] else "--"
+            text.extend([f"Probes in flight    : {probes['in_flight']} (peak {probes['peak_in_flight']})",
+                         f"Probes sent         : {probes['sent']}, {probes['peak_per_slot']} in the busiest"
+                         f" {int(1000 * probes['slot'])} ms for {probes['mean_per_slot']:.1f} on average"
+                         f" (burstiness {burstiness})"])
+            notifications = data.get('notifications')
+            if notifications:
+                latency = f"{1000 * notifications['avg_latency']:.0f} ms on average, up to " \
+                          f"{1000 * notifications['max_latency']:.0f} ms" if notifications['sent'] else "--"
+                text.append(f"Alerts              : {notifications['sent']} sent, {notifications['dropped']} dropped,"
+                            f" {notifications['retried']} retries, {notifications['waiting']} waiting"
+                            f" (delivered in {latency})")
+                text.append(f"Alert batches       : {notifications['batches']} queued,"
+                            f" {notifications['dropped_batches']} dropped as too many were queued")
+            text.extend(["", "Time spent per second:"])
+            for name, stats in sorted(data['timers'].items()):
+                text.append(f"    {name:<12}: {1000 * stats['per_second']:8.2f} ms  ({stats['calls']} calls,"
+                            f" longest {1000 * stats['max']:.2f} ms)")
+            profiler = data.get('profiler', {})
+            if profiler.get('running'):
+                t = TIME_FORMATTER.format(profiler['end'], date=False)
+                text.extend(["", f"Profiling until {t}, press p to stop"])
+            elif profiler.get('report'):
+                text.extend(["", f"Last profile: {profiler['report']}"])
+            text.extend(["", f"    {'Website':<30} {'In flight':>10} {'Skipped':>8} {'To consume':>11} {'To sort':>8}"
+                             f" {'Stored':>8} {'Capacity':>9} {'Memory':>10}"])
+            text.extend([f"    {site['name'][:30]:<30} {site['in_flight']:>10} {site['skipped']:>8}"
+                         f" {site['new_results']:>11} {site['pending']:>8} {site['stored']:>8} {site['capacity']:>9}"
+                         f" {site['memory'] / 2 ** 10:>7.0f} KB" for site in data['sites']])
         self.max_cursor = max(len(text) - self.h, 0)
         for i in range(self.cursor, min(self.cursor + self.h, len(text))):
-            self.screen.addstr(i - self.cursor, 5, text[i])
+            self.screen.addstr(i - self.cursor, 5, text[i][:max(self.w - 6, 0)])
         self.screen.refresh()
 
-    def log_screen(self):
+    @staticmethod
+    def format_event(event):
         """
-        Renders the log screen
+        Formats an availability change or a latency anomaly for the logs.
+
+        :param tuple event: the event, as **(website name, kind, time, description)**, see :class:`timeline.Timeline`
+        :return: the text to show and its color pair
+        :rtype: tuple
         """
-        for site in self.sites:
-            if self.changed[(3, site)]:
-                self.update_availability(site)
-        availability = sorted([x for v in self.availability_changes.values() for x in v], key=itemgetter(2))
-        self.max_cursor = max(len(availability) - self.h, 0)
-        if not availability:
-            self.screen.addstr(0, 5, "No website went down.", curses.color_pair(2))
-        else:
-            for i in range(self.cursor, min(self.cursor + self.h, len(availability))):
-                site, stat, res = availability[i]
-                if res:
-                    if stat == 'unavailable_since':
-                        self.screen.addstr(i - self.cursor, 5,
-                                           f"""site "{site[0]}" is unavailable since"""
-                                           f" {get_local_time(res).strftime('%Y-%m-%d %H:%M:%S')}",
-                                           curses.color_pair(3))
-                    else:
-                        self.screen.addstr(i - self.cursor, 5,
-                                           f"""site "{site[0]}" recovered at"""
-                                           f" {get_local_time(res).strftime('%Y-%m-%d %H:%M:%S')}",
-                                           curses.color_pair(2))
+        name, stat, res = event[:3]
+        t = TIME_FORMATTER.format(res)
+        if stat == 'unavailable_since':
+            return f"""site "{name}" is unavailable since {t}""", 3
+        if stat == 'recovered_at':
+            return f"""site "{name}" recovered at {t}""", 2
+        return f"""site "{name}" {event[3]} at {t}""", 4
 
     def update_plot(self, site):
         """
@@ -276,18 +492,21 @@ class UserInterface:
 
         :param site: the site to update
         """
-        for delay in [10, 60, 120]:
-            max_size = 10
-            timestamps = self.cum_metrics[(site, delay)]['time'][-max_size:]
-            if timestamps:
-                if delay == 120:
-                    metrics = self.cum_metrics[(site, delay)]['availability'][-max_size:]
-                    self.stored_plot[(site, 120)] = [self.get_plot(timestamps, metrics, True, max_size)]
-                else:
-                    self.stored_plot[(site, delay)] = []
-                    for stat in ['max_elapsed', 'avg_elapsed']:
-                        metrics = self.cum_metrics[(site, delay)][stat][-max_size:]
-                        self.stored_plot[(site, delay)].append(self.get_plot(timestamps, metrics, False, max_size))
+        max_size = 10
+        for key in [spec.key for spec in self.windows] + [AVAILABILITY_KEY]:
+            history = self.cum_metrics[(site, key)]
+            timestamps = history['time'][-max_size:]
+            self.stored_plot[(site, key)] = []
+            for stat in STAT_NAMES:
+                #  Only the response times and the availability shown by the window are plotted
+                if timestamps and stat not in ('codes_count', 'skipped') and len(history[stat]) >= len(timestamps):
+                    #  The windows in which every probe was skipped have no value
+                    points = [(t, v) for t, v in zip(timestamps, history[stat][-max_size:]) if v is not None]
+                    if not points:
+                        continue
+                    times, metrics = map(list, zip(*points))
+                    plot = self.get_plot(times, metrics, stat == 'availability', max_size)
+                    self.stored_plot[(site, key)].append((STAT_NAMES[stat].lower(), plot))
 
         self.changed[(2, site)] = False
 
@@ -332,7 +551,7 @@ class UserInterface:
                      f"Timeout : {site[3]}", "",
                      "Over the last 2 minutes   :", ])
         #  The availability stats
-        data = self.stored_metrics[(site, 120)]
+        data = self.stored_metrics[(site, AVAILABILITY_KEY)]
         availability = data["availability"]
         if availability is None:
             text.append(f"    Availability          : --,--%"),
@@ -341,46 +560,90 @@ class UserInterface:
         unavailable_since = data['unavailable_since']
         recovered_at = data['recovered_at']
         if unavailable_since:
-            t = get_local_time(data['unavailable_since']).strftime('%Y-%m-%d %H:%M:%S')
+            t = TIME_FORMATTER.format(data['unavailable_since'])
             text.append(f"    Website is down since : {t}"),
         elif recovered_at:
-            t = get_local_time(data['recovered_at']).strftime('%Y-%m-%d %H:%M:%S')
+            t = TIME_FORMATTER.format(data['recovered_at'])
             text.append(f"    Website recovered at  : {t}", ),
 
-        #   The stats over the last 10 minutes
-        data = self.stored_metrics[(site, 10)]
-
-        if not data:
-            text.extend(["", "Over the last 10 minutes  :", f"    Average Response Time : --",
-                         f"    Maximum Response Time : --", ])
-        else:
-            text.extend([
-                "", "Over the last 10 minutes:",
-                f"    Average Response Time : {int(1000 * data['avg_elapsed'])} ms",
-                f"    Maximum Response Time : {int(1000 * data['max_elapsed'])} ms",
-                f"    Response Code Count   :", ])
-            text.extend([f"         {k} : {v}" for k, v in data['codes_count'].items()])
-
-        #   The stats over the last hour
-        data = self.stored_metrics[(site, 60)]
-        if not data:
-            text.extend(["", "Over the last 60 minutes:", f"    Average Response Time : --",
-                         f"    Maximum Response Time : --"])
-        else:
-            text.extend(["", "Over the last 60 minutes:",
-                         f"    Average Response Time : {int(1000 * data['avg_elapsed'])} ms",
-                         f"    Maximum Response Time : {int(1000 * data['max_elapsed'])} ms",
-                         f"    Response Code Count:", ])
-            text.extend([f"         {k} : {v}" for k, v in data['codes_count'].items()])
+        #   The stats over each window
+        for spec in self.windows:
+            data = self.stored_metrics[(site, spec.key)]
+            text.extend(["", f"Over the last {describe_duration(spec.duration)}:"])
+            for stat in spec.stats:
+                value = data[stat]
+                if stat == 'codes_count':
+                    if value:
+                        text.append(f"    Response Code Count   :")
+                        text.extend([f"         {k} : {v}" for k, v in value.items()])
+                elif value is None:
+                    text.append(f"    {STAT_NAMES[stat]:<22}: --")
+                elif stat == 'availability':
+                    text.append(f"    {STAT_NAMES[stat]:<22}: {100 * value:10.2f}%")
+                elif stat == 'skipped':
+                    text.append(f"    {STAT_NAMES[stat]:<22}: {value}")
+                else:
+                    text.append(f"    {STAT_NAMES[stat]:<22}: {int(1000 * value)} ms")
         self.stored_info[site] = text
         self.changed[(1, site)] = False
 
-    def update_availability(self, site):
-        for stat in ['unavailable_since', 'recovered_at']:
-            res = self.stored_metrics[(site, 120)][stat]
-            if res and (not self.availability_changes[site] or res != self.availability_changes[site][-1][2]):
-                self.availability_changes[site].append((site, stat, res))
-        self.changed[(3, site)] = False
+    def get_availability_changes(self, site):
+        """
+        Returns the availability change of a website carried by its latest metrics, if it is new.
+
+        :param tuple site: the website
+        :return: the new events, as **(website name, kind, time, None)**
+        :rtype: list
+        """
+        changes = []
+        for stat in AVAILABILITY_KINDS:
+            res = self.stored_metrics[(site, AVAILABILITY_KEY)][stat]
+            if res and res != self.timeline.last_changes.get(site[0]):
+                changes.append((site[0], stat, res, None))
+        return changes
+
+    def get_state(self, max_size=100):
+        """
+        Copies the metrics and histories shown on screen, to be saved in a snapshot.
+
+        The events are saved in the timeline's own file instead.
+
+        :param int max_size: the number of values to keep in each history
+        :return: a JSON serializable dict, where websites are referred to by name
+        :rtype: dict
+        """
+        metrics = []
+        for (site, delay), values in list(self.cum_metrics.items()):
+            history = {k: v[-max_size:] for k, v in list(values.items())}
+            if 'codes_count' in history:
+                history['codes_count'] = [encode_metric({'codes_count': c})['codes_count']
+                                          for c in history['codes_count']]
+            metrics.append([site[0], delay, encode_metric(dict(self.stored_metrics[(site, delay)])), history])
+        return {'metrics': metrics}
+
+    def restore_state(self, state):
+        """
+        Restores the metrics and histories saved by :meth:`get_state`.
+        Websites that are not monitored anymore are ignored. The events of the snapshots saved before the timeline
+        had its own file are moved to the timeline, if it is empty.
+
+        :param dict state: the saved metrics and histories
+        """
+        sites = {site[0]: site for site in self.sites}
+        for name, delay, latest, history in state['metrics']:
+            if name in sites:
+                site = sites[name]
+                self.stored_metrics[(site, delay)].update(decode_metric(latest))
+                if 'codes_count' in history:
+                    history['codes_count'] = [decode_metric({'codes_count': c})['codes_count']
+                                              for c in history['codes_count']]
+                self.cum_metrics[(site, delay)].update(history)
+        if not len(self.timeline):
+            events = [(name, stat, res, None) for name, changes in state.get('availability_changes', [])
+                      if name in sites for stat, res in changes]
+            events.extend([(name, *a) for name, anomalies in state.get('anomalies', []) if name in sites
+                           for a in anomalies])
+            self.timeline.add(sorted(events, key=lambda event: event[2]))
 
     @staticmethod
     def get_plot(timestamps, metrics, is_availability, max_size):
@@ -442,13 +705,12 @@ class UserInterface:
             for i in range(m):
                 plot[i] = f"{(1000 * (min_val + (m - 1 - i) * step)) :6.1f} ms |" + plot[i]
         if n == 1:
-            time_axis = " " * (5 + 3 * max_size) + get_local_time(timestamps[0]).strftime('%H:%M:%S')
+            time_axis = " " * (5 + 3 * max_size) + TIME_FORMATTER.format(timestamps[0], date=False)
         elif n == 2:
-            time_axis = " " * (2 + 3 * max_size // 2) + get_local_time(timestamps[0]).strftime(
-                '%H:%M:%S') + " " * (3 * max_size // 2 - 2) + get_local_time(timestamps[-1]).strftime(
-                '%H:%M:%S')
+            first, last = TIME_FORMATTER.format_many([timestamps[0], timestamps[-1]], date=False)
+            time_axis = " " * (2 + 3 * max_size // 2) + first + " " * (3 * max_size // 2 - 2) + last
         else:
             time_axis = "   " + (" " * (3 + max_size // 2)).join(
-                [get_local_time(timestamps[idx]).strftime('%H:%M:%S') for idx in [0, n // 2, -1]])
+                TIME_FORMATTER.format_many([timestamps[idx] for idx in [0, n // 2, -1]], date=False))
         plot.append(time_axis)
         return plot
\ No newline at end of file
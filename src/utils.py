@@ -1,15 +1,28 @@
-from tzlocal import get_localzone
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 import time
-import requests
 import math
-from threading import Thread
+import socket
+from threading import Thread, Semaphore
+from urllib.parse import urlsplit
+import zlib
 
 """
 This module is for the different simple reusable classes and functions 
+
+:note: The heavier dependencies (requests, tzlocal, ssl) are imported the first time they are needed,
+    to keep the startup fast.
 """
 
-local_tz = get_localzone()
+
+@lru_cache(maxsize=None)
+def get_local_tz():
+    """
+    Returns the current time-zone. It is looked up once, the first time it is needed.
+    """
+    from tzlocal import get_localzone
+    return get_localzone()
 
 
 def get_local_time(timestamp):
@@ -19,32 +32,150 @@ def get_local_time(timestamp):
     :param timestamp: the unix time stamp
     :return: the time in the current timezone
     """
-    return local_tz.localize(datetime.fromtimestamp(timestamp))
+    return get_local_tz().localize(datetime.fromtimestamp(timestamp))
+
+
+#  The hours and minutes of each minute of a day, and the seconds of a minute, as formatted by TimeFormatter
+CLOCK_MINUTES = [f"{m // 60:02d}:{m % 60:02d}:" for m in range(1440)]
+CLOCK_SECONDS = [f"{s:02d}" for s in range(60)]
+
+
+class TimeFormatter:
+    """
+    Formats unix times in the current time-zone, much faster than formatting a :func:`get_local_time`.
+
+    The offset of the time-zone is looked up once per quarter of an hour, as the offsets only change on
+    a quarter of an hour, and the date is formatted once per day. The time of the day is assembled from
+    precomputed strings, and the milliseconds are computed arithmetically.
+
+    :param tz: the time-zone. Defaults to the current one, see :func:`get_local_tz`
+    :ivar dict offsets: the offset of the time-zone in seconds, by quarter of an hour since the epoch
+    :ivar dict dates: the formatted dates, by day since the epoch in the time-zone
+    """
+
+    def __init__(self, tz=None):
+        self.tz = tz
+        self.offsets = {}
+        self.dates = {}
+
+    def offset(self, timestamp):
+        """
+        Returns the offset of the time-zone at a given time, in seconds.
+
+        :param float timestamp: the unix time
+        :rtype: int
+        """
+        quarter = int(timestamp // 900)
+        offset = self.offsets.get(quarter)
+        if offset is None:
+            if len(self.offsets) > 10000:
+                self.offsets.clear()
+            offset = datetime.fromtimestamp(quarter * 900, self.tz or get_local_tz()).utcoffset()
+            offset = self.offsets[quarter] = int(offset.total_seconds())
+        return offset
+
+    def format(self, timestamp, date=True, ms=False):
+        """
+        Formats a unix time as **%Y-%m-%d %H:%M:%S**.
+
+        :param float timestamp: the unix time
+        :param bool date: whether to start with the date. Only the time of the day is returned otherwise
+        :param bool ms: whether to end with the milliseconds, as **.%f** truncated to 3 digits
+        :rtype: str
+        """
+        seconds = math.floor(timestamp)
+        fraction = timestamp - seconds
+        #  Rounded to the microsecond like datetime, which can round up to the next second
+        if fraction >= 0.9999995 and round(fraction * 1e6) == 1000000:
+            seconds, fraction = seconds + 1, 0
+        offset = self.offsets.get(seconds // 900)
+        if offset is None:
+            offset = self.offset(seconds)
+        day, seconds_of_day = divmod(seconds + offset, 86400)
+        text = CLOCK_MINUTES[seconds_of_day // 60] + CLOCK_SECONDS[seconds_of_day % 60]
+        if ms:
+            text += f".{round(fraction * 1e6) // 1000:03d}"
+        if not date:
+            return text
+        prefix = self.dates.get(day)
+        if prefix is None:
+            if len(self.dates) > 10000:
+                self.dates.clear()
+            prefix = self.dates[day] = time.strftime('%Y-%m-%d ', time.gmtime(day * 86400))
+        return prefix + text
+
+    def format_many(self, timestamps, date=True, ms=False):
+        """
+        Formats several unix times, see :meth:`format`.
+
+        :param timestamps: the unix times, for instance a list or a numpy array
+        :rtype: list
+        """
+        if hasattr(timestamps, 'tolist'):
+            timestamps = timestamps.tolist()
+        return [self.format(timestamp, date, ms) for timestamp in timestamps]
+
+
+TIME_FORMATTER = TimeFormatter()
+"""
+Formats the times shown on screen and written in the logs.
+"""
+
+
+def get_phase(name):
+    """
+    Returns a fraction between 0 and 1 derived from a name. It is the same every time the program runs,
+    and evenly spread over many names.
+
+    :param str name: the name, usually a website's
+    :rtype: float
+    """
+    return zlib.crc32(name.encode()) / 2 ** 32
 
 
-def get_sites(file_path):
+def get_probe_phases(sites):
     """
-    Reads the sites from an input file and returns the list of websites if no exceptions are raise.
+    Spreads the probes of the websites within their interval, so that the websites sharing an interval
+    don't all send their requests at the same time. The websites on the same host are spread evenly
+    over the interval, starting from a phase derived from the host name.
+    The phases are the same every time the program runs.
 
-    :param file_path: The path to read from
-    :return: The list of websites to monitor
+    :param list sites: the websites, as **(name, url, interval, timeout)**
+    :return: the phase of each website, as a fraction of its interval, by name
+    :rtype: dict
     """
-    s = []
-    names = set()
-    try:
-        with open(file_path, 'r') as file:
-            lines = file.read().splitlines()
-        for idx, line in enumerate(lines):
-            name, url, delay, timeout = line.split(',')
-            if name in names:
-                raise Exception('Names should be unique')
-            names.add(name)
-            s.append((name, url.strip(), float(delay), float(timeout)))
-        return s
-    except FileNotFoundError:
-        raise Exception('Could not find the file at the specified path. Please enter a valid location')
-    except (TypeError, ValueError):
-        raise Exception(f"Error at line {idx} of the input file. Format should be 'name, url, delay, timeout'")
+    hosts = {}
+    for name, url, _, _ in sites:
+        hosts.setdefault(urlsplit(url).hostname or url, []).append(name)
+    phases = {}
+    for host, names in hosts.items():
+        start = get_phase(host)
+        names.sort(key=get_phase)
+        for rank, name in enumerate(names):
+            phases[name] = (start + rank / len(names)) % 1
+    return phases
+
+
+def get_shared_probes(sites):
+    """
+    Finds the websites making the same probes: the same url, which sets the kind of probe, with the same timeout.
+    Only the website with the smallest interval of each group sends requests, and the others take their responses
+    from it.
+
+    :param list sites: the websites, as **(name, url, interval, timeout)**
+    :return: the website sending the requests, by name of the websites reading its responses
+    :rtype: dict
+    """
+    groups = {}
+    for site in sites:
+        groups.setdefault((site[1], site[3]), []).append(site)
+    shared = {}
+    for group in groups.values():
+        owner = min(group, key=itemgetter(2))
+        for site in group:
+            if site is not owner:
+                shared[site[0]] = owner
+    return shared
 
 
 def array_to_plot(array, min_val, max_val, step, repeats):
@@ -89,6 +220,85 @@ def array_to_plot(array, min_val, max_val, step, repeats):
     return [''.join(row) for row in plot]
 
 
+class TokenBucket:
+    """
+    A token bucket shared between threads to limit the rate of an action.
+
+    :param float rate: the number of tokens added per second
+    :param float capacity: the maximum number of tokens the bucket can hold, i.e. the allowed burst.
+        Defaults to **rate**
+    :ivar float tokens: the number of tokens currently available
+    :ivar Semaphore sem: a semaphore to make the bucket multi-thread safe
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.sem = Semaphore()
+
+    def consume(self, n=1):
+        """
+        Takes **n** tokens from the bucket if there are enough of them. Never blocks.
+
+        :param n: the number of tokens to take
+        :return: whether the tokens have been taken
+        :rtype: bool
+        """
+        self.sem.acquire()
+        t = time.time()
+        self.tokens = min(self.capacity, self.tokens + (t - self.last) * self.rate)
+        self.last = t
+        allowed = self.tokens >= n
+        if allowed:
+            self.tokens -= n
+        self.sem.release()
+        return allowed
+
+
+class InFlightLimit:
+    """
+    A limit on the number of requests waiting for their response at once, shared between threads.
+
+    :param int limit: the maximum number of requests in flight
+    :ivar int count: the number of requests currently in flight
+    :ivar Semaphore sem: a semaphore to make the limit multi-thread safe
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.sem = Semaphore()
+
+    def acquire(self):
+        """
+        Takes a place for a new request if the limit isn't reached. Never blocks.
+
+        :return: whether the place has been taken
+        :rtype: bool
+        """
+        self.sem.acquire()
+        allowed = self.count < self.limit
+        if allowed:
+            self.count += 1
+        self.sem.release()
+        return allowed
+
+    def release(self):
+        """
+        Gives back the place of a request that got its response.
+        """
+        self.sem.acquire()
+        self.count -= 1
+        self.sem.release()
+
+
+#  The status code of the probes skipped because too many requests were in flight. They aren't responses:
+#  they are left out of the availability and of the response times, and counted on their own
+SKIPPED = 0
+
+
 class Requester(Thread):
     """
     The base class that sends requests and adds relevant data to the queue in the right order.
@@ -104,14 +314,24 @@ class Requester(Thread):
         self.queue = queue
         self.timeout = timeout
 
+    @classmethod
+    def check_url(cls, url):
+        """
+        Checks that a url can be probed, before any probe is sent. Any url can be requested over HTTP,
+        the failures being stored as responses.
+
+        :param str url: the url to probe
+        """
+
     def run(self):
         """
         Runs the :class:`Requester` and adds the result to the queue before exiting.
-        |  If connection to the site fails, the status code is 503
+        |  If connection to the site fails, or the response can't be read, the status code is 503
         |  If the connection succeeds but times out, the status code is 408
 
         :rtype: None
         """
+        import requests
         t = time.time()
         try:
             response = requests.get(self.url, timeout=self.timeout)
@@ -120,3 +340,116 @@ class Requester(Thread):
             self.queue.add((t, 503, time.time() - t))
         except requests.exceptions.ReadTimeout:
             self.queue.add((t, 408, self.timeout))
+        except requests.exceptions.RequestException:
+            #  Invalid responses, too many redirects... The request is always accounted for
+            self.queue.add((t, 503, time.time() - t))
+
+
+class TcpRequester(Requester):
+    """
+    A cheaper probe that only opens a TCP connection to the target and closes it right away.
+    The url should be of the form **tcp://host:port**.
+
+    |  If the connection is established, the status code is 210
+    |  If the connection is refused or fails, the status code is 503
+    |  If the connection times out, the status code is 408
+    """
+
+    #  The port probed when the url has none. The url must have one if None
+    default_port = None
+
+    def __init__(self, url, queue, timeout):
+        super(TcpRequester, self).__init__(url, queue, timeout)
+        self.host, self.port = self.check_url(url)
+
+    @classmethod
+    def check_url(cls, url):
+        """
+        Reads the host and the port to connect to.
+
+        :param str url: the url to probe
+        :return: the host and the port
+        :rtype: tuple
+        :raises ValueError: if the url has no host, an invalid port, or no port and the probe has no default port
+        """
+        parsed = urlsplit(url)
+        try:
+            port = parsed.port
+        except ValueError:
+            raise ValueError(f"Invalid port in {url}, it should be a number between 0 and 65535")
+        if not parsed.hostname:
+            raise ValueError(f"No host in {url}, it should be of the form {parsed.scheme}://host:port")
+        port = port or cls.default_port
+        if port is None:
+            raise ValueError(f"No port in {url}, it should be of the form {parsed.scheme}://host:port")
+        return parsed.hostname, port
+
+    def run(self):
+        """
+        Opens a connection to the target and adds the result to the queue before exiting.
+
+        :rtype: None
+        """
+        t = time.time()
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except socket.timeout:
+            self.queue.add((t, 408, self.timeout))
+        except OSError:
+            self.queue.add((t, 503, time.time() - t))
+        else:
+            self.queue.add((t, 210, time.time() - t))
+            sock.close()
+
+
+class TlsRequester(TcpRequester):
+    """
+    A probe that opens a TCP connection and completes a TLS handshake without sending any request.
+    The url should be of the form **tls://host[:port]**, the port defaults to 443.
+
+    |  If the handshake completes, the status code is 211
+    |  If the handshake fails (bad certificate, protocol error...), the status code is 525
+    |  If the connection is refused or fails, the status code is 503
+    |  If the connection or the handshake times out, the status code is 408
+    """
+
+    context = None
+    default_port = 443
+
+    def run(self):
+        """
+        Opens a connection, does the TLS handshake and adds the result to the queue before exiting.
+
+        :rtype: None
+        """
+        import ssl
+        #  Loading the certificates is slow, so the context is created once and shared by all the probes
+        if TlsRequester.context is None:
+            TlsRequester.context = ssl.create_default_context()
+        t = time.time()
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+                with self.context.wrap_socket(sock, server_hostname=self.host):
+                    self.queue.add((t, 211, time.time() - t))
+        except socket.timeout:
+            self.queue.add((t, 408, self.timeout))
+        except ssl.SSLError:
+            self.queue.add((t, 525, time.time() - t))
+        except OSError:
+            self.queue.add((t, 503, time.time() - t))
+
+
+PROBES = {'http': Requester, 'https': Requester, 'tcp': TcpRequester, 'tls': TlsRequester}
+"""
+The probe class to use for each url scheme.
+"""
+
+
+def get_requester(url):
+    """
+    Returns the probe class matching the url's scheme. Urls without a known scheme are probed over HTTP.
+
+    :param str url: the url to probe
+    :return: the :class:`Requester` subclass to use
+    """
+    return PROBES.get(urlsplit(url).scheme.lower(), Requester)
@@ -0,0 +1,213 @@
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+from threading import Thread
+import logging
+import time
+from src.fixed_size import ColumnarQueue
+from src.utils import SKIPPED
+from src.windows import get_skipped_stats
+
+"""
+This module computes the metrics of the time windows of many websites in separate processes,
+so that the burst of computations every 10 and 60 seconds doesn't slow down the probes and the user interface.
+"""
+
+logger = logging.getLogger()
+
+#  The time in seconds during which the window requests are gathered into a single batch
+BATCH_PERIOD = 0.1
+
+
+def compute_windows(name, n, layout):
+    """
+    Computes the metrics of several windows whose responses are in a shared memory block.
+    Runs in the worker processes, with numpy if it is installed.
+
+    :param str name: the name of the shared memory block. It holds the elapsed times of all the windows
+        (float32) followed by their status codes (int16)
+    :param int n: the total number of responses in the block
+    :param list layout: the offset, number of responses and percentiles of each window to compute. The
+        percentiles are statistics among **windows.STATS**, such as **p99**
+    :return: the availability, codes count, skipped probes, maximum, average and percentiles of the response
+        times of each window, or None for the windows without probes. The availability and the response times are
+        None if every probe was skipped
+    :rtype: list
+    """
+    block = shared_memory.SharedMemory(name)
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    elapsed = block.buf[:4 * n].cast('f')
+    codes = block.buf[4 * n:6 * n].cast('h')
+    results = []
+    for offset, count, percentiles in layout:
+        stats = None
+        if np:
+            #  The arrays are views over the shared memory, nothing is copied unless probes were skipped
+            window_codes = np.frombuffer(codes, np.int16, count, 2 * offset)
+            window = np.frombuffer(elapsed, np.float32, count, 4 * offset)
+            values, counts = np.unique(window_codes, return_counts=True)
+            codes_count = Counter(dict(zip(values.tolist(), counts.tolist())))
+            skipped = codes_count.pop(SKIPPED, 0)
+            measured = window[window_codes != SKIPPED] if skipped else window
+            if len(measured):
+                availability = int(counts[(values != SKIPPED) & (values < 400)].sum()) / len(measured)
+                stats = {'availability': availability, 'codes_count': codes_count, 'skipped': skipped,
+                         'max_elapsed': float(measured.max()), 'avg_elapsed': float(measured.mean(dtype='float64'))}
+                quantiles = np.quantile(measured, [int(stat[1:]) / 100 for stat in percentiles])
+                stats.update(zip(percentiles, quantiles.tolist()))
+            elif skipped:
+                stats = get_skipped_stats(skipped, percentiles)
+            del window_codes, window, measured
+        else:
+            window_codes = codes[offset:offset + count]
+            window = elapsed[offset:offset + count]
+            codes_count = Counter(window_codes)
+            skipped = codes_count.pop(SKIPPED, 0)
+            measured = [e for c, e in zip(window_codes, window) if c != SKIPPED] if skipped else window
+            if len(measured):
+                availability = sum([v for k, v in codes_count.items() if k < 400]) / len(measured)
+                stats = {'availability': availability, 'codes_count': codes_count, 'skipped': skipped,
+                         'max_elapsed': max(measured), 'avg_elapsed': sum(measured) / len(measured)}
+                ordered = sorted(measured)
+                for stat in percentiles:
+                    stats[stat] = ordered[int(int(stat[1:]) / 100 * (len(ordered) - 1))]
+            elif skipped:
+                stats = get_skipped_stats(skipped, percentiles)
+            del measured
+            window_codes.release()
+            window.release()
+        results.append(stats)
+    elapsed.release()
+    codes.release()
+    block.close()
+    return results
+
+
+class WindowPool(Thread):
+    """
+    Gathers the windows the site monitors need computed, and computes them by batches in a pool of processes.
+    The responses of a batch are copied once into a shared memory block, which the workers read without copy.
+    The metrics are published back to each monitor as soon as its batch is done.
+
+    The windows are computed from the stored responses, so they can't be longer than the queue of responses.
+    They offer the availability, codes count, skipped probes, average and maximum of the response times, their
+    99th percentile, and the other percentiles chosen in their spec.
+    The pool helps the most when the responses are stored as tuples, whose metrics are slow to compute in
+    Python. With a :class:`fixed_size.ColumnarQueue`, the metrics are already cheap to compute in place.
+    The response times are sent as float32, which is more than enough for metrics in milliseconds.
+
+    :param int workers: the number of worker processes
+    :ivar deque requests: the windows to compute, as **(monitor, key)**
+    :ivar ProcessPoolExecutor executor: the pool of processes
+    """
+
+    def __init__(self, workers):
+        super().__init__(daemon=True)
+        self.workers = workers
+        self.requests = deque()
+        self.executor = None
+        self.set_stop = False
+
+    def submit(self, monitor, key):
+        """
+        Asks for the metrics of a window to be computed. They are published with
+        :meth:`site_monitor.SiteMonitor.publish_metrics` once ready.
+
+        :param site_monitor.SiteMonitor monitor: the monitor whose window to compute
+        :param key: the key of the window
+        """
+        self.requests.append((monitor, key))
+
+    def run(self):
+        #  Forking a program with many threads is unsafe, the workers are started from scratch instead
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+        logger.info(f"Window pool started with {self.workers} processes")
+        while not self.set_stop:
+            time.sleep(BATCH_PERIOD)
+            batch = []
+            while self.requests:
+                batch.append(self.requests.popleft())
+            if batch:
+                self.compute(batch)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def compute(self, batch):
+        """
+        Copies the responses of the windows in a shared memory block and splits the computation between
+        the workers.
+
+        :param list batch: the windows to compute, as **(monitor, key)**
+        """
+        columns = [get_window_columns(monitor, key) for monitor, key in batch]
+        n = sum([len(codes) for codes, _ in columns])
+        block = shared_memory.SharedMemory(create=True, size=max(6 * n, 1))
+        layout = []
+        offset = 0
+        for (monitor, key), (codes, elapsed) in zip(batch, columns):
+            count = len(codes)
+            block.buf[4 * offset:4 * (offset + count)] = memoryview(elapsed).cast('B')
+            block.buf[4 * n + 2 * offset:4 * n + 2 * (offset + count)] = memoryview(codes).cast('B')
+            #  The 99th percentile is always computed, it is the health of the website, see SiteMonitor.get_health
+            percentiles = sorted({'p99', *[stat for stat in monitor.windows[key].stats if stat.startswith('p')]})
+            layout.append((offset, count, percentiles))
+            offset += count
+        chunk = -(-len(batch) // self.workers)
+        futures = []
+        for i in range(0, len(batch), chunk):
+            future = self.executor.submit(compute_windows, block.name, n, layout[i:i + chunk])
+            future.add_done_callback(lambda f, requests=batch[i:i + chunk]: self.publish(requests, f))
+            futures.append(future)
+        Thread(target=self.release, args=(block, futures), daemon=True).start()
+
+    @staticmethod
+    def publish(requests, future):
+        """
+        Hands the computed metrics to the monitors. A failed batch is published as empty windows,
+        which the monitors ask for again at their next update.
+        """
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.warning(f"Could not compute the metrics of {len(requests)} windows: {e}")
+            results = [None] * len(requests)
+        for (monitor, key), stats in zip(requests, results):
+            monitor.publish_metrics(key, stats)
+
+    @staticmethod
+    def release(block, futures):
+        """
+        Frees the shared memory block once every worker is done with it.
+        """
+        for future in futures:
+            try:
+                future.exception()
+            except Exception:
+                pass
+        block.close()
+        block.unlink()
+
+    def stop(self):
+        self.set_stop = True
+
+
+def get_window_columns(monitor, key):
+    """
+    Gets the status codes and elapsed times of the responses of a monitor's window, as arrays.
+
+    :param site_monitor.SiteMonitor monitor: the monitor
+    :param key: the key of the window
+    :return: the status codes (int16) and the elapsed times (float32)
+    :rtype: tuple
+    """
+    spec = monitor.windows[key]
+    start, end = monitor.get_window(monitor.last_updates[key], spec.duration, spec.period)
+    results = monitor.request_scheduler.results
+    if isinstance(results, ColumnarQueue):
+        _, codes, elapsed = results.get_columns(start, end)
+        return codes, elapsed
+    responses = results.get_slice(start, end)
+    return array('h', [r[1] for r in responses]), array('f', [r[2] for r in responses])
@@ -0,0 +1,319 @@
+from collections import Counter, deque
+from functools import reduce
+from math import gcd, floor
+import json
+from src.summary import WindowSummary, encode_summaries, decode_summaries
+from src.utils import SKIPPED
+
+"""
+This module contains the time windows over which the metrics of the websites are computed,
+and the engine computing all of them in a single pass over the responses.
+"""
+
+#  The statistics a window can show. pXX is the XXth percentile of the response time, and skipped the number
+#  of probes not sent because too many requests were in flight
+STATS = ('availability', 'codes_count', 'avg_elapsed', 'max_elapsed', 'p50', 'p90', 'p95', 'p99', 'skipped')
+DEFAULT_STATS = ('avg_elapsed', 'max_elapsed', 'codes_count', 'skipped')
+#  The key of the availability reported by the monitors, which isn't computed over a window
+AVAILABILITY_KEY = 120
+
+
+class WindowSpec:
+    """
+    A time window over which metrics are computed periodically.
+
+    :param int period: the time in seconds between two updates of the metrics
+    :param int duration: the length of the window in seconds
+    :param list stats: the statistics to compute, among **STATS**
+    :param key: the key of the window's metrics. Defaults to **period**
+    """
+
+    def __init__(self, period, duration, stats=DEFAULT_STATS, key=None):
+        if int(period) != period or int(duration) != duration or period <= 0 or duration <= 0:
+            raise ValueError("The period and the duration of a window should be a positive number of seconds")
+        unknown = set(stats) - set(STATS)
+        if unknown:
+            raise ValueError(f"Unknown statistics {', '.join(sorted(unknown))}. Choose among {', '.join(STATS)}")
+        self.period = int(period)
+        self.duration = int(duration)
+        self.stats = tuple(stats)
+        self.key = period if key is None else key
+
+    def __repr__(self):
+        return f"WindowSpec({self.period}, {self.duration}, {self.stats}, {self.key})"
+
+
+DEFAULT_WINDOWS = (WindowSpec(10, 600), WindowSpec(60, 3600))
+"""
+The metrics over the last 10 minutes updated every 10 seconds, and over the last hour updated every minute.
+"""
+
+
+def check_windows(windows):
+    """
+    Checks that the keys of the windows are unique and don't clash with the availability.
+
+    :param list windows: the windows to check
+    :raises ValueError: if two windows share a key
+    """
+    keys = [spec.key for spec in windows]
+    if len(set(keys)) != len(keys) or AVAILABILITY_KEY in keys or 'anomalies' in keys:
+        raise ValueError(f"Each window needs a unique key, other than {AVAILABILITY_KEY} and 'anomalies'. "
+                         f"Set a key to the windows sharing a period")
+
+
+def load_windows(path):
+    """
+    Reads the windows from a JSON file, made of a list of objects with a **period**, a **duration**, and optionally
+    a list of **stats** and a **key**. For instance:
+
+    .. code-block:: json
+
+        [{"period": 10, "duration": 60, "stats": ["avg_elapsed", "p99"]},
+         {"period": 600, "duration": 86400, "key": "day"}]
+
+    :param str path: the path of the file
+    :rtype: list
+    """
+    with open(path) as file:
+        config = json.load(file)
+    windows = [WindowSpec(w['period'], w['duration'], w.get('stats', DEFAULT_STATS), w.get('key')) for w in config]
+    check_windows(windows)
+    return windows
+
+
+def get_skipped_stats(skipped, stats=()):
+    """
+    Returns the statistics of a window in which every probe was skipped: the skipped probes are counted, while the
+    availability and the response times are unknown.
+
+    :param int skipped: the number of skipped probes
+    :param list stats: the statistics of the window, among **STATS**
+    :rtype: dict
+    """
+    unknown = {stat: None for stat in ('availability', 'avg_elapsed', 'max_elapsed', 'p99', *stats)}
+    return {**unknown, 'codes_count': Counter(), 'skipped': skipped}
+
+
+def describe_duration(seconds):
+    """
+    Formats a duration for the user, in the largest unit it is a multiple of.
+
+    :param int seconds: the duration
+    :rtype: str
+    """
+    for unit, length in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= length and seconds % length == 0:
+            n = seconds // length
+            return f"{n} {unit}s" if n > 1 else unit
+    return f"{seconds} seconds" if seconds != 1 else "second"
+
+
+class WindowEngine:
+    """
+    Computes the metrics of several windows of the same website in a single pass over its responses.
+
+    Every response is added once to the summary of the time bucket it falls in. Each window keeps a running
+    summary of its buckets: when it is updated, the buckets that entered the window are merged into it and the
+    ones that left it are taken out, so an update costs the number of buckets elapsed since the last one,
+    whatever the number of responses or the length of the window.
+    The buckets are as long as the greatest common divisor of the periods and durations of the windows.
+
+    :param list windows: the windows to compute
+    :param float origin: a time at which a bucket starts
+    :ivar int resolution: the length of the buckets in seconds
+    :ivar dict buckets: the summary of each bucket holding responses, by index
+    :ivar dict running: the running summary of each window, by key
+    :ivar dict ranges: the indexes of the first bucket and the bucket after the last one in each running summary
+    :ivar dict maxima: the buckets of each window that can still hold its maximum response time, as
+        **(index, max_elapsed)**, by key. Their maxima decrease, so the first one is the maximum of the window
+    :ivar int expired: the index before which the buckets have been dropped. Older responses are ignored
+    """
+
+    def __init__(self, windows, origin=0):
+        self.windows = {spec.key: spec for spec in windows}
+        self.resolution = reduce(gcd, [n for spec in windows for n in (spec.period, spec.duration)])
+        self.origin = origin
+        self.buckets = {}
+        self.running = {key: WindowSummary(0, 0) for key in self.windows}
+        self.ranges = {key: None for key in self.windows}
+        self.maxima = {key: deque() for key in self.windows}
+        self.expired = None
+
+    def index(self, t):
+        return floor((t - self.origin) / self.resolution)
+
+    def add(self, t, code, elapsed):
+        """
+        Adds a response.
+
+        :param float t: the time the request was sent
+        :param int code: the status code
+        :param float elapsed: the response time
+        """
+        index = self.index(t)
+        bucket = self.get_bucket(index)
+        if bucket:
+            bucket.add(code, elapsed)
+            for key in self.late_windows(index):
+                self.running[key].add(code, elapsed)
+                self.push_maximum(key, index, bucket.max_elapsed)
+
+    def add_summary(self, summary):
+        """
+        Adds the responses of a summary, for instance one received from an agent, to the bucket of its start.
+
+        :param summary.WindowSummary summary: the summary
+        """
+        index = self.index(summary.start)
+        bucket = self.get_bucket(index)
+        if bucket:
+            bucket.merge(summary)
+            for key in self.late_windows(index):
+                self.running[key].merge(summary)
+                self.push_maximum(key, index, bucket.max_elapsed)
+
+    def get_bucket(self, index):
+        """
+        Returns the summary of a bucket, created if needed, or None if the bucket has been dropped.
+
+        :param int index: the index of the bucket
+        :rtype: Union[WindowSummary,None]
+        """
+        if self.expired is not None and index < self.expired:
+            return None
+        bucket = self.buckets.get(index)
+        if bucket is None:
+            start = self.origin + index * self.resolution
+            bucket = self.buckets[index] = WindowSummary(start, start + self.resolution)
+        return bucket
+
+    def late_windows(self, index):
+        """
+        Returns the keys of the windows whose running summary already includes a bucket.
+        The responses arriving late in such a bucket are added to these summaries too.
+
+        :param int index: the index of the bucket
+        :rtype: list
+        """
+        return [key for key, included in self.ranges.items() if included and included[0] <= index < included[1]]
+
+    def push_maximum(self, key, index, max_elapsed):
+        """
+        Updates the maxima of a window with the maximum response time of a bucket. The buckets before it with a lower
+        maximum can't hold the maximum of the window anymore, and are dropped.
+
+        :param key: the key of the window
+        :param int index: the index of the bucket
+        :param float max_elapsed: the maximum response time of the bucket
+        """
+        maxima = self.maxima[key]
+        if not maxima or index > maxima[-1][0]:
+            while maxima and maxima[-1][1] <= max_elapsed:
+                maxima.pop()
+            maxima.append((index, max_elapsed))
+            return
+        #  A response arrived late in a bucket already included
+        later = [(i, m) for i, m in maxima if i > index]
+        if later and later[0][1] >= max_elapsed:
+            return
+        earlier = [(i, m) for i, m in maxima if i < index and m > max_elapsed]
+        self.maxima[key] = deque(earlier + [(index, max_elapsed)] + later)
+
+    def evaluate(self, key, end):
+        """
+        Computes the metrics of a window ending at **end**. The end is rounded down to the start of its bucket.
+
+        :param key: the key of the window
+        :param float end: the end of the window
+        :return: the statistics of the window, along with its availability, codes count, skipped probes, average,
+            maximum and 99th percentile of the response times, or None if it holds no probe. The availability
+            and the response times are None if every probe was skipped
+        :rtype: dict
+        """
+        spec = self.windows[key]
+        #  Ends falling on a bucket boundary shouldn't be rounded down by a floating point error
+        high = self.index(end + 1e-6)
+        low = high - spec.duration // self.resolution
+        if self.ranges[key] is None or high < self.ranges[key][1]:
+            #  The first update, or the clock went back: the window is computed from scratch
+            self.running[key] = WindowSummary(0, 0)
+            self.ranges[key] = (low, low)
+            self.maxima[key] = deque()
+        running = self.running[key]
+        old_low, old_high = self.ranges[key]
+        for index in range(old_low, min(low, old_high)):
+            if index in self.buckets:
+                running.remove(self.buckets[index])
+        for index in range(max(old_high, low), high):
+            if index in self.buckets:
+                running.merge(self.buckets[index])
+                self.push_maximum(key, index, self.buckets[index].max_elapsed)
+        maxima = self.maxima[key]
+        while maxima and maxima[0][0] < low:
+            maxima.popleft()
+        self.ranges[key] = (low, high)
+        self.expire()
+        codes_count = +running.codes_count
+        skipped = codes_count.pop(SKIPPED, 0)
+        if not running.count:
+            return get_skipped_stats(skipped, spec.stats) if skipped else None
+        stats = {'availability': running.availability, 'skipped': skipped, 'codes_count': codes_count,
+                 'avg_elapsed': running.avg_elapsed,
+                 'max_elapsed': maxima[0][1],
+                 'p99': running.quantile(0.99)}
+        for stat in spec.stats:
+            if stat.startswith('p'):
+                stats[stat] = running.quantile(int(stat[1:]) / 100)
+        return stats
+
+    def get_state(self):
+        """
+        Copies the buckets and the running summaries, to be saved in a snapshot.
+
+        :return: a JSON serializable dict holding the windows and their ranges, and the running summaries of the
+            windows followed by the buckets, encoded with :func:`summary.encode_summaries`
+        :rtype: tuple
+        """
+        windows = [[key, spec.period, spec.duration, self.ranges[key], list(self.maxima[key])]
+                   for key, spec in self.windows.items()]
+        state = {'resolution': self.resolution, 'origin': self.origin, 'expired': self.expired, 'windows': windows}
+        summaries = [self.running[key] for key in self.windows] + [self.buckets[i] for i in sorted(self.buckets)]
+        return state, encode_summaries(summaries)
+
+    def restore_state(self, state, summaries):
+        """
+        Restores the buckets and the running summaries saved by :meth:`get_state`. The running summaries of the
+        windows whose period or duration changed since are computed again from the buckets at their next update.
+
+        :param dict state: the windows and their ranges
+        :param summaries: the encoded running summaries and buckets
+        :return: whether the buckets were restored, which requires buckets of the same length
+        :rtype: bool
+        """
+        if state['resolution'] != self.resolution:
+            return False
+        summaries = decode_summaries(summaries)
+        n = len(state['windows'])
+        self.origin = state['origin']
+        self.expired = state['expired']
+        self.buckets = {round((bucket.start - self.origin) / self.resolution): bucket for bucket in summaries[n:]}
+        for (key, period, duration, included, maxima), running in zip(state['windows'], summaries[:n]):
+            spec = self.windows.get(key)
+            if spec and (spec.period, spec.duration) == (period, duration) and included:
+                self.running[key] = running
+                self.ranges[key] = tuple(included)
+                self.maxima[key] = deque([tuple(maximum) for maximum in maxima])
+        return True
+
+    def expire(self):
+        """
+        Drops the buckets that are behind every window.
+        """
+        if not all(self.ranges.values()):
+            return
+        oldest = min([included[0] for included in self.ranges.values()])
+        start = min(self.buckets, default=oldest) if self.expired is None else self.expired
+        for index in range(start, oldest):
+            self.buckets.pop(index, None)
+        self.expired = max(oldest, start)
@@ -0,0 +1,495 @@
+import unittest
+import random
+import socket
+import subprocess
+import sys
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from operator import itemgetter
+from threading import Thread
+from types import SimpleNamespace
+from src.fixed_size import FixedSizeQueue, ColumnarQueue
+from src.global_monitor import GlobalMonitor
+from src.site_monitor import SiteMonitor, RequestScheduler
+from src.diagnostics import PROBE_ACTIVITY
+from src.utils import get_phase, get_probe_phases, get_local_time, TimeFormatter
+from src.window_pool import WindowPool
+from src.windows import WindowSpec
+from src.fleet import FleetIndex
+from src.storage import SQLiteStore
+from src.export import export_logs, load_npz
+from src.timeline import Timeline
+from src.sites import SitesReader, get_sites
+from src.simulator import Simulation, Target, VirtualClock
+from src.memory import get_usage
+from src.snapshot import write_snapshot, load_snapshot
+
+
+class LockedQueue(FixedSizeQueue):
+    """
+    The queue as it was before the hand-off deque: every insertion takes the semaphore.
+    """
+
+    def add(self, e):
+        self.sem.acquire()
+        val = self.key(e)
+        for i in range(len(self.items) - 1, -1, -1):
+            if val >= self.key(self.items[i]):
+                self.items.insert(i + 1, e)
+                break
+        else:
+            self.items.insert(0, e)
+        if len(self.items) > self.capacity:
+            self.items = self.items[-self.capacity:]
+        self.sem.release()
+
+
+class StartupBenchmark(unittest.TestCase):
+    def test_lazy_imports(self):
+        code = "import sys, time; t = time.time(); import main; print(time.time() - t); " \
+               "print(' '.join(m for m in ('requests', 'tzlocal', 'curses', 'ssl') if m in sys.modules))"
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        import_time, heavy_modules = (out.splitlines() + [''])[:2]
+        print(f"\nImporting main took {1000 * float(import_time):.1f} ms")
+        self.assertEqual(heavy_modules, '')
+        self.assertLess(float(import_time), 0.5)
+
+    def test_time_to_first_probe(self):
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(1024)
+        port = server.getsockname()[1]
+        sites = [(f'site {i}', f'tcp://localhost:{port}', 0.05, 1) for i in range(2000)]
+        t = time.time()
+        monitor = GlobalMonitor(sites, tempfile.mkdtemp())
+        monitor.start_monitoring()
+        while monitor.first_probe is None and time.time() - t < 5:
+            time.sleep(0.001)
+        first_probe = monitor.first_probe
+        monitor.stop()
+        server.close()
+        print(f"\nFirst request sent {1000 * (first_probe - t):.1f} ms after the monitor was created")
+        self.assertLess(first_probe - t, 0.5)
+
+    def test_large_sites_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sites.txt')
+        with open(path, 'w') as file:
+            file.write(''.join([f"site {i}, https://host{i % 500}.example.com/{i}, 60, 5\n" for i in range(100000)]))
+        t = time.time()
+        first_chunk = next(iter(SitesReader(path)))
+        first_chunk_time = time.time() - t
+        t = time.time()
+        sites = get_sites(path)
+        total_time = time.time() - t
+        print(f"\nThe first {len(first_chunk)} websites are read in {1000 * first_chunk_time:.1f} ms, "
+              f"all {len(sites)} in {1000 * total_time:.1f} ms")
+        self.assertEqual(sites[:len(first_chunk)], first_chunk)
+        self.assertLess(20 * first_chunk_time, total_time)
+
+
+class ContentionBenchmark(unittest.TestCase):
+    def run_writers(self, queue, n_writers, n_adds=20000):
+        """
+        Adds **n_adds** elements to the queue from **n_writers** threads, while another thread reads slices.
+
+        :return: the number of elements added per second
+        """
+        def write():
+            for _ in range(n_adds // n_writers):
+                queue.add((time.time(), 200, 0.1))
+
+        def read():
+            while writers[-1].is_alive():
+                now = time.time()
+                queue.get_slice(now - 10, now)
+                time.sleep(0.001)
+
+        writers = [Thread(target=write) for _ in range(n_writers)]
+        reader = Thread(target=read)
+        t = time.time()
+        for writer in writers:
+            writer.start()
+        reader.start()
+        for writer in writers:
+            writer.join()
+        elapsed = time.time() - t
+        reader.join()
+        return n_adds / elapsed
+
+    def test_writers(self):
+        for n_writers in (1, 8, 64):
+            locked = self.run_writers(LockedQueue(5000, key=itemgetter(0)), n_writers)
+            queue = FixedSizeQueue(5000, key=itemgetter(0))
+            handoff = self.run_writers(queue, n_writers)
+            print(f"\n{n_writers} writers: {locked:.0f} adds/s with a lock, {handoff:.0f} adds/s with the hand-off")
+            self.assertEqual(len(queue), 5000)
+            self.assertListEqual(queue.h, sorted(queue.h, key=itemgetter(0)))
+            self.assertGreaterEqual(handoff, locked)
+
+
+class ColumnarBenchmark(unittest.TestCase):
+    def fill(self, columnar, n=60000):
+        """
+        Fills the queue of a monitor with **n** responses, as a website pinged every 0.01 s would.
+
+        :return: the monitor and the memory taken by its responses, in bytes
+        """
+        #  Imports numpy beforehand, so that only the memory of the responses is measured
+        ColumnarQueue(1)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        monitor = SiteMonitor('test', 'http://localhost', 0.01, 1, columnar=columnar)
+        for i in range(n):
+            monitor.request_scheduler.results.add((1000 + i / 100, 200 if i % 10 else 500, 0.1 + i % 7 / 100))
+        len(monitor.request_scheduler.results)
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return monitor, memory
+
+    def test_memory_and_metrics(self):
+        timings = {}
+        for columnar in (False, True):
+            monitor, memory = self.fill(columnar)
+            t = time.time()
+            for _ in range(10):
+                metrics = monitor.get_metrics(1601, 600, 0)
+            timings[columnar] = (memory, (time.time() - t) / 10)
+            print(f"\n{'columnar' if columnar else 'tuples'}: {memory / 60000:.1f} bytes per response, "
+                  f"{1000 * timings[columnar][1]:.1f} ms per window")
+            self.assertEqual(sum(metrics[1].values()), 60000)
+        self.assertLess(5 * timings[True][0], timings[False][0])
+        self.assertLess(timings[True][1], timings[False][1])
+
+
+class WindowPoolBenchmark(unittest.TestCase):
+    def burst(self, monitors, pool):
+        """
+        Updates the 10 minutes window of every monitor at once, while a thread measures how late it wakes up.
+
+        :return: the time to publish every window, and the longest delay of the ticking thread, in seconds
+        """
+        delays = []
+
+        def tick():
+            while not done:
+                t = time.perf_counter()
+                time.sleep(0.001)
+                delays.append(time.perf_counter() - t - 0.001)
+
+        done = False
+        ticker = Thread(target=tick)
+        ticker.start()
+        t = time.time()
+        for monitor in monitors:
+            monitor.window_pool = pool
+            monitor.metrics.pop(10, None)
+            monitor.update_metrics(10)
+        while any(10 not in monitor.metrics for monitor in monitors):
+            time.sleep(0.001)
+        elapsed = time.time() - t
+        done = True
+        ticker.join()
+        return elapsed, max(delays)
+
+    def test_burst(self):
+        pool = WindowPool(4)
+        pool.start()
+        for columnar in (False, True):
+            monitors = []
+            for i in range(500):
+                monitor = SiteMonitor(f'site {i}', 'http://localhost', 0.1, 1, columnar=columnar)
+                end = monitor.last_updates[10]
+                responses = [(end - j / 10, 200 if j % 9 else 500, j % 13 / 100) for j in range(6000)]
+                monitor.request_scheduler.results.add_many(responses)
+                len(monitor.request_scheduler.results)
+                for response in responses:
+                    monitor.engine.add(*response)
+                monitors.append(monitor)
+            self.burst(monitors[:10], pool)
+            for name, window_pool in (('window engine', None), ('window pool', pool)):
+                elapsed, stall = self.burst(monitors, window_pool)
+                print(f"\n{'columnar' if columnar else 'tuples'}, {name}: {1000 * elapsed:.0f} ms to compute"
+                      f" 500 windows, the other threads stalled up to {1000 * stall:.1f} ms")
+        pool.stop()
+        #  The windows of the websites are due at different times, so they reach the pool a few at a time rather
+        #  than all at once every period
+        clock = VirtualClock()
+        submitted = Counter()
+
+        def submit(monitor, key):
+            submitted[round(clock() * 10)] += 1
+            monitor.publish_metrics(key, None)
+
+        pool = SimpleNamespace(submit=submit)
+        peaks = {}
+        for staggered in (False, True):
+            submitted.clear()
+            monitors = [SiteMonitor(f'site {i}', 'http://localhost', 1, 1, window_pool=pool, clock=clock,
+                                    phase=get_phase(f'site {i}') if staggered else 0, windows=[WindowSpec(10, 600)])
+                        for i in range(500)]
+            for _ in range(600):
+                clock.now += 0.1
+                for monitor in monitors:
+                    monitor.step()
+            peaks[staggered] = max(submitted.values())
+            mean = sum(submitted.values()) / 600
+            print(f"\n{'staggered' if staggered else 'synchronized'}: up to {peaks[staggered]} windows submitted"
+                  f" in 100 ms, for {mean:.1f} on average")
+        self.assertEqual(peaks[False], 500)
+        self.assertLessEqual(peaks[True], 4 * mean)
+
+
+class StaggerBenchmark(unittest.TestCase):
+    def test_burstiness(self):
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(1024)
+        url = f'tcp://localhost:{server.getsockname()[1]}'
+        sites = [(f'site {i}', url, 0.5, 1) for i in range(300)]
+
+        def accept():
+            while True:
+                try:
+                    server.accept()[0].close()
+                except OSError:
+                    break
+
+        Thread(target=accept, daemon=True).start()
+        phases = get_probe_phases(sites)
+        results = {}
+        for staggered in (False, True):
+            schedulers = [RequestScheduler(0.5, url, 1, phase=phases[name] if staggered else 0)
+                          for name, *_ in sites]
+            for scheduler in schedulers:
+                scheduler.start()
+            time.sleep(1)
+            PROBE_ACTIVITY.read()
+            time.sleep(3)
+            results[staggered] = PROBE_ACTIVITY.read()
+            for scheduler in schedulers:
+                scheduler.stop()
+            time.sleep(1.5)
+            stats = results[staggered]
+            print(f"\n{'staggered' if staggered else 'synchronized'}: {stats['sent']} probes, up to"
+                  f" {stats['peak_per_slot']} in 100 ms for {stats['mean_per_slot']:.1f} on average,"
+                  f" up to {stats['peak_in_flight']} in flight")
+        server.close()
+        self.assertLess(2 * results[True]['peak_per_slot'], results[False]['peak_per_slot'])
+
+
+class FleetBenchmark(unittest.TestCase):
+    def test_top(self):
+        generator = random.Random(0)
+        names = [f'site {i}' for i in range(2000)]
+        health = {name: {'availability': generator.random(), 'p99': generator.random(), 'errors': 0, 'down': False}
+                  for name in names}
+        fleet = FleetIndex()
+        for name in names:
+            fleet.update(name, health[name])
+        #  Every second, about one website in ten publishes new metrics, and the page is drawn up to 100 times
+        timings = {}
+        for incremental in (True, False):
+            t = time.time()
+            for _ in range(10):
+                for name in generator.sample(names, 200):
+                    health[name] = {**health[name], 'p99': generator.random()}
+                    if incremental:
+                        fleet.update(name, health[name])
+                for _ in range(100):
+                    if incremental:
+                        top = fleet.top('p99', 20)
+                    else:
+                        top = sorted([(h['p99'], name) for name, h in health.items()], reverse=True)[:20]
+            timings[incremental] = (time.time() - t) / 10
+            print(f"\n{'incremental' if incremental else 'sorting'}: {1000 * timings[incremental]:.1f} ms per second")
+        for name in names:
+            fleet.update(name, health[name])
+        self.assertEqual(fleet.top('p99', 20), top)
+        self.assertLess(timings[True], timings[False])
+
+
+class StorageBenchmark(unittest.TestCase):
+    def test_ingestion(self):
+        sites = [(f'site {i}', 'http://localhost:4444', 1, 1) for i in range(1000)]
+        monitors = {site: SiteMonitor(*site) for site in sites}
+        store = SQLiteStore(SimpleNamespace(site_monitors=monitors), os.path.join(tempfile.mkdtemp(), 'store.db'))
+        schedulers = [monitor.request_scheduler for monitor in monitors.values()]
+        #  Every website receives a response every second for 10 seconds, while the store writes them
+        store.start()
+        add_times = []
+        start = time.time()
+        for second in range(10):
+            t = time.time()
+            for scheduler in schedulers:
+                scheduler.add((time.time(), 200, 0.1))
+            add_times.append((time.time() - t) / len(schedulers))
+            time.sleep(max(0, start + second + 1 - time.time()))
+        time.sleep(1.5)
+        store.stop()
+        store.join()
+        rate = store.n_samples / store.busy
+        print(f"\n{store.n_samples} responses written in {store.busy:.2f} s of {time.time() - start:.1f} s "
+              f"({rate:.0f} responses per second), {1e6 * max(add_times):.1f} µs per response added")
+        self.assertEqual(store.n_samples, 10000)
+        self.assertGreater(rate, 10000)
+
+
+class ExportBenchmark(unittest.TestCase):
+    def test_load(self):
+        import numpy as np
+        logs = tempfile.mkdtemp()
+        path = os.path.join(logs, 'site_raw.txt')
+        #  About 12 days of responses every second
+        n = 1000000
+        with open(path, 'w') as file:
+            for start in range(0, n, 100000):
+                file.writelines(["%s %s %s\n" % (1.6e9 + i + 0.123456, 200 if i % 50 else 503, 0.05 + i % 97 / 1000)
+                                 for i in range(start, start + 100000)])
+        directory = os.path.join(logs, 'export')
+        tracemalloc.start()
+        t = time.time()
+        export_logs(['site'], logs, directory)
+        export_time = time.time() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        t = time.time()
+        text = np.loadtxt(path)
+        text_time = time.time() - t
+        t = time.time()
+        times, codes, elapsed = load_npz(directory, 'site')
+        npz_time = time.time() - t
+        print(f"\nExported {n} responses ({os.path.getsize(path) / 2 ** 20:.1f} MB of text) in {export_time:.2f} s, "
+              f"using at most {peak / 2 ** 20:.1f} MB. Loading them takes {1000 * text_time:.0f} ms from the text, "
+              f"{1000 * npz_time:.1f} ms from the archives")
+        self.assertTrue(np.array_equal(times, text[:, 0]))
+        #  The memory used depends on the responses of a day, not on the size of the logs
+        self.assertLess(peak, os.path.getsize(path) / 2)
+        self.assertLess(10 * npz_time, text_time)
+
+
+class SnapshotBenchmark(unittest.TestCase):
+    def test_load(self):
+        #  10000 websites probed every second, with an hour of metrics and 10 minutes of responses each
+        simulation = Simulation([('site', 'sim://site', 1, 2)], {})
+        simulation.run(3660)
+        state, responses, summaries = simulation.monitors['site'].get_state()
+        names = [f'site {i}' for i in range(10000)]
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        t = time.time()
+        write_snapshot(path, [(name, state, responses, summaries) for name in names])
+        write_time = time.time() - t
+        monitors = [SiteMonitor(name, 'http://localhost:4444', 1, 2) for name in names]
+        t = time.time()
+        _, sites = load_snapshot(path)
+        for monitor in monitors:
+            monitor.restore_state(*sites[monitor.name])
+        load_time = time.time() - t
+        #  Each monitor puts its responses and summaries back when it starts, in its own thread
+        t = time.time()
+        monitors[-1].restore_responses()
+        restore_time = time.time() - t
+        print(f"\nSnapshot of {len(names)} websites ({os.path.getsize(path) / 2 ** 20:.1f} MB) written in "
+              f"{write_time:.2f} s, loaded in {1000 * load_time:.0f} ms, then {1000 * restore_time:.1f} ms "
+              f"for each monitor")
+        restored = monitors[-1].request_scheduler.results.get_slice(float('-inf'), float('inf'))
+        self.assertEqual([r[0] for r in restored], [r[0] for r in responses])
+        self.assertEqual(monitors[-1].engine.get_state()[1], summaries)
+        self.assertEqual(monitors[-1].metrics, simulation.monitors['site'].metrics)
+        self.assertLess(load_time, 1)
+
+
+class TimeFormatBenchmark(unittest.TestCase):
+    def test_format(self):
+        #  The times of 10000 log lines spread over a day
+        times = [1.7e9 + i * 8.64 for i in range(10000)]
+        t = time.time()
+        expected = [get_local_time(x).strftime('%Y-%m-%d %H:%M:%S') for x in times]
+        datetime_time = time.time() - t
+        formatter = TimeFormatter()
+        t = time.time()
+        formatted = formatter.format_many(times)
+        cached_time = time.time() - t
+        print(f"\nFormatting {len(times)} times takes {1000 * datetime_time:.1f} ms with datetime, "
+              f"{1000 * cached_time:.1f} ms with the formatter")
+        self.assertListEqual(formatted, expected)
+        self.assertLess(3 * cached_time, datetime_time)
+
+
+class TimelineBenchmark(unittest.TestCase):
+    def test_frames(self):
+        #  100000 events of 1000 flapping websites, and 1000 frames of the logs page, 50 events each
+        generator = random.Random(0)
+        events = [(f"site-{generator.randrange(1000)}", 'unavailable_since', 1.7e9 + i - generator.random(), None)
+                  for i in range(100000)]
+        timeline = Timeline()
+        t = time.time()
+        for event in events:
+            timeline.add([event])
+        add_time = time.time() - t
+        t = time.time()
+        for frame in range(1000):
+            expected = sorted(events, key=itemgetter(2))[100 * frame:100 * frame + 50]
+        sort_time = time.time() - t
+        t = time.time()
+        for frame in range(1000):
+            shown = timeline.select()[1][100 * frame:100 * frame + 50]
+        timeline_time = time.time() - t
+        print(f"\nAdding {len(events)} events takes {1000 * add_time:.1f} ms, 1000 frames take"
+              f" {1000 * sort_time:.1f} ms sorting the events and {1000 * timeline_time:.2f} ms with the timeline")
+        self.assertEqual(shown, expected)
+        self.assertLess(100 * timeline_time, sort_time)
+
+
+class SimulationBenchmark(unittest.TestCase):
+    def test_throughput(self):
+        #  1000 websites on 20 hosts probed every second for 10 minutes of virtual time, with a 5 minutes outage
+        sites = [(f'site {i}', f'sim://host{i % 20}/{i}', 1, 2) for i in range(1000)]
+        targets = {site[0]: Target(i, {'distribution': 'lognormal', 'median': 0.1, 'sigma': 0.5},
+                                   {200: 98, 500: 2}, [{'start': 300, 'end': 600}] if i % 10 == 0 else ())
+                   for i, site in enumerate(sites)}
+        simulation = Simulation(sites, targets, step=0.5)
+        n, elapsed = simulation.run(600)
+        print(f"\nSimulated {n} probes in {elapsed:.1f} s, {60 * n / elapsed / 1e6:.2f} million probes per minute")
+        self.assertEqual(len([m for m in simulation.monitors.values() if m.unavailable_since]), 100)
+        self.assertGreater(60 * n / elapsed, 1e6)
+
+
+class MemoryBudgetBenchmark(unittest.TestCase):
+    def simulate(self, columnar, capacity=None):
+        """
+        Simulates 10 websites pinged every 0.01 s for 11 minutes, keeping at most **capacity** responses each.
+
+        :return: the memory taken by the monitors and the memory they are estimated to take, in bytes
+        """
+        sites = [(f'site {i}', f'sim://site{i}', 0.01, 5) for i in range(10)]
+        #  Imports numpy beforehand, so that only the memory of the monitors is measured
+        ColumnarQueue(1)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        simulation = Simulation(sites, {}, step=1, columnar=columnar)
+        if capacity:
+            for monitor in simulation.monitors.values():
+                monitor.resize(capacity)
+        simulation.run(660)
+        estimate = sum([get_usage(monitor)['total'] for monitor in simulation.monitors.values()])
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return memory, estimate
+
+    def test_estimates(self):
+        for columnar in (False, True):
+            used = {}
+            for capacity in (None, 5000):
+                memory, estimate = self.simulate(columnar, capacity)
+                print(f"\n{'columnar' if columnar else 'tuples'}, {capacity or 60000} responses kept: "
+                      f"{memory / 2 ** 20:.1f} MB used, {estimate / 2 ** 20:.1f} MB estimated")
+                self.assertLess(abs(memory - estimate), memory / 2)
+                used[capacity] = memory
+            self.assertLess(5 * used[5000], used[None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,43 @@
 import unittest
+from unittest.mock import Mock, patch
 from collections import Counter
-from src.fixed_size import FixedSizeQueue
+from src.fixed_size import FixedSizeQueue, ColumnarQueue
 from operator import itemgetter
-from src.utils import Requester
+from src.utils import Requester, TcpRequester, TlsRequester, get_requester, TokenBucket, InFlightLimit, SKIPPED, \
+    get_probe_phases, get_shared_probes, TimeFormatter, TIME_FORMATTER, get_local_time
 from src.site_monitor import SiteMonitor, RequestScheduler
+from src.availability import AvailabilityTracker, AvailabilityPolicy
+from src.snapshot import Snapshotter, write_snapshot, load_snapshot
+from src.summary import WindowSummary, encode_frame, decode_payload
+from src.agent import Agent, Aggregator
+from src.anomaly import LatencyDetector, describe_anomaly
+from src.diagnostics import Timers, ProbeActivity, SamplingProfiler, collect, dump
+from src.window_pool import WindowPool, compute_windows
+from src.windows import WindowSpec, WindowEngine, load_windows, STATS
+from src.fleet import FleetIndex
+from src.timeline import Timeline, parse_time
+from src.sites import SitesReader, SitesFileError, get_sites
+from src.global_monitor import GlobalMonitor
+from src.simulator import Simulation, Target, VirtualClock, load_scenario
+from src.storage import SQLiteStore
+from src.export import export_logs, export_monitors, load_npz, check_format, read_raw
+from src.notifier import Notifier
+from src.memory import MemoryBudget, get_usage, BUCKET_BYTES, MIN_SAMPLES
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from importlib.util import find_spec
+from array import array
+from datetime import datetime
+from multiprocessing import shared_memory
+import json
+import random
+from types import SimpleNamespace
+import os
+import sys
+import tempfile
 import time
+import socket
+import sqlite3
+from threading import Barrier, Thread
 
 
 class MyTestCase(unittest.TestCase):
@@ -29,6 +62,24 @@ class MyTestCase(unittest.TestCase):
         self.assertListEqual(queue.get_slice(3, 4), [(3, 0), (4, 0)])
         self.assertListEqual(queue.get_slice(2, 5), [(2, 0), (3, 0), (4, 0), (5, 0)])
 
+    def test_columnar_queue(self):
+        queue = ColumnarQueue(50)
+        reference = FixedSizeQueue(50, itemgetter(0))
+        for i in [0, 3, 1, 2, 5, 4] + list(range(6, 100)) + [60, 42]:
+            response = (float(i), 200 + 100 * (i % 3), i / 8)
+            queue.add(response)
+            reference.add(response)
+            if i % 7 == 0:
+                self.assertListEqual(queue.h, reference.h)
+        self.assertEqual(len(queue), 50)
+        self.assertListEqual(queue.get_slice(60, 70), reference.get_slice(60, 70))
+        self.assertListEqual(queue.get_slice(70, 60), [])
+        monitor = SiteMonitor('test', 'http://localhost', 1, 1)
+        columnar_monitor = SiteMonitor('test', 'http://localhost', 1, 1, columnar=True)
+        monitor.request_scheduler.results = reference
+        columnar_monitor.request_scheduler.results = queue
+        self.assertEqual(monitor.get_metrics(75, 30, 0), columnar_monitor.get_metrics(75, 30, 0))
+
     def test_requester(self):
         queue = FixedSizeQueue(int(600 / 1), key=itemgetter(0))
         requester = Requester('http://localhost:4444', queue, 5)
@@ -39,6 +90,45 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(code, 200)
         self.assertTrue(0 < elapsed < 1)
 
+    def test_tcp_requester(self):
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen()
+        port = server.getsockname()[1]
+        queue = FixedSizeQueue(10, key=itemgetter(0))
+        requester = TcpRequester(f'tcp://localhost:{port}', queue, 5)
+        requester.start()
+        requester.join()
+        server.close()
+        requester = TcpRequester(f'tcp://localhost:{port}', queue, 5)
+        requester.start()
+        requester.join()
+        _, codes, elapsed = zip(*queue.h)
+        self.assertListEqual(list(codes), [210, 503])
+        self.assertTrue(all(0 <= e < 1 for e in elapsed))
+        for url in ('tcp://localhost', 'tcp://localhost:99999', 'tcp://:80', 'tls://localhost:https'):
+            self.assertRaises(ValueError, RequestScheduler, 1, url, 1)
+        self.assertEqual(TlsRequester.check_url('tls://example.com'), ('example.com', 443))
+
+    def test_tls_requester(self):
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen()
+        port = server.getsockname()[1]
+        #  The server reads the handshake and closes the connection without answering. Closing the connection
+        #  before the handshake is read would reset it, and the probe would fail before the handshake
+        acceptor = Thread(target=lambda: server.accept()[0].recv(1024))
+        acceptor.start()
+        queue = FixedSizeQueue(10, key=itemgetter(0))
+        requester = TlsRequester(f'tls://localhost:{port}', queue, 5)
+        requester.start()
+        requester.join()
+        acceptor.join()
+        server.close()
+        self.assertEqual(queue.h[0][1], 525)
+        self.assertIs(get_requester('tls://localhost'), TlsRequester)
+        self.assertIs(get_requester('localhost:4444'), Requester)
+
     def test_request_scheduler(self):
         scheduler = RequestScheduler(1, 'http://localhost:4444/delay?increment=1&reset_after=6', 5)
         t = time.time()
@@ -53,6 +143,759 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(all([-0.1 < a-b < 0.1 for a, b in zip(elapsed, [1, 2, 3, 4, 5, 5])]))
         self.assertListEqual(list(code), [200, 200, 200, 200, 408, 408])
 
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, 5)
+        self.assertEqual(sum(bucket.consume() for _ in range(20)), 5)
+        time.sleep(0.2)
+        self.assertTrue(bucket.consume())
+
+    def test_in_flight_limits(self):
+        #  A server that accepts the connections but never answers
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(100)
+        url = f'http://localhost:{server.getsockname()[1]}/'
+        limit = InFlightLimit(4)
+        schedulers = [RequestScheduler(0.05, url, 1, max_in_flight=3, in_flight_limit=limit),
+                      RequestScheduler(0.05, url, 1, max_in_flight=3, in_flight_limit=limit, overload_policy='timeout')]
+        peak = 0
+        for scheduler in schedulers:
+            scheduler.start()
+        t = time.time()
+        while time.time() - t < 0.8:
+            in_flight = [scheduler.in_flight for scheduler in schedulers]
+            peak = max(peak, sum(in_flight))
+            self.assertTrue(all([n <= 3 for n in in_flight]))
+            time.sleep(0.01)
+        for scheduler in schedulers:
+            scheduler.stop()
+        time.sleep(1.5)
+        server.close()
+        #  The probes are sent by threads, the limit can be reached between two checks
+        self.assertLessEqual(peak, 4)
+        self.assertEqual(limit.count, 0)
+        skipped, timeouts = [scheduler.results.get_slice(0, float('inf')) for scheduler in schedulers]
+        self.assertGreater(schedulers[0].n_skipped, 5)
+        self.assertEqual(len([r for r in skipped if r[1] == SKIPPED]), schedulers[0].n_skipped)
+        self.assertEqual(len([r for r in timeouts if r[1] == 408]), len(timeouts))
+        self.assertRaises(ValueError, RequestScheduler, 1, url, 1, overload_policy='wait')
+        #  The skipped probes are counted apart, and left out of the availability and the response times
+        summary = WindowSummary(0, 10)
+        tracker = AvailabilityTracker()
+        for code, elapsed in ((200, 0.5), (SKIPPED, 0), (SKIPPED, 0), (500, 0.1)):
+            summary.add(code, elapsed)
+            tracker.add(1, code)
+        self.assertEqual((summary.count, summary.availability, summary.avg_elapsed), (2, 0.5, 0.3))
+        self.assertEqual(tracker.availability, 0.5)
+        engine = WindowEngine([WindowSpec(10, 60)])
+        for code, elapsed in ((200, 0.5), (SKIPPED, 0), (SKIPPED, 0), (500, 0.1)):
+            engine.add(1, code, elapsed)
+        stats = engine.evaluate(10, 10)
+        self.assertEqual((stats['skipped'], stats['codes_count'], stats['availability']), (2, {200: 1, 500: 1}, 0.5))
+        #  A window in which every probe was skipped still reports them, without availability nor response times
+        engine = WindowEngine([WindowSpec(10, 10)])
+        for t in range(20, 30):
+            engine.add(t, SKIPPED, 0)
+        stats = engine.evaluate(10, 30)
+        self.assertEqual((stats['skipped'], stats['codes_count'], stats['availability'], stats['max_elapsed']),
+                         (10, {}, None, None))
+        monitor = SiteMonitor('test', 'http://localhost', 1, 1, windows=[WindowSpec(10, 10, STATS)])
+        monitor.publish_metrics(10, stats)
+        self.assertEqual(monitor.metrics[10]['skipped'], 10)
+        for columnar in (False, True):
+            monitor = SiteMonitor('test', 'http://localhost', 1, 1, columnar=columnar)
+            monitor.request_scheduler.results.add_many([(t, SKIPPED, 0) for t in range(20, 30)])
+            self.assertEqual(monitor.get_metrics(30, 10, 0), (None, {}, None, None, 10))
+        block = shared_memory.SharedMemory(create=True, size=6 * 10)
+        block.buf[40:60] = array('h', [SKIPPED] * 10).tobytes()
+        self.assertEqual(compute_windows(block.name, 10, [(0, 10, ['p99'])])[0]['skipped'], 10)
+        block.close()
+        block.unlink()
+
+    def test_probe_phases(self):
+        sites = [(f'site {i}', f'http://example.com/{i}', 1, 1) for i in range(8)] + [('other', 'tcp://other:80', 1, 1)]
+        phases = get_probe_phases(sites)
+        self.assertEqual(phases, get_probe_phases(sites[::-1]))
+        #  The websites of the same host are evenly spread
+        shared = sorted([phases[f'site {i}'] for i in range(8)])
+        self.assertTrue(all([abs(b - a - 1 / 8) < 1e-9 for a, b in zip(shared, shared[1:])]))
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(10)
+        scheduler = RequestScheduler(1, f'tcp://localhost:{server.getsockname()[1]}', 1, phase=0.3)
+        t = time.time()
+        scheduler.start()
+        time.sleep(0.5)
+        scheduler.stop()
+        server.close()
+        self.assertAlmostEqual(scheduler.first_probe - t, 0.3, delta=0.05)
+        activity = ProbeActivity(slot=0.1)
+        activity.since = 100
+        for t in (100.01, 100.02, None, 100.04, None, 100.55, None, None, 100.8):
+            if t is None:
+                activity.on_done()
+            else:
+                activity.on_sent(t)
+        stats = activity.read()
+        self.assertEqual((stats['sent'], stats['in_flight'], stats['peak_in_flight']), (5, 1, 2))
+        self.assertEqual(stats['peak_per_slot'], 3)
+        self.assertEqual(activity.read()['peak_in_flight'], 1)
+        #  The probes keep their phase instead of drifting by the time spent sending each of them, and the probes
+        #  missed while the scheduler was late aren't caught up
+        scheduler.next_probe = 10.3
+        scheduler.schedule(10.31)
+        self.assertAlmostEqual(scheduler.next_probe, 11.3)
+        scheduler.schedule(13.5)
+        self.assertAlmostEqual(scheduler.next_probe, 14.3)
+
+    def test_shared_probes(self):
+        sites = [('a', 'http://example.com', 10, 1), ('b', 'http://example.com', 5, 1),
+                 ('c', 'http://example.com', 7, 1), ('d', 'http://example.com', 5, 2),
+                 ('e', 'tcp://example.com:80', 5, 1)]
+        self.assertEqual(get_shared_probes(sites), {'a': sites[1], 'c': sites[1]})
+        owner = SiteMonitor('b', 'http://example.com', 5, 1)
+        monitors = [SiteMonitor(name, 'http://example.com', interval, 1, scheduler=owner.request_scheduler)
+                    for name, interval in (('a', 10), ('c', 7))]
+        #  Responses every 5 seconds, slightly jittered
+        for i in range(70):
+            owner.request_scheduler.add((1000 + 5 * i + i % 3 / 10, 200, 0.1))
+        self.assertEqual(len(owner.request_scheduler.results), 70)
+        self.assertEqual(len(monitors[0].request_scheduler.results), 35)
+        self.assertEqual(len(monitors[1].request_scheduler.new_results), 50)
+        monitors[0].stop()
+        owner.request_scheduler.add((2000, 200, 0.1))
+        self.assertEqual(len(monitors[0].request_scheduler.results), 35)
+        self.assertEqual(len(monitors[1].request_scheduler.results), 51)
+        #  The responses arrive from the threads of the requests at once, a single one is kept
+        feed = SiteMonitor('f', 'http://example.com', 10, 1, scheduler=owner.request_scheduler).request_scheduler
+        barrier = Barrier(20)
+
+        def respond():
+            barrier.wait()
+            owner.request_scheduler.add((3000, 200, 0.1))
+
+        threads = [Thread(target=respond) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(feed.results), 1)
+
+    def test_adaptive_interval(self):
+        scheduler = RequestScheduler(1, 'http://localhost:4444', 5, adaptive=True)
+        for i in range(1, 20):
+            scheduler.results.add((i, 200, 0.1))
+            scheduler.adapt()
+        self.assertEqual(scheduler.interval, scheduler.max_interval)
+        scheduler.results.add((20, 200, 1))
+        scheduler.adapt()
+        self.assertEqual(scheduler.interval, scheduler.max_interval / 2)
+        for i in range(21, 30):
+            scheduler.results.add((i, 503, 0.1))
+            scheduler.adapt()
+        self.assertEqual(scheduler.interval, scheduler.min_interval)
+        #  The response time changes for good: once taken as the new normal, the interval stretches again
+        for i in range(30, 60):
+            scheduler.results.add((i, 200, 2))
+            scheduler.adapt()
+        self.assertAlmostEqual(scheduler.avg_elapsed, 2, delta=0.1)
+        self.assertEqual(scheduler.interval, scheduler.max_interval)
+
+    def test_availability_tracker(self):
+        tracker = AvailabilityTracker(AvailabilityPolicy(0.8, 0.9, window=10, min_samples=5))
+        transitions = [tracker.add(t, 200) for t in range(10)]
+        transitions += [tracker.add(t, 503) for t in range(10, 13)]
+        self.assertEqual(transitions[-1], 'unavailable_since')
+        self.assertAlmostEqual(tracker.availability, 0.7)
+        #  80% is enough to stay up, but not to recover
+        transitions += [tracker.add(t, 200) for t in range(13, 21)]
+        self.assertAlmostEqual(tracker.availability, 0.8)
+        self.assertFalse(tracker.available)
+        transitions += [tracker.add(t, 200) for t in range(21, 23)]
+        self.assertListEqual([x for x in transitions if x], ['unavailable_since', 'recovered_at'])
+        self.assertIsNone(AvailabilityTracker().add(0, 200))
+        #  A single failed request isn't enough to report a website down
+        tracker = AvailabilityTracker()
+        self.assertListEqual([tracker.add(t, 503) for t in range(3)], [None, None, 'unavailable_since'])
+
+    def test_snapshot(self):
+        monitor = SiteMonitor('snapshot', 'http://localhost:4444', 1, 5)
+        t = time.time()
+        for i in range(10):
+            monitor.request_scheduler.add((t + i, 200 if i < 5 else 503, 0.5))
+        monitor.consume_responses()
+        monitor.update_metrics(10)
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+        write_snapshot(path, [('snapshot', *monitor.get_state())], {'metrics': [], 'availability_changes': []})
+        ui_state, states = load_snapshot(path)
+        restored = SiteMonitor('snapshot', 'http://localhost:4444', 1, 5)
+        restored.restore_state(*states['snapshot'])
+        restored.restore_responses()
+        self.assertListEqual(restored.request_scheduler.results.h, monitor.request_scheduler.results.h)
+        self.assertEqual(restored.unavailable_since, t + 6)
+        self.assertFalse(restored.tracker.available)
+        self.assertEqual(restored.metrics[120]['availability'], monitor.metrics[120]['availability'])
+        self.assertEqual(restored.metrics[10]['codes_count'], monitor.metrics[10]['codes_count'])
+        #  The hour window is restored from the summaries of the windows, not from the 100 responses stored
+        clock = VirtualClock()
+        monitor = SiteMonitor('hour', 'http://localhost:4444', 1, 5, clock=clock, capacity=100)
+
+        def probe(monitors, duration):
+            for _ in range(duration):
+                clock.now += 1
+                for m in monitors:
+                    m.request_scheduler.add((clock.now, 503 if clock.now % 10 < 1 else 200, 0.1 + clock.now % 7 / 100))
+                    m.step()
+
+        probe([monitor], 2000)
+        write_snapshot(path, [('hour', *monitor.get_state())])
+        _, states = load_snapshot(path)
+        restored = SiteMonitor('hour', 'http://localhost:4444', 1, 5, clock=clock, capacity=100)
+        restored.restore_state(*states['hour'])
+        restored.restore_responses()
+        probe([monitor, restored], 120)
+        self.assertGreater(sum(monitor.metrics[60]['codes_count'].values()), 1000)
+        self.assertEqual(restored.metrics[60], monitor.metrics[60])
+        #  A failed snapshot is logged, and the snapshotter keeps running
+        snapshotter = Snapshotter(SimpleNamespace(site_monitors={}, ui=None), os.path.join(path, 'snapshot.bin'), 0)
+        with self.assertLogs(level='ERROR') as logs:
+            snapshotter.start()
+            time.sleep(0.3)
+            self.assertTrue(snapshotter.is_alive())
+            snapshotter.stop()
+            snapshotter.join()
+        self.assertGreater(len(logs.output), 1)
+
+    def test_sqlite_store(self):
+        monitors = {(name, 'http://localhost:4444', 1, 1): SiteMonitor(name, 'http://localhost:4444', 1, 1)
+                    for name in ('a', 'b')}
+        store = SQLiteStore(SimpleNamespace(site_monitors=monitors), os.path.join(tempfile.mkdtemp(), 'store.db'),
+                            retention=3600, partition=600)
+        store.connect()
+        t = time.time()
+        for i, monitor in enumerate(monitors.values()):
+            for j in range(10):
+                monitor.request_scheduler.add((t - 100 + j, 200 if i else 503, 0.1))
+            #  In a partition past the retention, deleted right after being written
+            monitor.request_scheduler.add((t - 5000, 200, 0.1))
+        store.add_metrics('a', [(10, {'time': t, 'duration': 600, 'codes_count': Counter({503: 10})})])
+        store.write()
+        rows = store.connection.execute('SELECT site, count(*), min(time) FROM samples GROUP BY site').fetchall()
+        self.assertEqual(rows, [('a', 10, t - 100), ('b', 10, t - 100)])
+        key, metric = store.connection.execute('SELECT key, metric FROM metrics').fetchone()
+        self.assertEqual((key, json.loads(metric)['codes_count']), ('10', {'503': 10}))
+        self.assertEqual(store.n_samples, 22)
+        store.write()
+        self.assertEqual(store.n_samples, 22)
+        #  A failed write is logged, and its responses and metrics are written by the next one. The last write
+        #  stores the responses more recent than the timeout too
+        store.add_metrics('b', [(10, {'time': t, 'duration': 600, 'codes_count': Counter({200: 10})})])
+        for monitor in monitors.values():
+            monitor.request_scheduler.add((time.time(), 200, 0.1))
+        store.connection.execute('PRAGMA busy_timeout=0')
+        other = sqlite3.connect(store.path)
+        other.execute('BEGIN EXCLUSIVE')
+        with self.assertLogs(level='ERROR'):
+            store.try_write(final=True)
+        self.assertTrue(store.failing)
+        self.assertEqual(store.n_samples, 22)
+        other.rollback()
+        other.close()
+        store.try_write(final=True)
+        self.assertFalse(store.failing)
+        self.assertEqual(store.n_samples, 24)
+        self.assertEqual(store.connection.execute('SELECT count(*) FROM metrics').fetchone(), (2,))
+        store.connection.close()
+
+    def test_export(self):
+        logs = tempfile.mkdtemp()
+        responses = [(86400 * 3 + 600 * i + i % 5 / 10, 200 if i % 7 else 503, i / 1000) for i in range(400)]
+        with open(os.path.join(logs, 'a_raw.txt'), 'w') as file:
+            #  Slightly out of order, like the slices written by the writer
+            file.writelines(["%s %s %s\n" % x for x in responses[:150] + responses[160:] + responses[150:160]])
+        directory = os.path.join(logs, 'export')
+        self.assertEqual(export_logs(['a', 'b'], logs, directory), 400)
+        self.assertEqual(sorted(os.listdir(directory)), ['a_1970-01-04.npz', 'a_1970-01-05.npz', 'a_1970-01-06.npz'])
+        times, codes, elapsed = load_npz(directory, 'a')
+        self.assertListEqual(list(zip(times.tolist(), codes.tolist())), [r[:2] for r in responses])
+        self.assertLess(max([abs(e - r[2]) for e, r in zip(elapsed.tolist(), responses)]), 1e-6)
+        monitor = SiteMonitor('c', 'http://localhost:4444', 1, 1)
+        for response in responses[:10]:
+            monitor.request_scheduler.add(response)
+        global_monitor = SimpleNamespace(site_monitors={('c', 'http://localhost:4444', 1, 1): monitor})
+        self.assertEqual(export_monitors(global_monitor, directory), 10)
+        self.assertListEqual(load_npz(directory, 'c')[0].tolist(), [r[0] for r in responses[:10]])
+        self.assertRaises(ValueError, check_format, 'csv')
+        if find_spec('pyarrow') is None:
+            self.assertRaises(ValueError, check_format, 'arrow')
+        #  The malformed lines, like the last line of a killed program, are logged with their file and skipped
+        path = os.path.join(logs, 'd_raw.txt')
+        with open(path, 'w') as file:
+            file.writelines(["%s %s %s\n" % x for x in responses[:10]] + ["1.5 200 x\n"]
+                            + ["%s %s %s\n" % x for x in responses[10:20]] + ["1.5 20"])
+        for chunk_size in (2 ** 20, 100):
+            with self.assertLogs(level='WARNING') as logs_output:
+                times = [t for columns in read_raw(path, chunk_size) for t in columns[0].tolist()]
+            self.assertListEqual(times, [r[0] for r in responses[:20]])
+            self.assertEqual([message.split(': ')[0] for message in logs_output.output],
+                             [f"WARNING:root:Skipped line {line} of {path}" for line in (11, 22)])
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(export_logs(['d'], logs, os.path.join(logs, 'torn')), 20)
+
+    @unittest.skipUnless(find_spec('pyarrow'), "requires pyarrow")
+    def test_arrow_export(self):
+        import pyarrow as pa
+        logs = tempfile.mkdtemp()
+        responses = {name: [(1000 + i, 200 if i % 3 else 503, i / 100) for i in range(n)]
+                     for name, n in (('a', 50), ('b', 20))}
+        for name, rows in responses.items():
+            with open(os.path.join(logs, name + '_raw.txt'), 'w') as file:
+                file.writelines(["%s %s %s\n" % x for x in rows])
+        directory = os.path.join(logs, 'export')
+        self.assertEqual(export_logs(['a', 'b', 'c'], logs, directory, 'arrow'), 70)
+        with pa.OSFile(os.path.join(directory, 'responses.arrow')) as file:
+            table = pa.ipc.open_file(file).read_all()
+        self.assertListEqual(table.column('site').to_pylist(), ['a'] * 50 + ['b'] * 20)
+        self.assertListEqual(list(zip(table.column('time').to_pylist(), table.column('code').to_pylist())),
+                             [r[:2] for r in responses['a'] + responses['b']])
+        self.assertEqual(table.schema.field('elapsed').type, pa.float32())
+
+    def test_notifier(self):
+        received = []
+
+        class Receiver(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+                #  The flaky destination fails twice before accepting the alerts
+                failed = self.path == '/flaky' and len([r for r in received if r[0] == '/flaky']) <= 2
+                self.send_response(500 if failed else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('localhost', 0), Receiver)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://localhost:{server.server_address[1]}'
+        notifier = Notifier([url + '/hook', 'chat+' + url + '/chat', url + '/flaky', 'http://localhost:1'],
+                            window=0.2, retries=2, backoff=0.1, timeout=1)
+        monitor = SiteMonitor('a', 'http://a', 1, 1, notifier=notifier)
+        #  The website is reported down after the third failed request
+        for _ in range(3):
+            monitor.request_scheduler.add((time.time(), 503, 0))
+        monitor.consume_responses()
+        for state in ('up', 'down'):
+            notifier.notify('a', 'http://a', state, time.time())
+        notifier.notify('b', 'http://b', 'down', time.time(), 0.5)
+        notifier.start()
+        time.sleep(1.5)
+        notifier.stop()
+        server.shutdown()
+        hook = [alerts for path, alerts in received if path == '/hook']
+        self.assertEqual(len(hook), 1)
+        self.assertEqual([(a['site'], a['state'], a['transitions']) for a in hook[0]['alerts']],
+                         [('a', 'down', 3), ('b', 'down', 1)])
+        self.assertIn('b (http://b) is down since', [alerts for path, alerts in received if path == '/chat'][0]['text'])
+        self.assertEqual(len([path for path, _ in received if path == '/flaky']), 3)
+        stats = notifier.read()
+        #  Both alerts reached three destinations, and were dropped after three attempts on the unreachable one
+        self.assertEqual((stats['sent'], stats['dropped'], stats['retried']), (6, 2, 4))
+        self.assertGreater(stats['avg_latency'], 0.2)
+        notifier = Notifier([url], capacity=1)
+        notifier.notify('a', 'http://a', 'down', 0)
+        notifier.notify('b', 'http://b', 'down', 0)
+        self.assertEqual(notifier.read()['dropped'], 1)
+        #  A destination that doesn't take the batches keeps only the latest ones
+        notifier = Notifier([url], window=0, max_batches=2)
+        for _ in range(2):
+            notifier.destinations[0].limit.acquire()
+        for i in range(3):
+            notifier.notify(f'site {i}', 'http://a', 'down', 0)
+            notifier.process()
+        stats = notifier.read()
+        self.assertEqual((stats['batches'], stats['dropped_batches'], stats['dropped']), (2, 1, 1))
+        self.assertEqual(notifier.destinations[0].batches[0][2][0]['site'], 'site 1')
+
+    def test_time_formatter(self):
+        import pytz
+        tz = pytz.timezone('Europe/Paris')
+        formatter = TimeFormatter(tz)
+        #  Around the change to summer time on 2024-03-31, and at random times
+        generator = random.Random(0)
+        times = [1711846800 + i * 60.5 for i in range(-200, 200)] + [generator.uniform(0, 2e9) for _ in range(1000)]
+        expected = [datetime.fromtimestamp(t, tz).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] for t in times]
+        self.assertListEqual(formatter.format_many(times, ms=True), expected)
+        self.assertEqual(formatter.format(1711846800 - 1, date=False), '01:59:59')
+        self.assertEqual(formatter.format(1711846800), '2024-03-31 03:00:00')
+        self.assertEqual(TIME_FORMATTER.format(1e9), get_local_time(1e9).strftime('%Y-%m-%d %H:%M:%S'))
+
+    def test_summary(self):
+        summary = WindowSummary(0, 10)
+        for i in range(1, 1001):
+            summary.add(200 if i % 10 else 503, i / 1000)
+        self.assertAlmostEqual(summary.availability, 0.9)
+        self.assertAlmostEqual(summary.quantile(0.5), 0.5, delta=0.5 * 0.025)
+        self.assertAlmostEqual(summary.quantile(0.99), 0.99, delta=0.99 * 0.025)
+        names, received = {}, {}
+        frame = encode_frame('agent', [('site a', summary), ('site b', summary)], names)
+        agent, records = decode_payload(frame[10:], received)
+        self.assertEqual(agent, 'agent')
+        self.assertDictEqual(received, {0: 'site a', 1: 'site b'})
+        self.assertEqual(records[1][1].codes_count, summary.codes_count)
+        self.assertEqual(records[1][1].sketch, summary.sketch)
+        #  The names are only sent once per connection
+        self.assertNotIn(b'site a', encode_frame('agent', [('site a', summary)], names))
+
+    def test_agent(self):
+        aggregator = Aggregator(('localhost', 0))
+        aggregator.start()
+        remote = aggregator.monitor_factory('site', 'http://localhost:4444', 1, 5)
+        t = time.time() - 60
+        agents = []
+        for i in range(2):
+            monitor = SiteMonitor('site', 'http://localhost:4444', 1, 5)
+            for j in range(50):
+                monitor.request_scheduler.add((t + j, 200 if i else 503, 0.1 * (i + 1)))
+            agents.append(Agent(SimpleNamespace(site_monitors={('site',): monitor}), aggregator.address, f'agent {i}'))
+            self.assertTrue(agents[-1].flush())
+        time.sleep(0.5)
+        remote.consume_responses()
+        availability, codes_count, max_elapsed, avg_elapsed, _ = remote.get_metrics(time.time(), 600, 10)
+        for agent in agents:
+            agent.sock.close()
+        aggregator.stop()
+        self.assertSetEqual(aggregator.agents, {'agent 0', 'agent 1'})
+        self.assertEqual(codes_count, Counter({200: 50, 503: 50}))
+        self.assertAlmostEqual(availability, 0.5)
+        self.assertAlmostEqual(max_elapsed, 0.2)
+        self.assertAlmostEqual(avg_elapsed, 0.15)
+
+    def test_latency_detector(self):
+        detector = LatencyDetector(cooldown=10)
+        anomalies = [detector.update(t, 0.1 + 0.01 * (t % 3)) for t in range(100)]
+        self.assertFalse(any(anomalies))
+        spike = detector.update(100, 1)
+        self.assertEqual(spike['kind'], 'latency_spike')
+        self.assertAlmostEqual(spike['baseline'], 0.11, delta=0.01)
+        #  No new anomaly during the cooldown
+        self.assertIsNone(detector.update(101, 2))
+        self.assertEqual(detector.update(111, 2)['kind'], 'latency_spike')
+        self.assertIsNone(detector.check_window(111, 0.1, 0.5, 600))
+        self.assertEqual(detector.check_window(111, 0.1, 2, 600)['kind'], 'latency_divergence')
+        self.assertIn("over the last 30 seconds,", describe_anomaly(detector.check_window(200, 0.1, 2, 30)))
+        monitor = SiteMonitor('anomaly', 'http://localhost:4444', 1, 5)
+        for t in range(100):
+            monitor.request_scheduler.add((t, 200, 0.1))
+        monitor.request_scheduler.add((100, 200, 3))
+        monitor.consume_responses()
+        self.assertEqual(dict(monitor.read_metrics())['anomalies']['anomalies'][0]['elapsed'], 3)
+        self.assertListEqual(monitor.read_metrics(), [])
+
+    def test_diagnostics(self):
+        timers = Timers()
+        with timers.measure('render'):
+            time.sleep(0.02)
+        timers.add('render', 0.01)
+        stats = timers.read()['render']
+        self.assertEqual(stats['calls'], 2)
+        self.assertGreaterEqual(stats['max'], 0.02)
+        self.assertDictEqual(timers.read(), {})
+        monitor = SiteMonitor('test', 'tcp://localhost:1', 1, 1)
+        monitor.request_scheduler.add((time.time(), 503, 0))
+        diagnostics = collect(SimpleNamespace(site_monitors={('test', 'tcp://localhost:1', 1, 1): monitor},
+                                              ui=None, memory_budget=None))
+        self.assertDictEqual(diagnostics['sites'][0], {'name': 'test', 'in_flight': 0, 'skipped': 0, 'new_results': 1,
+                                                       'pending': 1, 'stored': 1, 'capacity': 600, 'memory': 120})
+        self.assertEqual(diagnostics['memory']['total'], 120)
+        directory = tempfile.mkdtemp()
+        with open(dump(diagnostics, directory)) as file:
+            self.assertIn('"threads"', file.read())
+        profiler = SamplingProfiler(directory, duration=0.2)
+        Thread(target=lambda: time.sleep(0.5), name='sleeper').start()
+        profiler.start()
+        profiler.join()
+        with open(profiler.path) as file:
+            self.assertIn('<lambda> (tests.py', file.read())
+
+    def test_window_pool(self):
+        pool = WindowPool(2)
+        pool.start()
+        monitors = []
+        #  The percentiles chosen are computed by the workers too
+        windows = [WindowSpec(10, 600, ('avg_elapsed', 'max_elapsed', 'codes_count', 'p50', 'p95'))]
+        for columnar in (False, True) * 3:
+            monitor = SiteMonitor(f'test {len(monitors)}', 'http://localhost', 1, 1, columnar=columnar,
+                                  window_pool=pool, windows=windows)
+            end = monitor.last_updates[10]
+            for i in range(1000):
+                monitor.request_scheduler.add((end - i / 10, 200 if i % 4 else 500, i / 1000))
+            monitor.update_metrics(10)
+            self.assertIn(10, monitor.pending_windows)
+            monitors.append((monitor, end))
+        empty = SiteMonitor('empty', 'http://localhost', 1, 1, window_pool=pool)
+        empty_end = empty.last_updates[10]
+        empty.update_metrics(10)
+        t = time.time()
+        while any(monitor.pending_windows for monitor, _ in monitors + [(empty, None)]) and time.time() - t < 30:
+            time.sleep(0.1)
+        pool.stop()
+        #  A window without responses publishes nothing, and is computed again one period later
+        self.assertNotIn(10, empty.metrics)
+        self.assertGreater(empty.last_updates[10], empty_end)
+        for monitor, end in monitors:
+            _, codes_count, max_elapsed, avg_elapsed, _ = monitor.get_metrics(end, 600, 10)
+            self.assertEqual(monitor.metrics[10]['codes_count'], codes_count)
+            self.assertAlmostEqual(monitor.metrics[10]['max_elapsed'], max_elapsed, 6)
+            self.assertAlmostEqual(monitor.metrics[10]['avg_elapsed'], avg_elapsed, 6)
+            elapsed = sorted([r[2] for r in monitor.request_scheduler.results.get_slice(float('-inf'), end)])
+            self.assertAlmostEqual(monitor.metrics[10]['p50'], elapsed[len(elapsed) // 2], delta=0.001)
+            self.assertAlmostEqual(monitor.metrics[10]['p95'], elapsed[int(0.95 * len(elapsed))], delta=0.001)
+        #  Without numpy, the workers compute the same percentiles
+        block = shared_memory.SharedMemory(create=True, size=6 * 1000)
+        block.buf[:4000] = array('f', [i / 1000 for i in range(1000)]).tobytes()
+        block.buf[4000:6000] = array('h', [200] * 1000).tobytes()
+        for modules in ({}, {'numpy': None}):
+            with patch.dict(sys.modules, modules):
+                stats = compute_windows(block.name, 1000, [(0, 1000, ['p50', 'p99'])])[0]
+            self.assertAlmostEqual(stats['p50'], 0.5, delta=0.001)
+            self.assertAlmostEqual(stats['p99'], 0.99, delta=0.001)
+        block.close()
+        block.unlink()
+
+    def test_window_engine(self):
+        windows = [WindowSpec(10, 60, ['availability', 'p99']), WindowSpec(30, 300, key='five minutes')]
+        engine = WindowEngine(windows, origin=0)
+        self.assertEqual(engine.resolution, 10)
+        generator = random.Random(0)
+        responses = [(generator.uniform(0, 1000), generator.choice([200, 200, 500]), generator.uniform(0, 1))
+                     for _ in range(5000)]
+        responses.sort()
+        for end in range(10, 1000, 10):
+            for response in [r for r in responses if end - 10 <= r[0] < end]:
+                engine.add(*response)
+            #  A response arriving late in a bucket already included
+            engine.add(end - 25, 200, 0.5)
+            responses.append((end - 25, 200, 0.5))
+            #  Sometimes slower than the responses of its bucket
+            late = (end - generator.randrange(11, 60), 200, generator.uniform(0, 1.2))
+            engine.add(*late)
+            responses.append(late)
+            for spec in windows:
+                stats = engine.evaluate(spec.key, end)
+                window = [r for r in responses if end - spec.duration <= r[0] < end]
+                self.assertEqual(stats['codes_count'], Counter([r[1] for r in window]))
+                self.assertAlmostEqual(stats['max_elapsed'], max([r[2] for r in window]))
+                self.assertAlmostEqual(stats['avg_elapsed'], sum([r[2] for r in window]) / len(window))
+            self.assertAlmostEqual(stats['availability'], sum([r[1] < 400 for r in window]) / len(window))
+        self.assertLessEqual(len(engine.buckets), 31)
+        path = os.path.join(tempfile.mkdtemp(), 'windows.json')
+        with open(path, 'w') as file:
+            json.dump([{'period': 60, 'duration': 300}, {'period': 60, 'duration': 86400, 'stats': ['p99']}], file)
+        self.assertRaises(ValueError, load_windows, path)
+        self.assertRaises(ValueError, WindowSpec, 10, 60, ['p42'])
+
+    def test_fleet_index(self):
+        fleet = FleetIndex()
+        generator = random.Random(0)
+        health = {}
+        for _ in range(3000):
+            name = f"{generator.choice(['eu', 'us'])}-{generator.randrange(300)}"
+            health[name] = {'availability': generator.choice([None, generator.random()]),
+                            'p99': generator.choice([None, generator.uniform(0, 3)]),
+                            'errors': generator.randrange(5), 'down': generator.random() < 0.1}
+            fleet.update(name, health[name])
+        for ranking, lowest_first in (('availability', True), ('p99', False), ('errors', False)):
+            for prefix in ('', 'eu', 'us-1', 'us-12', 'asia'):
+                expected = sorted([(h[ranking], name) for name, h in health.items()
+                                   if name.startswith(prefix) and h[ranking] is not None])
+                worst = expected if lowest_first else expected[::-1]
+                self.assertEqual(fleet.top(ranking, 20, prefix), worst[:20])
+                self.assertEqual(fleet.top(ranking, 20, prefix, worst=False), worst[::-1][:20])
+        available = [h['availability'] for h in health.values() if h['availability'] is not None]
+        self.assertAlmostEqual(fleet.availability, sum(available) / len(available))
+        self.assertEqual(fleet.n_down, sum([h['down'] for h in health.values()]))
+        self.assertEqual(sum(fleet.bands), sum([h['p99'] is not None for h in health.values()]))
+        self.assertEqual(fleet.count('eu'), len([name for name in health if name.startswith('eu')]))
+
+    def test_timeline(self):
+        generator = random.Random(0)
+        events = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'timeline.jsonl')
+            timeline = Timeline(path)
+            for i in range(2000):
+                #  The events mostly arrive in order, with a few late ones
+                t = 1000 + i - (generator.randrange(50) if generator.random() < 0.1 else 0)
+                event = (f"site-{generator.randrange(20)}", generator.choice(['unavailable_since', 'spike']), t,
+                         None)
+                events.append(event)
+                timeline.add([event])
+            expected = sorted(events, key=itemgetter(2))
+            self.assertEqual(list(timeline), expected)
+            self.assertEqual(list(timeline.select('site-3')[1]), [e for e in expected if e[0] == 'site-3'])
+            self.assertEqual(timeline.select('unknown'), ([], []))
+            self.assertEqual(timeline[timeline.find(1500.5)][2], min([e[2] for e in events if e[2] >= 1500.5]))
+            self.assertTrue(all([e[2] >= 1500 for e in timeline.select('site-3')[1][timeline.find(1500, 'site-3'):]]))
+            self.assertEqual(timeline.last_changes['site-3'], max([e[2] for e in events
+                                                                  if e[0] == 'site-3' and e[1] != 'spike']))
+            #  A restart reads the events back, and a line cut short by a crash is dropped
+            with open(path, 'a') as file:
+                file.write('["site-1", "recov')
+            restored = Timeline(path)
+            self.assertEqual(list(restored), expected)
+            self.assertEqual(restored.last_changes, timeline.last_changes)
+            #  The events added after the restart are read back too
+            restored.add([('site-1', 'recovered_at', 3000, None)])
+            expected.append(('site-1', 'recovered_at', 3000, None))
+            self.assertEqual(list(Timeline(path)), expected)
+            #  Only the latest events are kept, in memory and in the file
+            restored = Timeline(path, max_events=1000)
+            self.assertEqual(list(restored), expected[-1000:])
+            self.assertEqual(list(restored.select('site-3')[1]), [e for e in expected[-1000:] if e[0] == 'site-3'])
+            spikes = [('site-1', 'spike', 4000 + i, None) for i in range(501)]
+            for event in spikes:
+                restored.add([event])
+            self.assertEqual(list(restored), (expected + spikes)[-1000:])
+            self.assertEqual(list(Timeline(path)), list(restored))
+        self.assertEqual(parse_time('2024-01-31 13:05'), time.mktime((2024, 1, 31, 13, 5, 0, 0, 0, -1)))
+        self.assertEqual(time.localtime(parse_time('13:05:30'))[3:6], (13, 5, 30))
+        self.assertIsNone(parse_time('tomorrow'))
+
+    def test_sites_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sites.txt')
+            with open(path, 'w') as file:
+                file.write('name,url,interval,timeout\n'
+                           'a, http://example.com, 10, 1\n'
+                           '"b, eu", "http://example.com/?q=1,2", 5, 1\n\n'
+                           'c, example.com, 5, 1\n'
+                           'd, tcp://example.com, -1, x\n'
+                           'a, http://example.com, 5, 1\n'
+                           'e, tls://example.com, 5\n')
+            with self.assertRaises(SitesFileError) as error:
+                get_sites(path)
+            self.assertEqual([line for line, _ in error.exception.errors], [5, 6, 6, 6, 7, 8])
+            with open(path, 'w') as file:
+                file.write(''.join([f"site {i}, http://host{i % 3}.com, {1 + i % 2}, 1\n" for i in range(25)]))
+            chunks = list(SitesReader(path, chunk_size=10))
+            self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+            self.assertEqual(chunks[0][1], ('site 1', 'http://host1.com', 2, 1))
+            path = os.path.join(directory, 'sites.jsonl')
+            with open(path, 'w') as file:
+                file.write('{"name": "a", "url": "https://example.com", "interval": 10, "timeout": 2}\n'
+                           '{"name": "b", "url": "https://example.com"}\n[]\n{"name":\n')
+            with self.assertRaises(SitesFileError) as error:
+                get_sites(path)
+            self.assertEqual([line for line, _ in error.exception.errors], [2, 3, 4])
+            #  Once the first chunk is handed, the invalid lines are logged and skipped
+            path = os.path.join(directory, 'sites.txt')
+            with open(path, 'a') as file:
+                file.write('z, example.com, 5, 1\n')
+            with self.assertRaises(SitesFileError) as error:
+                list(SitesReader(path, chunk_size=30))
+            self.assertEqual([line for line, _ in error.exception.errors], [26])
+            reader = SitesReader(path, chunk_size=10)
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertEqual(list(reader), chunks)
+            self.assertEqual(len(logs.output), 1)
+            self.assertEqual([line for line, _ in reader.errors], [26])
+            with self.assertRaises(SitesFileError):
+                get_sites(path)
+            with self.assertRaises(SitesFileError) as error:
+                get_sites(os.path.join(directory, 'missing.txt'))
+            self.assertIn('missing.txt', str(error.exception))
+            #  The websites of the next chunks share the probes of the websites already started. The monitors are
+            #  stand-ins, so that no website is probed
+            monitor = GlobalMonitor(chunks[0], directory, site_chunks=chunks[1:],
+                                    monitor_factory=lambda *site, **settings: Mock())
+            while not monitor.all_started:
+                monitor.start_batch()
+            monitor.stop()
+            self.assertEqual(len(monitor.site_monitors), 25)
+            self.assertEqual(set(monitor.shared_probes.values()), {chunks[0][0], chunks[0][2], chunks[0][4]})
+            self.assertEqual(len(monitor.probe_phases), 3)
+
+    def test_simulator(self):
+        #  test_stats in virtual time: a website always failing, probed every 0.1 second for 121 seconds
+        simulation = Simulation([('probability', 'sim://probability', 0.1, 5)],
+                                {'probability': Target(codes={400: 1})})
+        simulation.run(121)
+        monitor = simulation.monitors['probability']
+        first_probe = monitor.request_scheduler.first_probe
+        self.assertAlmostEqual(monitor.unavailable_since, first_probe + 0.2, delta=1e-6)
+        self.assertEqual(monitor.metrics[120]['availability'], 0)
+        #  The counts are exact, the probes being sent at the same virtual times at every run
+        self.assertEqual(dict(monitor.metrics[10]['codes_count']), {400: 1050})
+        self.assertEqual(dict(monitor.metrics[60]['codes_count']), {400: 550})
+        #  A scripted outage, replayed identically from the same seed
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'scenario.json')
+            with open(path, 'w') as file:
+                json.dump([{'name': 'shop', 'interval': 1, 'timeout': 2, 'seed': 7,
+                            'latency': {'distribution': 'lognormal', 'median': 0.1, 'sigma': 0.5},
+                            'codes': {'200': 95, '500': 5}, 'outages': [{'start': 300, 'end': 400}]}], file)
+            runs = []
+            for _ in range(2):
+                simulation = Simulation(*load_scenario(path))
+                simulation.run(350)
+                monitor = simulation.monitors['shop']
+                self.assertAlmostEqual(monitor.unavailable_since - simulation.clock.start, 300, delta=30)
+                simulation.run(250)
+                self.assertAlmostEqual(monitor.recovered_at - simulation.clock.start, 400, delta=120)
+                runs.append(monitor.read_metrics())
+        self.assertEqual(runs[0], runs[1])
+        self.assertEqual(set(monitor.metrics[10]['codes_count']), {200, 500, 503})
+        with self.assertRaises(ValueError):
+            Target(latency={'distribution': 'normal', 'mean': 1})
+
+    def test_memory_budget(self):
+        sites = [('fast', 'sim://fast', 0.001, 1), ('slow', 'sim://slow', 10, 1), ('normal', 'sim://normal', 1, 1)]
+        reserved = 3 * 361 * BUCKET_BYTES
+        budget = MemoryBudget(reserved + 1e6, columnar=True)
+        capacities = budget.add(sites)
+        #  The websites needing less than their share keep all their responses, the rest goes to the fast one.
+        #  Each response costs 18 bytes, and 100 for the fifth of an entry of the availability window
+        self.assertEqual(capacities['slow'], 60)
+        self.assertEqual(capacities['normal'], 600)
+        self.assertEqual(capacities['fast'], int((1e6 - 0.05 * (reserved + 1e6)) / 38) - 660)
+        self.assertEqual(budget.trimmed, ['fast'])
+        #  16 histories of each website: 6 for each window and 4 for the availability
+        self.assertEqual(budget.history_size, int(0.05 * (reserved + 1e6) / (3 * 16 * 64)))
+        self.assertLessEqual(budget.allocated, budget.total)
+        #  The shares only shrink as websites are added, down to the fewest responses
+        budget.add([(f'site {i}', f'sim://site{i}', 0.01, 1) for i in range(100)])
+        self.assertLess(budget.capacities['fast'], capacities['fast'])
+        self.assertEqual(budget.capacities['site 0'], MIN_SAMPLES)
+        self.assertEqual(budget.capacities['slow'], 60)
+        self.assertGreater(budget.allocated, budget.total)
+        #  A website keeping 1000 responses out of 60000 still computes its metrics over all of them
+        for columnar in (False, True):
+            reference = Simulation(sites[:1], {}, columnar=columnar)
+            reference.run(70)
+            simulation = Simulation(sites[:1], {}, columnar=columnar)
+            monitor = simulation.monitors['fast']
+            monitor.resize(1000)
+            monitor.window_pool = SimpleNamespace(submit=lambda *args: self.fail("the pool needs the responses"))
+            simulation.run(70)
+            self.assertEqual(len(monitor.request_scheduler.results), 1000)
+            self.assertFalse(monitor.covers(600))
+            self.assertEqual(monitor.metrics[10], reference.monitors['fast'].metrics[10])
+            self.assertGreater(sum(monitor.metrics[10]['codes_count'].values()), 50000)
+            #  The availability window merges its responses in 0.6 second entries
+            self.assertEqual(monitor.tracker.resolution, 0.6)
+            self.assertLessEqual(len(monitor.tracker.samples), 201)
+            self.assertAlmostEqual(monitor.tracker.total, reference.monitors['fast'].tracker.total, delta=600)
+            usage = get_usage(monitor, 100)
+            self.assertEqual(usage['buckets'], len(monitor.engine.buckets) * BUCKET_BYTES)
+            self.assertEqual(usage['history'], 6400)
+            self.assertLess(usage['samples'], 130000)
+        #  The monitors of a global monitor are sized within its budget
+        with tempfile.TemporaryDirectory() as directory:
+            monitor = GlobalMonitor(sites, directory, memory_budget=reserved + 1e6)
+            self.assertEqual(monitor.memory_budget.capacities['normal'], 600)
+            monitor.add_sites([(f'site {i}', f'sim://site{i}', 0.01, 1) for i in range(100)])
+            self.assertEqual(monitor.memory_budget.capacities['site 0'], MIN_SAMPLES)
+
     def test_stats(self):
         monitor = SiteMonitor('probability', 'http://localhost:4444/unavailable?probability=1', 0.1, 5)
         t = time.time()
@@ -60,7 +903,8 @@ class MyTestCase(unittest.TestCase):
         time.sleep(121)
         monitor.stop()
         time.sleep(5)
-        self.assertAlmostEqual(monitor.unavailable_since, t, 1)
+        #  The website goes down with the third failed request
+        self.assertAlmostEqual(monitor.unavailable_since, t, delta=0.5)
         self.assertEqual(monitor.metrics[120]['availability'], 0)
         self.assertIsInstance(monitor.metrics, dict)
         self.assertIsInstance(monitor.metrics[10]['codes_count'], Counter)